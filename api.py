@@ -1,41 +1,344 @@
 from time import sleep
 import time
 import boto3
+import botocore.config, botocore.credentials, botocore.session, botocore.exceptions
 import pandas as pd
 import numpy as np
 import datetime
-import urllib.request, json 
+import urllib.request, urllib.parse, json 
 import requests
 import adal
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from functools import partial 
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from typing import List, Dict
 import threading
 import sys
-from collections import defaultdict 
+import os
+import re
+import math
+import random
+import shutil
+import tempfile
+import queue
+import uuid
+from collections import defaultdict, OrderedDict, deque
 
 US_REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2']
-clients = {}
-region = US_REGIONS[0]
+clients = {} # (profile, region, service) -> client, see get_client
+region = US_REGIONS[0] # defaults of the ManagerState that run() serves, set from the command line in __main__
+zone = None # availability zone the fleet is launched in
 current_type = 't2.micro'
 capacity = 2
 INSTANCE_MANAGER_INSTANCE_ID = "i-035f88ca820e399e7"
 CLIENT_INSTANCE_ID = "i-0c7adc535b262d69e"
 SERVICE_INSTANCE_ID = "i-0dd2ca9d91838f3c8"
+PRICE_STORE_DIR = "price_store" # columnar price snapshots, see write_price_snapshot
+PRICE_STORE_LATEST_FILE = "LATEST" # per region dir, name of the newest partition, see latest_price_snapshot
+PRICE_STORE_RETENTION = 7 * 24 * 60 * 60 # in seconds, older partitions are deleted, see compact_price_snapshots
+PRICE_STORE_COMPACT_AFTER = 24 * 60 * 60 # in seconds, older partitions are thinned to the last one of each hour
+PRICE_STORE_COMPACT_INTERVAL = 60 * 60 # in seconds, how often write_price_snapshot compacts a region
+INSTANCE_TYPE_CACHE_DIR = "instance_type_cache" # one json catalog per region, see load_instance_type_catalog
+INSTANCE_TYPE_CACHE_TTL = 7 * 24 * 60 * 60 # in seconds. NIC limits, architectures, etc. almost never change
+INSTANCE_TYPE_CACHE_MAX_REGIONS = 8 # in-memory LRU size
+FLEET_FULFILMENT_HISTORY_FILE = "fleet_fulfilment_history.json" # observed spot pool capacity, see record_pool_fulfilment
+POOL_CAPACITY_TTL = 6 * 60 * 60 # in seconds, how long an observed shortfall caps a pool
+UM_AWS_PROFILE = 'spotproxy-pat-umich-role'
+CLIENT_MAX_POOL_CONNECTIONS = 50 # per client, i.e., per (profile, region, service)
+CLIENT_RETRY_MODE = 'standard' # 'legacy' | 'standard' | 'adaptive'
+CLIENT_MAX_ATTEMPTS = 3 # botocore retries of non-EC2 clients (e.g., ce, sts)
+EC2_CLIENT_MAX_ATTEMPTS = 1 # no botocore retries for ec2 clients: ec2_call retries (and counts) throttles and transient errors itself
+CREDENTIAL_RELOAD_INTERVAL = 20 * 60 # in seconds. botocore refreshes credentials 15 minutes before they "expire", so profiles are re-read every ~5 minutes
+EC2_THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'RequestThrottled', 'RequestThrottledException', 'ThrottledException', 'EC2ThrottledException', 'TooManyRequestsException', 'SlowDown')
+EC2_TRANSIENT_ERROR_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable', 'RequestTimeout', 'RequestTimeoutException') # retried by ec2_call like any 5xx
+EC2_CALL_BUCKETS = { # family -> (bucket size, refill per second), AWS's default EC2 API request rate limits per account and region
+    'describe': (100, 20),
+    'mutate': (200, 5),
+    'instances': (50, 5), # RunInstances, CreateFleet, Start/Stop/Reboot/TerminateInstances (the resource-intensive family)
+}
+EC2_INSTANCE_OPERATIONS = ('run_instances', 'create_fleet', 'start_instances', 'stop_instances', 'reboot_instances', 'terminate_instances')
+EC2_CALL_MAX_CONCURRENCY = 32 # per (region, family)
+EC2_CALL_MAX_RETRIES = 8
+EC2_CALL_BACKOFF_BASE = 0.5 # in seconds
+EC2_CALL_BACKOFF_CAP = 20 # in seconds
+FLEET_FULFILMENT_TIMEOUT = 60 # in seconds, how long AWS gets to place a fleet's capacity, see iter_fleet_instances
+FLEET_RUNNING_TIMEOUT = 180 # in seconds, how much longer placed instances get to reach running
+FLEET_POLL_INTERVAL = 1 # in seconds, first poll. Grows by 1.5x up to FLEET_POLL_MAX_INTERVAL
+FLEET_POLL_MAX_INTERVAL = 10
+CAPACITY_ERROR_CODES = ('InsufficientInstanceCapacity', 'MaxSpotInstanceCountExceeded', 'InsufficientCapacity', 'UnfulfillableCapacity')
+POOL_BLACKLIST_TTL = 10 * 60 # in seconds, how long a pool that reported a capacity error is skipped
+EIP_POOL_SPARES = 8 # spare EIPs kept allocated per region, see ElasticIpPool
+EIP_POOL_WORKERS = 4 # background allocate/release calls per region
+EIP_POOL_TAG = {'Key': 'instance-manager', 'Value': 'eip-pool'} # tags every EIP an ElasticIpPool allocates, so that cleanup scripts can leave the spares alone
+ROTATION_MAX_WORKERS = 64 # concurrent NIC IP swaps across the fleet, see rotate_fleet_ips
+ROTATION_MAX_WORKERS_PER_REGION = 32
+ROTATION_PHASES = ('allocate', 'disassociate', 'associate', 'release', 'swap') # swap: the whole critical path of one NIC (allocate + disassociate + associate)
+NIC_PROVISIONING_WORKERS = 16 # concurrent NIC create/attach (and rollback) calls per instance, see create_nics
+NIC_DETACH_TIMEOUT = 120 # in seconds, how long delete_nics waits for detached NICs to become available
+FLEET_MAX_OVERRIDES = 20 # pools per diversified create_fleet request, see fleet_overrides
+FLEET_TERMINAL_STATES = ('failed', 'deleted', 'deleted_running', 'deleted_terminating')
+EXCLUDE_FROM_TERMINATION_FILE = "misc/exclude-from-termination-list.json"
+INVENTORY_RECONCILE_INTERVAL = 60 # in seconds, how often FleetInventory re-lists every instance. Bounds the staleness of what the HTTP endpoints serve
+INVENTORY_RECONCILE_MAX_BACKOFF = 10 * 60 # in seconds, reconcile interval after repeated failures
+INVENTORY_MIN_STALENESS = 5 # in seconds, smallest max_staleness a caller can ask for, so that polling clients can't turn every request into a describe_instances listing
+INVENTORY_CHANGE_LOG_SIZE = 4096 # membership changes kept for the changes endpoint. Older cursors get a full reset instead
+INVENTORY_LONG_POLL_TIMEOUT = 30 # in seconds, longest a changes request is held open
+INTERRUPT_QUEUE_SIZE = 64 # pending interrupt jobs before the interrupt endpoint answers 503, see InterruptQueue
+INTERRUPT_WORKERS = 4 # interrupt jobs processed concurrently
+INTERRUPT_JOB_TTL = 60 * 60 # in seconds, how long finished jobs stay queryable
+INTERRUPT_REACHABLE_TIMEOUT = 120 # in seconds, how long a replacement gets to answer pings once running
+INTERRUPT_JOB_PHASES = ('queued', 'launch', 'running', 'registered', 'reachable', 'terminate')
+AZURE_RETAIL_PRICES_URL = "https://prices.azure.com/api/retail/prices" # override to point at a local fixture server
+AZURE_SKUS_URL = "https://management.azure.com/subscriptions/0e51cc83-16a9-4ea1-b6f9-ba23ddfcc8bf/providers/Microsoft.Compute/skus"
 
 def pretty_json(obj):
     return json.dumps(obj, sort_keys=True, indent=4, default=str)
 
+_client_sessions = {} # profile -> boto3 session, see _get_boto3_session
+_client_credentials = {} # profile -> ProfileCredentials
+_client_registry_lock = threading.Lock()
+
+def _load_profile_credentials(profile):
+    """
+        Re-reads profile from the shared credentials file (which refresh_credentials in the rejuvenation script rewrites in place).
+    """
+    credentials = botocore.session.Session(profile=profile).get_credentials().get_frozen_credentials()
+    return {
+        'access_key': credentials.access_key,
+        'secret_key': credentials.secret_key,
+        'token': credentials.token,
+        'expiry_time': (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=CREDENTIAL_RELOAD_INTERVAL)).isoformat(),
+    }
+
+class ProfileCredentials(botocore.credentials.RefreshableCredentials):
+    """
+        Credentials of one profile, re-read from the shared credentials file when they near their (artificial) expiry, see _load_profile_credentials.
+        force_refresh() makes the next read re-load them right away.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refresh_forced = threading.Event()
+
+    def force_refresh(self):
+        self.refresh_forced.set()
+        self.get_frozen_credentials() # refresh_needed is now True, so this re-loads them
+
+    def refresh_needed(self, refresh_in=None):
+        return self.refresh_forced.is_set() or super().refresh_needed(refresh_in)
+
+class ProfileCredentialProvider(botocore.credentials.CredentialProvider):
+    """
+        Hands a botocore session the ProfileCredentials of its profile, ahead of the default credential chain.
+    """
+    METHOD = 'spotproxy-profile'
+    CANONICAL_NAME = 'SpotproxyProfile'
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+def _get_boto3_session(profile):
+    """
+        Must be called with _client_registry_lock held (boto3 sessions are not thread safe, the clients they create are).
+    """
+    if profile not in _client_sessions:
+        if profile is None:
+            _client_sessions[profile] = boto3.session.Session()
+        else:
+            credentials = None
+            def load():
+                metadata = _load_profile_credentials(profile)
+                if credentials is not None:
+                    credentials.refresh_forced.clear()
+                return metadata
+            credentials = ProfileCredentials.create_from_metadata(
+                metadata=load(),
+                refresh_using=load,
+                method='shared-credentials-file',
+            )
+            botocore_session = botocore.session.get_session()
+            botocore_session.set_config_variable('profile', profile)
+            botocore_session.get_component('credential_provider').insert_before('env', ProfileCredentialProvider(credentials))
+            _client_credentials[profile] = credentials
+            _client_sessions[profile] = boto3.session.Session(botocore_session=botocore_session)
+    return _client_sessions[profile]
+
+def get_client(service, region=None, profile=None):
+    """
+        Process-wide client registry: one client per (profile, region, service), created on first use and shared by every thread afterwards.
+
+        Parameters:
+            region: None for the profile's default region (e.g., for the global ce endpoint)
+            profile: None for the default credential chain
+    """
+    key = (profile, region, service)
+    client = clients.get(key)
+    if client is not None:
+        return client
+    with _client_registry_lock:
+        if key not in clients:
+            max_attempts = EC2_CLIENT_MAX_ATTEMPTS if service == 'ec2' else CLIENT_MAX_ATTEMPTS
+            config = botocore.config.Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS, retries={'mode': CLIENT_RETRY_MODE, 'max_attempts': max_attempts})
+            clients[key] = _get_boto3_session(profile).client(service, region_name=region, config=config)
+        return clients[key]
+
+def configure_clients(max_pool_connections=None, retry_mode=None, max_attempts=None):
+    """
+        Changes the configuration of every client created from now on, and drops the existing ones so they are rebuilt with it.
+    """
+    global CLIENT_MAX_POOL_CONNECTIONS, CLIENT_RETRY_MODE, CLIENT_MAX_ATTEMPTS
+    with _client_registry_lock:
+        if max_pool_connections is not None:
+            CLIENT_MAX_POOL_CONNECTIONS = max_pool_connections
+        if retry_mode is not None:
+            CLIENT_RETRY_MODE = retry_mode
+        if max_attempts is not None:
+            CLIENT_MAX_ATTEMPTS = max_attempts
+        clients.clear()
+
+def refresh_client_credentials(profile=UM_AWS_PROFILE):
+    """
+        Swaps the credentials of every client of profile in place with the ones now in the shared credentials file. Clients (and their connection pools) are kept.
+    """
+    with _client_registry_lock:
+        credentials = _client_credentials.get(profile)
+    if credentials is not None:
+        credentials.force_refresh()
+
 def choose_session(is_UM_AWS, region):
-    if is_UM_AWS:
-        my_session = boto3.session.Session(profile_name='spotproxy-pat-umich-role')
-        ec2 = my_session.client('ec2', region)
-        ce = my_session.client('ce')
-    else:
-        ec2 = boto3.client('ec2', region)
-        ce = boto3.client('ce')
+    profile = UM_AWS_PROFILE if is_UM_AWS else None
+    ec2 = get_client('ec2', region, profile)
+    ce = get_client('ce', None, profile)
     return ec2, ce
 
+class CallThrottle:
+    """
+        Token bucket plus adaptive concurrency limit for one (region, API family).
+        The concurrency limit grows by ~1 per limit successful calls and halves on every throttle (AIMD), and a throttle also empties the bucket.
+    """
+    def __init__(self, capacity, refill_rate, max_concurrency=EC2_CALL_MAX_CONCURRENCY):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.stats = {'calls': 0, 'throttles': 0, 'retries': 0, 'failures': 0}
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and self.in_flight < int(self.concurrency_limit):
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.stats['calls'] += 1
+                    return
+                wait_time = (1 - self.tokens) / self.refill_rate if self.tokens < 1 else None # None: until a call in flight is released
+                self.condition.wait(wait_time)
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.stats['throttles'] += 1
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                self.tokens = 0
+            else:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self.condition.notify_all()
+
+    def count(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def snapshot(self):
+        with self.condition:
+            return dict(self.stats, concurrency_limit=self.concurrency_limit)
+
+_call_throttles = {} # (region, family) -> CallThrottle
+_call_throttles_lock = threading.Lock()
+
+def ec2_call_family(operation):
+    if operation in EC2_INSTANCE_OPERATIONS:
+        return 'instances'
+    if operation.startswith('describe_') or operation.startswith('get_'):
+        return 'describe'
+    return 'mutate'
+
+def get_call_throttle(region, family):
+    with _call_throttles_lock:
+        if (region, family) not in _call_throttles:
+            _call_throttles[(region, family)] = CallThrottle(*EC2_CALL_BUCKETS[family])
+        return _call_throttles[(region, family)]
+
+def get_call_stats():
+    """
+        Returns:
+            {"<region>/<family>": {'calls', 'throttles', 'retries', 'failures', 'concurrency_limit'}}
+    """
+    with _call_throttles_lock:
+        throttles = dict(_call_throttles)
+    return {region + "/" + family: throttle.snapshot() for (region, family), throttle in throttles.items()}
+
+def is_transient_ec2_error(e):
+    """
+        True for errors worth retrying that are not throttles: 5xx responses (see EC2_TRANSIENT_ERROR_CODES) and connection errors or timeouts.
+    """
+    if isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code') in EC2_TRANSIENT_ERROR_CODES or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))
+
+def ec2_call(ec2, operation, **kwargs):
+    """
+        Gateway for every EC2 API call: rate limited per (region, API family) by a CallThrottle, and retried with full-jitter exponential backoff 
+        when AWS throttles us or the call fails transiently (see is_transient_ec2_error). ec2 clients make a single attempt (EC2_CLIENT_MAX_ATTEMPTS), so every retry happens, and is counted, here.
+        Other errors are raised as is.
+
+        Usage example: ec2_call(ec2, 'allocate_address', Domain='vpc')
+    """
+    throttle = get_call_throttle(ec2.meta.region_name, ec2_call_family(operation))
+    for attempt in range(EC2_CALL_MAX_RETRIES + 1):
+        throttle.acquire()
+        try:
+            response = getattr(ec2, operation)(**kwargs)
+        except (botocore.exceptions.ClientError, botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) as e:
+            throttled = isinstance(e, botocore.exceptions.ClientError) and e.response.get('Error', {}).get('Code') in EC2_THROTTLE_ERROR_CODES
+            throttle.release(throttled)
+            if not (throttled or is_transient_ec2_error(e)) or attempt == EC2_CALL_MAX_RETRIES:
+                throttle.count('failures')
+                raise
+            throttle.count('retries')
+            sleep(random.uniform(0, min(EC2_CALL_BACKOFF_CAP, EC2_CALL_BACKOFF_BASE * 2 ** attempt)))
+            continue
+        except Exception:
+            throttle.release()
+            throttle.count('failures')
+            raise
+        throttle.release()
+        return response
+
+def ec2_paginate(ec2, operation, **kwargs):
+    """
+        Paginated variant of ec2_call: yields one response page at a time, following NextToken. Each page goes through the gateway on its own, so a throttled page is retried without restarting the listing.
+    """
+    while True:
+        page = ec2_call(ec2, operation, **kwargs)
+        yield page
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
 def chunks(lst, n):
     """
         Breaks a list into equally sized chunks of size n.
@@ -66,78 +369,327 @@ def get_azure_token():
     )
     return token['accessToken']
 
+_instance_type_catalogs = OrderedDict() # region -> {instance_type: metadata}, least recently used first
+_instance_type_catalogs_lock = threading.Lock()
+
+def _slim_instance_type_info(info):
+    """
+        Only keeps the metadata we actually use, in the same shape as a describe_instance_types entry.
+    """
+    return {
+        'InstanceType': info['InstanceType'],
+        'ProcessorInfo': {'SupportedArchitectures': info['ProcessorInfo']['SupportedArchitectures']},
+        'VCpuInfo': {'DefaultVCpus': info['VCpuInfo']['DefaultVCpus']},
+        'MemoryInfo': {'SizeInMiB': info['MemoryInfo']['SizeInMiB']},
+        'NetworkInfo': {'MaximumNetworkInterfaces': info['NetworkInfo']['MaximumNetworkInterfaces']},
+    }
+
+def _remember_instance_type_catalog(region, catalog):
+    with _instance_type_catalogs_lock:
+        _instance_type_catalogs[region] = catalog
+        _instance_type_catalogs.move_to_end(region)
+        while len(_instance_type_catalogs) > INSTANCE_TYPE_CACHE_MAX_REGIONS:
+            _instance_type_catalogs.popitem(last=False)
+
+def load_instance_type_catalog(ec2, refresh=False, cache_dir=INSTANCE_TYPE_CACHE_DIR, ttl=INSTANCE_TYPE_CACHE_TTL):
+    """
+        Metadata (architectures, vCPUs, memory, max NICs) of every instance type offered in ec2's region.
+        Lookup order: in-memory LRU -> on-disk json (if younger than ttl) -> bulk describe_instance_types (all pages), which then refreshes both caches.
+
+        Parameters:
+            refresh: True to skip both caches and re-fetch from AWS
+        Returns:
+            {instance_type: metadata}, where metadata has the same shape as a describe_instance_types entry
+    """
+    region = ec2.meta.region_name
+    if not refresh:
+        with _instance_type_catalogs_lock:
+            if region in _instance_type_catalogs:
+                _instance_type_catalogs.move_to_end(region)
+                return _instance_type_catalogs[region]
+
+    path = os.path.join(cache_dir, region + ".json")
+    catalog = None
+    if not refresh and os.path.exists(path):
+        with open(path, "r") as f:
+            cached = json.load(f)
+        if time.time() - cached['fetched_at'] < ttl:
+            catalog = cached['instance_types']
+
+    if catalog is None:
+        catalog = {}
+        for page in ec2_paginate(ec2, 'describe_instance_types'):
+            for info in page['InstanceTypes']:
+                catalog[info['InstanceType']] = _slim_instance_type_info(info)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, prefix=region + ".", suffix=".tmp", delete=False) as f: # unique per writer, so concurrent refreshes don't clobber each other
+            json.dump({'region': region, 'fetched_at': time.time(), 'instance_types': catalog}, f)
+        os.replace(f.name, path)
+
+    _remember_instance_type_catalog(region, catalog)
+    return catalog
+
+def get_instance_type_info(ec2, instance_type):
+    """
+        Cached metadata of a single instance type (see load_instance_type_catalog).
+    """
+    catalog = load_instance_type_catalog(ec2)
+    info = catalog.get(instance_type)
+    if info is None: # e.g., a type that was released after the catalog was cached
+        response = ec2_call(ec2, 'describe_instance_types',
+            InstanceTypes=[instance_type]
+        )
+        info = _slim_instance_type_info(response['InstanceTypes'][0])
+        region = ec2.meta.region_name
+        with _instance_type_catalogs_lock: # copy on write, other threads may be iterating the cached catalog
+            catalog = dict(_instance_type_catalogs.get(region, catalog))
+            catalog[instance_type] = info
+        _remember_instance_type_catalog(region, catalog)
+    return info
+
 def get_instance_type(ec2, types):
-    response = ec2.describe_instance_types(
-        InstanceTypes=types
-    )
-    return response
+    """
+        Same shape as the describe_instance_types response, but served from the instance type catalog cache.
+    """
+    return {'InstanceTypes': [get_instance_type_info(ec2, instance_type) for instance_type in types]}
 
 def get_max_nics(ec2, instance_type):
-    response = ec2.describe_instance_types(
-        InstanceTypes=[
-            instance_type,
-        ],
-        # Filters=[
-        #     {
-        #         'Name': 'network-info.maximum-network-interfaces',
-        #         'Values': [
-        #             'string',
-        #         ]
-        #     },
-        # ],
+    return int(get_instance_type_info(ec2, instance_type)['NetworkInfo']['MaximumNetworkInterfaces'])
+
+def attach_instance_type_metadata(ec2, prices):
+    """
+        Adds the catalog columns of each row's instance type to a price table (one cache lookup per distinct instance type):
+            - MaximumNetworkInterfaces: int
+            - SupportedArchitectures: comma separated, e.g., "i386,x86_64"
+            - VCpus: int
+            - MemoryMiB: int
+        The index and row order of prices are preserved.
+    """
+    instance_types = prices['InstanceType'].astype(str)
+    infos = {instance_type: get_instance_type_info(ec2, instance_type) for instance_type in pd.unique(instance_types)}
+    return prices.assign(
+        MaximumNetworkInterfaces=instance_types.map({t: int(info['NetworkInfo']['MaximumNetworkInterfaces']) for t, info in infos.items()}),
+        SupportedArchitectures=instance_types.map({t: ','.join(info['ProcessorInfo']['SupportedArchitectures']) for t, info in infos.items()}),
+        VCpus=instance_types.map({t: int(info['VCpuInfo']['DefaultVCpus']) for t, info in infos.items()}),
+        MemoryMiB=instance_types.map({t: int(info['MemoryInfo']['SizeInMiB']) for t, info in infos.items()}),
     )
 
-    # print(pretty_json(response))
+def instance_selection_mask(prices, price_column='SpotPrice', supported_architecture=None, min_nics=None, min_cost=None, max_cost=None, regions=None, exclude_pools=None):
+    """
+        One boolean mask over the price table for all the given constraints (None means unconstrained). 
+
+        Parameters:
+            supported_architecture: list of architectures, a row matches if its type supports any of them (needs the SupportedArchitectures column, see attach_instance_type_metadata)
+            min_nics: minimum MaximumNetworkInterfaces
+            min_cost, max_cost: inclusive bounds on price_column
+            regions: list of region prefixes of the AvailabilityZone, e.g., ["us-east-1"]
+            exclude_pools: (instance_type, availability_zone) pools to skip, e.g., get_blacklisted_pools()
+    """
+    mask = np.ones(len(prices.index), dtype=bool)
+    if supported_architecture:
+        pattern = r'(?:^|,)(?:' + '|'.join(re.escape(arch) for arch in supported_architecture) + r')(?:,|$)'
+        mask &= prices['SupportedArchitectures'].astype(str).str.contains(pattern).to_numpy()
+    if min_nics:
+        mask &= prices['MaximumNetworkInterfaces'].to_numpy() >= min_nics
+    if min_cost or max_cost:
+        cost = prices[price_column].to_numpy(dtype=float)
+        if min_cost:
+            mask &= cost >= min_cost
+        if max_cost:
+            mask &= cost <= max_cost
+    if regions:
+        mask &= prices['AvailabilityZone'].astype(str).str.startswith(tuple(regions)).to_numpy()
+    if exclude_pools:
+        pools = pd.MultiIndex.from_arrays([prices['InstanceType'].astype(str), prices['AvailabilityZone'].astype(str)])
+        mask &= ~pools.isin(list(exclude_pools))
+    return mask
+
+def select_cheapest_instance_row(prices, price_column='SpotPrice', supported_architecture=None, min_nics=None, min_cost=None, max_cost=None, regions=None, keep_order=False, exclude_pools=None):
+    """
+        Vectorized cheapest-instance selection: mask all constraints at once (see instance_selection_mask), then argmin over price_column. 
+
+        Parameters:
+            keep_order: True to return the first matching row in the table's current order instead (for tables that the caller already sorted)
+        Returns:
+            index, row of the selected instance
+    """
+    mask = instance_selection_mask(prices, price_column, supported_architecture, min_nics, min_cost, max_cost, regions, exclude_pools)
+    if not mask.any():
+        raise Exception("No instance type satisfies the constraints: architecture={}, min_nics={}, min_cost={}, max_cost={}, regions={}".format(supported_architecture, min_nics, min_cost, max_cost, regions))
+    if keep_order:
+        position = int(np.argmax(mask))
+    else:
+        position = int(np.argmin(np.where(mask, prices[price_column].to_numpy(dtype=float), np.inf)))
+    return prices.index[position], prices.iloc[position]
 
-    return int(response['InstanceTypes'][0]['NetworkInfo']['MaximumNetworkInterfaces'])
+def load_spot_price_watermarks(store_dir=PRICE_STORE_DIR):
+    """
+        Returns: {"<region>|<product description>": "<iso timestamp>"} of the last successful spot price history fetch.
+    """
+    path = os.path.join(store_dir, "watermarks.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+_watermarks_lock = threading.Lock() # regions may be refreshed concurrently (see update_spot_prices_all_regions)
+
+def save_spot_price_watermark(region, product_description, watermark, store_dir=PRICE_STORE_DIR):
+    with _watermarks_lock:
+        watermarks = load_spot_price_watermarks(store_dir)
+        watermarks[region + "|" + product_description] = watermark.isoformat()
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = os.path.join(store_dir, "watermarks.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(watermarks, f, indent=4)
+        os.replace(tmp_path, os.path.join(store_dir, "watermarks.json"))
+
+def check_deadline(deadline, what):
+    """
+        Raises TimeoutError if deadline (time.monotonic() value, None for no deadline) has passed.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError(what + " ran past its deadline")
+
+def fetch_spot_price_history(ec2, product_description='Linux/UNIX', start_time=None, deadline=None):
+    """
+        Follows NextToken until the end of the spot price history (describe_spot_price_history only returns a page at a time).
+
+        Parameters:
+            start_time: datetime (UTC). Defaults to now, i.e., only the prices currently in effect.
+            deadline: time.monotonic() value after which no further page is requested (TimeoutError)
+        Returns:
+            list of SpotPriceHistory records
+    """
+    if start_time is None:
+        start_time = datetime.datetime.utcnow()
+    records = []
+    for page in ec2_paginate(ec2, 'describe_spot_price_history', ProductDescriptions=[product_description], StartTime=start_time):
+        records.extend(page['SpotPriceHistory'])
+        check_deadline(deadline, "Spot price history of " + ec2.meta.region_name)
+    return records
+
+def update_spot_prices(ec2, product_description='Linux/UNIX', deadline=None):
+    """
+        Incrementally refreshes the AWS spot price table of ec2's region. 
+        Only the records newer than the persisted (region, product) watermark are fetched, and they are merged into the latest stored snapshot (latest price per AvailabilityZone and InstanceType wins). 
+        The first refresh of a region (no watermark yet) fetches the prices currently in effect for every pool.
+
+        Parameters:
+            deadline: time.monotonic() value. Past it, the refresh stops (TimeoutError) without storing anything
+        Returns:
+            df of the merged price table
+    """
+    region = ec2.meta.region_name
+    watermarks = load_spot_price_watermarks()
+    watermark = watermarks.get(region + "|" + product_description)
+    existing = None
+    if watermark is not None:
+        existing = read_price_snapshot('AWS', region)
+    if existing is None: # no usable history, start from the prices currently in effect
+        watermark = None
+    fetch_time = datetime.datetime.utcnow()
+    start_time = datetime.datetime.fromisoformat(watermark) if watermark is not None else fetch_time
+    responses = fetch_spot_price_history(ec2, product_description, start_time, deadline)
+
+    if len(responses) == 0:
+        if existing is None:
+            raise Exception("No spot price history returned for region: " + region)
+        check_deadline(deadline, "Spot price refresh of " + region)
+        save_spot_price_watermark(region, product_description, fetch_time)
+        return existing
 
-def update_spot_prices(ec2):
-    responses = ec2.describe_spot_price_history(
-        ProductDescriptions=['Linux/UNIX'],
-        StartTime=datetime.datetime.utcnow(),
-    )
     spot_prices: List[Dict[str, str]] = []
-    #get instance types in a batch of 50
-    item_count = len(responses['SpotPriceHistory'])
-    batch_size = 100
-    type_to_NIC = {}
-    for i in range(0, item_count, batch_size):
-        batch = responses['SpotPriceHistory'][i:i+batch_size]
-        instance_types = []
-        for response in batch:
-            instance_types.append(response['InstanceType'])
-        #get instance types
-        instance_types_response = ec2.describe_instance_types(
-            InstanceTypes=instance_types
-        )
-        #add instance types to spot price history
-        for response in instance_types_response['InstanceTypes']:
-            type_to_NIC[response['InstanceType']] = response['NetworkInfo']['MaximumNetworkInterfaces']
-    #add price per interface to spot price history
-    for response in responses['SpotPriceHistory']:
+    for response in responses:
         spot_prices.append({
             'AvailabilityZone': response['AvailabilityZone'],
             'InstanceType': response['InstanceType'],
-            'MaximumNetworkInterfaces': type_to_NIC[response['InstanceType']],
             'SpotPrice': float(response['SpotPrice']),
-            'PricePerInterface': (float(response['SpotPrice']) + 0.005 * (type_to_NIC[response['InstanceType']] - 1)) / type_to_NIC[response['InstanceType']],
             'Timestamp': response['Timestamp']  
         })
     df = pd.DataFrame(spot_prices)
-    #write to csv
-    df.to_csv('spot_prices.csv')
+    df['Timestamp'] = pd.to_datetime(df['Timestamp'], utc=True)
+    if existing is not None:
+        existing = existing[['AvailabilityZone', 'InstanceType', 'SpotPrice', 'Timestamp']].astype({'AvailabilityZone': str, 'InstanceType': str})
+        df = pd.concat([existing, df], ignore_index=True)
+    # keep only the latest price of each pool:
+    df = df.sort_values(by=['Timestamp'], kind='stable').drop_duplicates(subset=['AvailabilityZone', 'InstanceType'], keep='last')
+    df = df.reset_index(drop=True)
+    # join the catalog columns (NICs, architectures, vCPUs, memory) and add price per interface:
+    df = attach_instance_type_metadata(ec2, df)
+    df['PricePerInterface'] = (df['SpotPrice'] + 0.005 * (df['MaximumNetworkInterfaces'] - 1)) / df['MaximumNetworkInterfaces']
+    df = df[['AvailabilityZone', 'InstanceType', 'MaximumNetworkInterfaces', 'SpotPrice', 'PricePerInterface', 'Timestamp', 'SupportedArchitectures', 'VCpus', 'MemoryMiB']]
+    check_deadline(deadline, "Spot price refresh of " + region)
+    write_price_snapshot(df, 'AWS', region)
+    save_spot_price_watermark(region, product_description, fetch_time)
     return df
 
-def update_azure_vm_sizes():
-    token = "eyJ0eXAiOiJKV1QiLCJhbGciOiJSUzI1NiIsIng1dCI6IjVCM25SeHRRN2ppOGVORGMzRnkwNUtmOTdaRSIsImtpZCI6IjVCM25SeHRRN2ppOGVORGMzRnkwNUtmOTdaRSJ9.eyJhdWQiOiJodHRwczovL21hbmFnZW1lbnQuY29yZS53aW5kb3dzLm5ldCIsImlzcyI6Imh0dHBzOi8vc3RzLndpbmRvd3MubmV0L2JhZjBkNjVjLWM3NzQtNDA0MC1hMWE2LTBmZjAzZmQ2MWRkNi8iLCJpYXQiOjE3MDUwMDUwMDEsIm5iZiI6MTcwNTAwNTAwMSwiZXhwIjoxNzA1MDA5MjM4LCJhY3IiOiIxIiwiYWlvIjoiQVdRQW0vOFZBQUFBQyt5bVpJdTNxdU01TUk5V3c4ZnlrODcrQ3JaY2duTG1FV0JZUUVRRkczR3NCWUROSEZ0S3BuSDhJcWlEbWVYUC9WRGF4VnVWdkIwOTV0VVpBdDVzYmE1NzJYSkE0UFJ3bElXeFByTHZUVjRPQk9aMWZFMHZSWlVxdk84dnZ6NDkiLCJhbXIiOlsicHdkIl0sImFwcGlkIjoiMThmYmNhMTYtMjIyNC00NWY2LTg1YjAtZjdiZjJiMzliM2YzIiwiYXBwaWRhY3IiOiIwIiwiZmFtaWx5X25hbWUiOiJQZWkiLCJnaXZlbl9uYW1lIjoiSmlueXUiLCJncm91cHMiOlsiYmVjZWJlNTUtOTBhZi00ZjAzLWFiNjUtYjE3ZGYyMDVjOGRjIiwiMGY5OTJkN2UtMDMxYS00M2Y0LWJjZmQtMmU0YzMwMzY5YWMwIiwiMmU3ZGZjZjQtNzBlOC00MGQxLWJkNjktNDMyMjJlYjgwOGEyIl0sImlkdHlwIjoidXNlciIsImlwYWRkciI6IjE2OC41LjE4NS4yNiIsIm5hbWUiOiJKaW55dSBQZWkiLCJvaWQiOiJhZmQ2YjA1Zi1jYzA2LTQzZmUtOGVjMy1hZTkwMWUwNGFjMDciLCJvbnByZW1fc2lkIjoiUy0xLTUtMjEtMzk4MTcxODI5Mi0zMTQ3MDE3NDM3LTI0NTU3MjQyOTctMjU2OTMxIiwicHVpZCI6IjEwMDMyMDAwRDY4QjkzREEiLCJyaCI6IjAuQVZrQVhOYnd1blRIUUVDaHBnX3dQOVlkMWtaSWYza0F1dGRQdWtQYXdmajJNQk5aQVBFLiIsInNjcCI6InVzZXJfaW1wZXJzb25hdGlvbiIsInN1YiI6ImZwSU1zUGo2TGpxMHhOQ1FVTEM3NzlnVy1GQ3poWDV0Rk9hTTZzOVA2WTgiLCJ0aWQiOiJiYWYwZDY1Yy1jNzc0LTQwNDAtYTFhNi0wZmYwM2ZkNjFkZDYiLCJ1bmlxdWVfbmFtZSI6ImpwOTVAcmljZS5lZHUiLCJ1cG4iOiJqcDk1QHJpY2UuZWR1IiwidXRpIjoiUnVyNllqQ3lyVTJFV1Q0RmFMby1BQSIsInZlciI6IjEuMCIsIndpZHMiOlsiYjc5ZmJmNGQtM2VmOS00Njg5LTgxNDMtNzZiMTk0ZTg1NTA5Il0sInhtc19jYWUiOiIxIiwieG1zX3RjZHQiOjE1OTQ5MTg2MzF9.0-p5FaqFZQJ3UmB6Hg6UwQEGFm6-3p_bFRTt5OaBtJTqZjYefUjOpUyPAIXMVaPm-f8euCgx1JMv4zgwp63spcgFG370nUYmzfBWX_dCSaoWI2fCdRbxW3Z9qEEEo1sJIQ08HR7WORdWQcreWuOdZmGoRhwU_P78SdTW90-hnqIRQvggGN7_WGcN1_HxIcyrsa09v5pIXrad_noJsmCiwUvRmXBq2PFi5IbHs2vn5qbOEE_9d2xpK_cO48YtuctTmYPe5D1ATEzIR3ENNaNpH5EimvhOsCWHdmGsZ4DBZHoGBStQZBiAl_YmJ5vD9F-e_gcIGnw083Qy5xkdAfC3vw"
-    url = "https://management.azure.com/subscriptions/0e51cc83-16a9-4ea1-b6f9-ba23ddfcc8bf/providers/Microsoft.Compute/skus?api-version=2021-07-01&$filter=location eq 'eastus'"
+def update_spot_prices_all_regions(is_UM_AWS, regions=US_REGIONS, max_workers=4, timeout=120):
+    """
+        Refreshes the spot prices of several regions in parallel, each region through its own ec2 client, and merges them into one snapshot.
+        A region that fails, or that has not finished after timeout seconds, is left out of the result instead of blocking the others.
+        Regions that did not start by then are cancelled, and the ones still running stop at their next page (see update_spot_prices' deadline) without storing anything, 
+        so a timed out refresh never writes after this returns. Only the describe_spot_price_history call in flight, if any, is left to finish.
+
+        Parameters:
+            timeout: in seconds, for the whole refresh
+        Returns:
+            df of the merged prices (None if every region failed),
+            stats: {region: {"latency": seconds | None, "rows": int, "error": str | None}}
+    """
+    deadline = time.monotonic() + timeout
+    def refresh(ec2):
+        start_time = time.time()
+        df = update_spot_prices(ec2, deadline=deadline)
+        return df, time.time() - start_time
+
+    region_clients = {region: choose_session(is_UM_AWS=is_UM_AWS, region=region)[0] for region in regions}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(refresh, ec2): region for region, ec2 in region_clients.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True) # the slow regions give up at the deadline on their own
+
+    frames = []
+    stats = {}
+    for future, region in futures.items():
+        if future in not_done:
+            stats[region] = {"latency": None, "rows": 0, "error": "timed out after {} seconds".format(timeout)}
+        elif future.exception() is not None:
+            stats[region] = {"latency": None, "rows": 0, "error": repr(future.exception())}
+        else:
+            df, latency = future.result()
+            frames.append(df)
+            stats[region] = {"latency": latency, "rows": len(df.index), "error": None}
+    if not frames:
+        return None, stats
+    return pd.concat(frames, ignore_index=True), stats
+
+def azure_http_session(pool_size=8):
+    """
+        requests session with a connection pool large enough for pool_size concurrent requests.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_azure_vm_sizes(token, region='eastus', url=AZURE_SKUS_URL, session=None):
+    """
+        Follows every nextLink of the Microsoft.Compute/skus API.
+
+        Returns:
+            {sku name: MaxNetworkInterfaces}
+    """
+    session = session or azure_http_session(1)
     headers = {
         "Authorization": "Bearer " + token
     }
     max_nic = {}
-    next_page_link = url
+    next_page_link = url + "?api-version=2021-07-01&$filter=" + urllib.parse.quote("location eq '{}'".format(region))
     while next_page_link != None:
-        response = requests.get(next_page_link, headers=headers)
+        response = session.get(next_page_link, headers=headers)
+        response.raise_for_status()
         data = response.json()
         for item in data['value']:
             if "capabilities" in item.keys():
@@ -145,85 +697,607 @@ def update_azure_vm_sizes():
                 for c_item in capabilities:
                     if c_item['name'] == 'MaxNetworkInterfaces':
                         max_nic[item['name']] = c_item['value']
-        next_page_link = None
+        next_page_link = data.get('nextLink')
+    return max_nic
+
+def update_azure_vm_sizes(token=None, region='eastus', url=AZURE_SKUS_URL, session=None):
+    if token is None:
+        token = get_azure_token()
+    max_nic = fetch_azure_vm_sizes(token, region, url, session)
     #write to csv
     df = pd.DataFrame(max_nic.items(), columns=['InstanceType', 'MaximumNetworkInterfaces'])
     df.to_csv('azure_vm_sizes.csv')
 
+def _azure_retail_prices_page_url(base_url, region, skip):
+    price_filter = "serviceName eq 'Virtual Machines' and priceType eq 'Consumption' and armRegionName eq '{}'".format(region)
+    return base_url + "?$skip=" + str(skip) + "&$filter=" + urllib.parse.quote(price_filter)
 
-def update_azure_prices(update_nic=False):
+def iter_azure_retail_price_pages(region='eastus', base_url=AZURE_RETAIL_PRICES_URL, session=None, max_workers=8):
+    """
+        Streams the pages of the Azure retail prices API. 
+        The first page tells us the page size, after that pages are requested by $skip offset, max_workers at a time, until a page comes back short or without a NextPageLink.
+
+        Yields:
+            list of price items of each page, in page order
+    """
+    session = session or azure_http_session(max_workers)
+
+    def get_page(skip):
+        response = session.get(_azure_retail_prices_page_url(base_url, region, skip))
+        response.raise_for_status()
+        return response.json()
+
+    data = get_page(0)
+    yield data['Items']
+    page_size = len(data['Items'])
+    if data.get('NextPageLink') is None or page_size == 0:
+        return
+    next_skip = page_size
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            skips = [next_skip + i * page_size for i in range(max_workers)]
+            for data in executor.map(get_page, skips): # map keeps page order
+                yield data['Items']
+                if data.get('NextPageLink') is None or len(data['Items']) < page_size:
+                    return
+            next_skip = skips[-1] + page_size
+
+def update_azure_prices(update_nic=False, region='eastus', base_url=AZURE_RETAIL_PRICES_URL, max_workers=8):
+    """
+        Refreshes the Azure spot price table of region: retail price pages are fetched concurrently over one pooled session, and Spot SKUs are hash-joined against azure_vm_sizes.csv for their NIC limits.
+    """
+    session = azure_http_session(max_workers)
     if update_nic:
-        update_azure_vm_sizes()
-    nic_info = pd.read_csv('azure_vm_sizes.csv')
-    next_page_link = "https://prices.azure.com/api/retail/prices?$skip=0&$filter=serviceName%20eq%20%27Virtual%20Machines%27%20and%20priceType%20eq%20%27Consumption%27%20and%20armRegionName%20eq%20%27eastus%27"
+        update_azure_vm_sizes(region=region, session=session)
+    nic_info = pd.read_csv('azure_vm_sizes.csv', index_col=0)
     spot_prices: List[Dict[str, str]] = []
-    while next_page_link != None:
-        with urllib.request.urlopen(next_page_link) as url:
-            data = json.loads(url.read().decode())
-            for item in data['Items']:
-                if 'Spot' in item['skuName']:
-                    instance_type_name = item['skuName'].split('Spot')[0].strip()
-                    if instance_type_name in nic_info['InstanceType'].values:
-                        nic = nic_info.loc[nic_info['InstanceType'] == instance_type_name]['MaximumNetworkInterfaces'].values[0]
-                        spot_prices.append({
-                            'AvailabilityZone': item['location'],
-                            'InstanceType': item['skuName'],
-                            'MaximumNetworkInterfaces': nic,
-                            'SpotPrice': item['retailPrice'],
-                            'PricePerInterface': item['retailPrice'] / nic + nic * 0.005,
-                            'Timestamp': item['effectiveStartDate']  
-                        })
-                    else:
-                        spot_prices.append({
-                            'AvailabilityZone': item['location'],
-                            'InstanceType': item['skuName'],
-                            'MaximumNetworkInterfaces': 1,
-                            'SpotPrice': item['retailPrice'],
-                            'PricePerInterface': item['retailPrice'],
-                            'Timestamp': item['effectiveStartDate']  
-                        })
-            next_page_link = data['NextPageLink']
+    for items in iter_azure_retail_price_pages(region, base_url, session, max_workers):
+        for item in items:
+            if 'Spot' in item['skuName']:
+                spot_prices.append({
+                    'AvailabilityZone': item['location'],
+                    'InstanceType': item['skuName'],
+                    'SpotPrice': item['retailPrice'],
+                    'Timestamp': item['effectiveStartDate']  
+                })
+    if not spot_prices: # keep the latest stored snapshot rather than storing an empty one
+        print("no Azure spot prices returned for region: " + region)
+        return pd.DataFrame(columns=['AvailabilityZone', 'InstanceType', 'MaximumNetworkInterfaces', 'SpotPrice', 'PricePerInterface', 'Timestamp'])
     df = pd.DataFrame(spot_prices)
-    #write to csv
-    df.to_csv('azure_spot_prices.csv')
+    # hash join against the NIC table (types without NIC info are counted as single NIC):
+    max_nics = nic_info.drop_duplicates(subset=['InstanceType']).set_index('InstanceType')['MaximumNetworkInterfaces']
+    nic = df['InstanceType'].str.split('Spot').str[0].str.strip().map(max_nics)
+    has_nic_info = nic.notna()
+    df['MaximumNetworkInterfaces'] = nic.fillna(1).astype(int)
+    df['PricePerInterface'] = np.where(has_nic_info, df['SpotPrice'] / df['MaximumNetworkInterfaces'] + df['MaximumNetworkInterfaces'] * 0.005, df['SpotPrice'])
+    df['Timestamp'] = pd.to_datetime(df['Timestamp'], utc=True)
+    df = df[['AvailabilityZone', 'InstanceType', 'MaximumNetworkInterfaces', 'SpotPrice', 'PricePerInterface', 'Timestamp']]
+    write_price_snapshot(df, 'Azure', region)
     return df
 
+def _price_snapshot_name(snapshot_time):
+    return snapshot_time.strftime('%Y%m%dT%H%M%S%fZ')
+
+def write_price_snapshot(df, provider, region, snapshot_time=None, store_dir=PRICE_STORE_DIR):
+    """
+        Appends a price snapshot to the columnar price store. Snapshots are never rewritten, each one is a new partition:
+            <store_dir>/<provider>/<region>/<snapshot_time>/
+                meta.json               # column order, kinds and categories
+                <column>.npy            # one typed array per column (memory-mappable)
+            <store_dir>/<provider>/<region>/LATEST  # name of the newest partition, replaced atomically
+
+        Old partitions are thinned and eventually deleted, see compact_price_snapshots.
+
+        String columns (e.g., AvailabilityZone, InstanceType) are categorically encoded: the .npy file holds int32 codes and meta.json holds the categories.
+        Datetime columns are stored as int64 nanoseconds since epoch (UTC).
+
+        Parameters:
+            provider: "AWS" | "Azure"
+            region: e.g., "us-east-1", "eastus"
+            snapshot_time: datetime (UTC). Defaults to now.
+        Returns:
+            path of the new partition
+    """
+    if snapshot_time is None:
+        snapshot_time = datetime.datetime.utcnow()
+    region_dir = os.path.join(store_dir, provider, region)
+    partition = os.path.join(region_dir, _price_snapshot_name(snapshot_time))
+    tmp_partition = partition + ".tmp"
+    os.makedirs(tmp_partition, exist_ok=True)
+
+    meta = {'provider': provider, 'region': region, 'snapshot_time': snapshot_time.isoformat(), 'rows': len(df.index), 'columns': []}
+    for column in df.columns:
+        series = df[column]
+        column_meta = {'name': str(column)}
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = pd.to_datetime(series, utc=True)
+            column_meta['kind'] = 'datetime'
+            array = values.values.astype('datetime64[ns]').view('int64')
+        elif pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+            column_meta['kind'] = 'numeric'
+            array = series.to_numpy()
+        else:
+            categorical = pd.Categorical(series)
+            column_meta['kind'] = 'categorical'
+            column_meta['categories'] = [str(c) for c in categorical.categories]
+            array = categorical.codes.astype('int32')
+        np.save(os.path.join(tmp_partition, str(column) + ".npy"), array, allow_pickle=False)
+        meta['columns'].append(column_meta)
+    with open(os.path.join(tmp_partition, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_partition, partition) # readers only ever see complete partitions
+
+    name = os.path.basename(partition)
+    with _price_store_lock:
+        latest = latest_price_snapshot(provider, region, store_dir)
+        if latest is None or name > latest: # backfilled snapshots don't move the pointer back
+            pointer = os.path.join(region_dir, PRICE_STORE_LATEST_FILE)
+            tmp_pointer = pointer + "." + uuid.uuid4().hex + ".tmp"
+            with open(tmp_pointer, "w") as f:
+                f.write(name)
+            os.replace(tmp_pointer, pointer)
+        key = (store_dir, provider, region)
+        compact = time.time() - _price_store_compacted.get(key, 0) >= PRICE_STORE_COMPACT_INTERVAL
+        if compact:
+            _price_store_compacted[key] = time.time()
+    if compact:
+        compact_price_snapshots(provider, region, store_dir)
+    return partition
+
+_price_store_lock = threading.Lock()
+_price_store_compacted = {} # (store_dir, provider, region) -> time of the last compact_price_snapshots
+
+def compact_price_snapshots(provider, region, store_dir=PRICE_STORE_DIR, retention=PRICE_STORE_RETENTION, compact_after=PRICE_STORE_COMPACT_AFTER):
+    """
+        Bounds the size of a region's price store: partitions older than compact_after are thinned to the last one of each hour, 
+        and partitions older than retention are deleted. The latest partition is always kept.
+
+        Returns:
+            names of the deleted partitions
+    """
+    snapshots = list_price_snapshots(provider, region, store_dir)
+    latest = latest_price_snapshot(provider, region, store_dir)
+    now = datetime.datetime.utcnow()
+    deleted = []
+    for position, name in enumerate(snapshots):
+        if name == latest or position == len(snapshots) - 1:
+            continue
+        try:
+            age = (now - datetime.datetime.strptime(name, '%Y%m%dT%H%M%S%fZ')).total_seconds()
+        except ValueError:
+            continue # not a partition
+        next_in_same_hour = position + 1 < len(snapshots) and snapshots[position + 1][:11] == name[:11] # YYYYmmddTHH
+        if age > retention or (age > compact_after and next_in_same_hour):
+            shutil.rmtree(os.path.join(store_dir, provider, region, name), ignore_errors=True)
+            deleted.append(name)
+    if deleted:
+        print(f"Compacted the {provider} {region} price store: deleted {len(deleted)} of {len(snapshots)} snapshots")
+    return deleted
+
+def list_price_snapshots(provider, region, store_dir=PRICE_STORE_DIR):
+    """
+        Returns the snapshot partition names of a provider/region, oldest first.
+    """
+    region_dir = os.path.join(store_dir, provider, region)
+    if not os.path.isdir(region_dir):
+        return []
+    return sorted(name for name in os.listdir(region_dir) if not name.endswith(".tmp") and name != PRICE_STORE_LATEST_FILE)
+
+def latest_price_snapshot(provider, region, store_dir=PRICE_STORE_DIR):
+    """
+        Name of the newest partition of a provider/region (None if there is none). 
+        Reads the LATEST pointer that write_price_snapshot maintains, so the region dir is only listed for stores written before the pointer existed.
+    """
+    try:
+        with open(os.path.join(store_dir, provider, region, PRICE_STORE_LATEST_FILE), "r") as f:
+            name = f.read().strip()
+        if name:
+            return name
+    except FileNotFoundError:
+        pass
+    snapshots = list_price_snapshots(provider, region, store_dir)
+    return snapshots[-1] if snapshots else None
+
+def list_price_regions(provider, store_dir=PRICE_STORE_DIR):
+    provider_dir = os.path.join(store_dir, provider)
+    if not os.path.isdir(provider_dir):
+        return []
+    return sorted(os.listdir(provider_dir))
+
+def read_price_snapshot(provider, region, snapshot=None, store_dir=PRICE_STORE_DIR):
+    """
+        Loads a price snapshot from the columnar price store (the latest one if snapshot is None). 
+        Column files are memory-mapped, so no text parsing or type inference happens here.
+
+        Returns:
+            df with the same columns that were written (categorical columns come back as pandas categoricals), or None if the store has no snapshot
+    """
+    if snapshot is None:
+        snapshot = latest_price_snapshot(provider, region, store_dir)
+        if snapshot is None:
+            return None
+    partition = os.path.join(store_dir, provider, region, snapshot)
+    with open(os.path.join(partition, "meta.json"), "r") as f:
+        meta = json.load(f)
+    columns = {}
+    for column_meta in meta['columns']:
+        array = np.load(os.path.join(partition, column_meta['name'] + ".npy"), mmap_mode='r', allow_pickle=False)
+        if column_meta['kind'] == 'categorical':
+            columns[column_meta['name']] = pd.Categorical.from_codes(array, categories=column_meta['categories'])
+        elif column_meta['kind'] == 'datetime':
+            columns[column_meta['name']] = pd.to_datetime(np.asarray(array).view('datetime64[ns]'), utc=True)
+        else:
+            columns[column_meta['name']] = array
+    return pd.DataFrame(columns, index=pd.RangeIndex(meta['rows']))
+
+def read_price_history(provider, regions=None, store_dir=PRICE_STORE_DIR):
+    """
+        Concatenates every stored snapshot of a provider (optionally only for some regions), oldest first.
+        Adds 'Region' and 'SnapshotTime' columns so that snapshots can be told apart.
+    """
+    frames = []
+    for region in (regions or list_price_regions(provider, store_dir)):
+        for snapshot in list_price_snapshots(provider, region, store_dir):
+            try:
+                df = read_price_snapshot(provider, region, snapshot, store_dir)
+            except FileNotFoundError:
+                continue # compacted away while listing
+            df['Region'] = region
+            df['SnapshotTime'] = pd.to_datetime(snapshot, format='%Y%m%dT%H%M%S%fZ', utc=True)
+            frames.append(df)
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+def read_latest_prices(provider, store_dir=PRICE_STORE_DIR):
+    """
+        Latest snapshot of every region of a provider, concatenated.
+    """
+    frames = [read_price_snapshot(provider, region, store_dir=store_dir) for region in list_price_regions(provider, store_dir)]
+    frames = [df for df in frames if df is not None]
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+PRICE_INDEX_KEYS = ['SpotPrice', 'PricePerInterface']
+_price_index_cache = {} # (provider, regions) -> (snapshot names, index)
+_price_index_cache_lock = threading.Lock()
+
+def price_region_of_zone(availability_zone):
+    """
+        e.g., us-east-1a -> us-east-1. Non-AWS zone names (e.g., Azure's "US East") are returned unchanged.
+    """
+    match = re.match(r'^([a-z]{2}(?:-[a-z]+)+-\d+)[a-z]$', availability_zone)
+    return match.group(1) if match else availability_zone
+
+def build_price_index(prices, keys=PRICE_INDEX_KEYS):
+    """
+        Per-region sorted arrays of each cost key, so that cost range queries are binary searches (see query_price_index). prices is referenced, not copied.
+
+        Returns:
+            {
+                'prices': prices,
+                'regions': {region: {key: (sorted key values, row positions in that order)}},
+                'nics': MaximumNetworkInterfaces array,
+                'zones': AvailabilityZone array,
+                'architectures': SupportedArchitectures array (or None),
+                'architecture_masks': {}, # filled lazily, one boolean array per architecture
+                'pools': {(instance_type, availability_zone): row position}
+            }
+    """
+    zones = prices['AvailabilityZone'].astype(str)
+    zone_to_region = {zone: price_region_of_zone(zone) for zone in pd.unique(zones)}
+    row_regions = zones.map(zone_to_region).to_numpy()
+    values = {key: prices[key].to_numpy(dtype=float) for key in keys}
+    index = {
+        'prices': prices,
+        'regions': {},
+        'nics': prices['MaximumNetworkInterfaces'].to_numpy(),
+        'zones': zones.to_numpy(),
+        'architectures': prices['SupportedArchitectures'].astype(str).to_numpy() if 'SupportedArchitectures' in prices.columns else None,
+        'architecture_masks': {},
+        'pools': {pool: position for position, pool in enumerate(zip(prices['InstanceType'].astype(str), zones))},
+    }
+    for region, positions in pd.Series(row_regions).groupby(row_regions).indices.items():
+        index['regions'][region] = {}
+        for key in keys:
+            order = np.argsort(values[key][positions], kind='stable')
+            index['regions'][region][key] = (values[key][positions][order], positions[order])
+    return index
+
+def _architecture_mask(index, arch):
+    if arch not in index['architecture_masks']:
+        if index['architectures'] is None:
+            raise Exception("Price index has no SupportedArchitectures column, see attach_instance_type_metadata")
+        pattern = r'(?:^|,)' + re.escape(arch) + r'(?:,|$)'
+        index['architecture_masks'][arch] = pd.Series(index['architectures']).str.contains(pattern).to_numpy()
+    return index['architecture_masks'][arch]
+
+def query_price_index(index, sort_by='SpotPrice', min_cost=None, max_cost=None, regions=None, supported_architecture=None, min_nics=None, k=None, exclude_positions=None, exclude_pools=None):
+    """
+        Cheapest candidates from a price index (see build_price_index). 
+        Cost bounds are binary searches on each region's sorted array, the remaining constraints are only evaluated on the rows inside the cost range.
+
+        Parameters:
+            sort_by: "SpotPrice" | "PricePerInterface"
+            min_cost, max_cost: inclusive bounds on sort_by
+            regions: list of region prefixes of the AvailabilityZone, e.g., ["us-east-1"] or ["us-east-1a"] (same as instance_selection_mask)
+            supported_architecture: list of architectures, a row matches if its type supports any of them
+            min_nics: minimum MaximumNetworkInterfaces
+            k: number of candidates to return (None for all)
+            exclude_positions: row positions to skip, e.g., rows that were already tried
+            exclude_pools: (instance_type, availability_zone) pools to skip, e.g., get_blacklisted_pools()
+        Returns:
+            df of the k cheapest matching rows of index['prices'], sorted by sort_by
+    """
+    if exclude_pools:
+        exclude_positions = list(exclude_positions or []) + [index['pools'][pool] for pool in exclude_pools if pool in index['pools']]
+    candidate_values = []
+    candidate_positions = []
+    for region, entry in index['regions'].items():
+        zone_prefixes = None # prefixes that only match some of the region's zones
+        if regions and not region.startswith(tuple(regions)):
+            zone_prefixes = tuple(prefix for prefix in regions if prefix.startswith(region))
+            if not zone_prefixes:
+                continue
+        values, positions = entry[sort_by]
+        low = np.searchsorted(values, min_cost, side='left') if min_cost else 0
+        high = np.searchsorted(values, max_cost, side='right') if max_cost else len(values)
+        values, positions = values[low:high], positions[low:high]
+        mask = np.ones(len(positions), dtype=bool)
+        if zone_prefixes:
+            mask &= pd.Series(index['zones'][positions], dtype=str).str.startswith(zone_prefixes).to_numpy()
+        if min_nics:
+            mask &= index['nics'][positions] >= min_nics
+        if supported_architecture:
+            arch_mask = np.zeros(len(positions), dtype=bool)
+            for arch in supported_architecture:
+                arch_mask |= _architecture_mask(index, arch)[positions]
+            mask &= arch_mask
+        if exclude_positions is not None and len(exclude_positions):
+            mask &= ~np.isin(positions, exclude_positions)
+        candidate_values.append(values[mask])
+        candidate_positions.append(positions[mask])
+
+    if not candidate_positions:
+        return index['prices'].iloc[[]]
+    values = np.concatenate(candidate_values)
+    positions = np.concatenate(candidate_positions)
+    order = np.argsort(values, kind='stable')[:k] # only the candidate arrays are sorted, and only k rows of the frame are copied
+    return index['prices'].iloc[positions[order]]
+
+def get_latest_price_index(provider='AWS', regions=None, store_dir=PRICE_STORE_DIR):
+    """
+        Price index of the latest stored snapshot of each region (all stored regions if regions is None). 
+        The index is rebuilt only when a region has a newer snapshot than the cached one.
+    """
+    regions = tuple(regions or list_price_regions(provider, store_dir))
+    snapshots = tuple((region, latest_price_snapshot(provider, region, store_dir)) for region in regions)
+    with _price_index_cache_lock:
+        cached = _price_index_cache.get((provider, regions))
+        if cached is not None and cached[0] == snapshots:
+            return cached[1]
+    frames = [read_price_snapshot(provider, region, snapshot, store_dir) for region, snapshot in snapshots if snapshot is not None]
+    if not frames:
+        return None
+    index = build_price_index(pd.concat(frames, ignore_index=True))
+    with _price_index_cache_lock:
+        _price_index_cache[(provider, regions)] = (snapshots, index)
+    return index
+
+_fulfilment_history_lock = threading.Lock()
+
+def _load_fulfilment_history(history_file=FLEET_FULFILMENT_HISTORY_FILE):
+    if not os.path.exists(history_file):
+        return {}
+    with open(history_file, "r") as f:
+        return json.load(f)
+
+def record_pool_fulfilment(instance_type, availability_zone, requested, fulfilled, history_file=FLEET_FULFILMENT_HISTORY_FILE):
+    """
+        Remembers how many instances a spot pool actually gave us. 
+        A shortfall caps the pool at what it fulfilled (see get_pool_capacity_caps), and a request that is fully fulfilled beyond that cap lifts it again.
+    """
+    key = instance_type + "|" + availability_zone
+    with _fulfilment_history_lock:
+        history = _load_fulfilment_history(history_file)
+        if fulfilled < requested:
+            history[key] = {'capacity': fulfilled, 'requested': requested, 'time': time.time()}
+        elif key in history and fulfilled >= history[key]['capacity']:
+            del history[key]
+        else:
+            return
+        tmp_path = history_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(history, f, indent=4)
+        os.replace(tmp_path, history_file)
+
+def get_pool_capacity_caps(history_file=FLEET_FULFILMENT_HISTORY_FILE, ttl=POOL_CAPACITY_TTL):
+    """
+        Returns:
+            {(instance_type, availability_zone): max instances} for pools that came up short within the last ttl seconds
+    """
+    with _fulfilment_history_lock:
+        history = _load_fulfilment_history(history_file)
+    caps = {}
+    for key, entry in history.items():
+        if time.time() - entry['time'] < ttl:
+            instance_type, availability_zone = key.split("|")
+            caps[(instance_type, availability_zone)] = entry['capacity']
+    return caps
+
+def plan_fleet(prices, proxy_count, multi_NIC=True, capacity_caps=None, max_pools=50):
+    """
+        Cheapest mix of spot pools (instance type, availability zone) that covers proxy_count proxies, solved as a bounded knapsack (min-cost cover) over the number of proxies covered.
+
+        Parameters:
+            prices: candidate rows (already filtered, e.g., by query_price_index). Needs InstanceType, AvailabilityZone, MaximumNetworkInterfaces, SpotPrice, PricePerInterface
+            multi_NIC: True if each instance serves MaximumNetworkInterfaces proxies (live IP), False for one proxy per instance
+            capacity_caps: {(instance_type, availability_zone): max instances}, e.g., from get_pool_capacity_caps. Uncapped pools can take as many instances as needed
+            max_pools: only the max_pools cheapest pools (per proxy) are considered
+        Returns:
+            launch plan, cheapest per proxy first: [
+                {
+                    'Index': index of the row in prices,
+                    'InstanceType': str,
+                    'AvailabilityZone': str,
+                    'Count': instances to request,
+                    'ProxiesPerInstance': int,
+                    'SpotPrice': float,
+                    'HourlyCost': float, # of the Count instances, including EIPs (multi_NIC)
+                },
+                ...
+            ]
+    """
+    capacity_caps = capacity_caps or {}
+    if multi_NIC:
+        per_instance = prices['MaximumNetworkInterfaces'].to_numpy(dtype=int)
+        cost = prices['PricePerInterface'].to_numpy(dtype=float) * per_instance # SpotPrice + EIPs of the extra NICs
+    else:
+        per_instance = np.ones(len(prices.index), dtype=int)
+        cost = prices['SpotPrice'].to_numpy(dtype=float)
+    order = np.argsort(cost / per_instance, kind='stable')[:max_pools]
+
+    # Binary split of each pool's bounded count into 0/1 chunks (1, 2, 4, ..., rest):
+    chunks_of_pools = [] # (row position, instance count, proxies covered, cost)
+    for position in order:
+        row = prices.iloc[position]
+        bound = math.ceil(proxy_count / per_instance[position])
+        bound = min(bound, capacity_caps.get((str(row['InstanceType']), str(row['AvailabilityZone'])), bound))
+        size = 1
+        while bound > 0:
+            count = min(size, bound)
+            chunks_of_pools.append((position, count, count * per_instance[position], count * cost[position]))
+            bound -= count
+            size *= 2
+
+    # dp[j] = min cost to cover j proxies (j == proxy_count means "at least proxy_count"):
+    dp = np.full(proxy_count + 1, np.inf)
+    dp[0] = 0
+    history = []
+    for position, count, proxies, chunk_cost in chunks_of_pools:
+        candidate = np.full(proxy_count + 1, np.inf)
+        if proxies < proxy_count:
+            candidate[proxies:] = dp[:proxy_count + 1 - proxies] + chunk_cost
+        candidate[proxy_count] = dp[max(0, proxy_count - proxies):].min() + chunk_cost
+        history.append(dp)
+        dp = np.minimum(dp, candidate)
+    if not np.isfinite(dp[proxy_count]):
+        raise Exception("Not enough pool capacity to cover {} proxies".format(proxy_count))
+
+    # Walk the chunks backwards to recover the chosen ones:
+    counts = defaultdict(int)
+    j = proxy_count
+    for (position, count, proxies, chunk_cost), previous in zip(reversed(chunks_of_pools), reversed(history)):
+        if j == 0:
+            break
+        if not np.isclose(previous[j], dp[j]): # this chunk was taken
+            counts[position] += count
+            if j < proxy_count:
+                j -= proxies
+            else:
+                low = max(0, proxy_count - proxies)
+                j = low + int(np.argmin(previous[low:]))
+        dp = previous
+
+    plan = []
+    for position in sorted(counts, key=lambda position: cost[position] / per_instance[position]):
+        row = prices.iloc[position]
+        plan.append({
+            'Index': prices.index[position],
+            'InstanceType': str(row['InstanceType']),
+            'AvailabilityZone': str(row['AvailabilityZone']),
+            'Count': int(counts[position]),
+            'ProxiesPerInstance': int(per_instance[position]),
+            'SpotPrice': float(row['SpotPrice']),
+            'HourlyCost': float(cost[position] * counts[position]),
+        })
+    return plan
+
 def merge_spot_prices():
-    aws_spot_prices = pd.read_csv('spot_prices.csv')
-    azure_spot_prices = pd.read_csv('azure_spot_prices.csv')
+    aws_spot_prices = read_latest_prices('AWS')
+    if aws_spot_prices is None: # store not populated yet, fall back to the legacy csv
+        aws_spot_prices = pd.read_csv('spot_prices.csv', index_col=0)
+    azure_spot_prices = read_latest_prices('Azure')
+    if azure_spot_prices is None:
+        azure_spot_prices = pd.read_csv('azure_spot_prices.csv', index_col=0)
     aws_spot_prices['Provider'] = 'AWS'
     azure_spot_prices['Provider'] = 'Azure'
-    spot_prices = pd.concat([aws_spot_prices, azure_spot_prices])
-    spot_prices['Timestamp'] = pd.to_datetime(spot_prices['Timestamp'])
+    spot_prices = pd.concat([aws_spot_prices, azure_spot_prices], ignore_index=True)
+    spot_prices['Timestamp'] = pd.to_datetime(spot_prices['Timestamp'], utc=True)
     spot_prices = spot_prices.sort_values(by=['Timestamp'])
-    spot_prices.to_csv('total_spot_prices.csv')
     return spot_prices
 
-def get_spot_prices():
-    df = pd.read_csv('spot_prices.csv')
+def get_spot_prices(region=US_REGIONS[0]):
+    """
+        Latest AWS prices for region, read from the price store.
+    """
+    df = read_price_snapshot('AWS', region)
+    if df is None: # store not populated yet, fall back to the legacy csv
+        df = pd.read_csv('spot_prices.csv', index_col=0)
     return df
 
+INSTANCE_RECORD_FIELDS = ('InstanceId', 'State', 'InstanceType', 'AvailabilityZone', 'PublicIpAddress', 'PrivateIpAddress', 'NetworkInterfaces', 'Tags')
+
+def instance_state_filter(*states):
+    return [
+        {
+            'Name': 'instance-state-name',
+            'Values': list(states)
+        }
+    ]
+
+def _slim_instance_record(instance, fields):
+    """
+        Keeps only fields of a describe_instances instance, under their AWS names. State is flattened to its name, AvailabilityZone is lifted out of Placement, 
+        NetworkInterfaces keep NetworkInterfaceId, DeviceIndex, PrivateIpAddress and PublicIp, and Tags become a dict.
+    """
+    record = {}
+    for field in fields:
+        if field == 'State':
+            record['State'] = instance['State']['Name']
+        elif field == 'AvailabilityZone':
+            record['AvailabilityZone'] = instance['Placement']['AvailabilityZone']
+        elif field == 'NetworkInterfaces':
+            record['NetworkInterfaces'] = [{
+                'NetworkInterfaceId': nic['NetworkInterfaceId'],
+                'DeviceIndex': nic['Attachment']['DeviceIndex'] if 'Attachment' in nic else None,
+                'PrivateIpAddress': nic.get('PrivateIpAddress'),
+                'PublicIp': nic.get('Association', {}).get('PublicIp'),
+            } for nic in sorted(instance.get('NetworkInterfaces', []), key=lambda nic: nic.get('Attachment', {}).get('DeviceIndex', 0))]
+        elif field == 'Tags':
+            record['Tags'] = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+        else:
+            record[field] = instance.get(field)
+    return record
+
+def iter_instances(ec2, filters=None, instance_ids=None, fields=INSTANCE_RECORD_FIELDS, page_size=None):
+    """
+        Streams every instance matching filters (server-side, e.g., instance_state_filter('running')) and/or instance_ids, one page of describe_instances at a time.
+
+        Parameters:
+            fields: projection, see INSTANCE_RECORD_FIELDS and _slim_instance_record
+            page_size: instances per describe_instances call (5-1000). Ignored with instance_ids, which AWS does not allow to be paged
+        Yields:
+            {'InstanceId': str, 'State': 'running', ...} with only the requested fields
+    """
+    kwargs = {}
+    if filters:
+        kwargs['Filters'] = filters
+    if instance_ids:
+        kwargs['InstanceIds'] = list(instance_ids)
+    elif page_size:
+        kwargs['MaxResults'] = page_size
+    for page in ec2_paginate(ec2, 'describe_instances', **kwargs):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield _slim_instance_record(instance, fields)
+
 def get_all_instances(ec2):
-    response = ec2.describe_instances()
-    # response['Reservations'][0]['Instances'][0]['InstanceId']
-    # print(pretty_json(response))
-    instance_ids = [instance['InstanceId'] for instance in extract_instance_details_from_describe_instances_response(response)]
-    return instance_ids
+    return [instance['InstanceId'] for instance in iter_instances(ec2, fields=('InstanceId',))]
 
 def get_all_running_instances(ec2):
-    response = ec2.describe_instances(
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': [
-                    'running',
-                ]
-            }
-    ])
-    # response['Reservations'][0]['Instances'][0]['InstanceId']
-    # print(pretty_json(response))
-    instance_ids = [instance['InstanceId'] for instance in extract_instance_details_from_describe_instances_response(response)]
-    return instance_ids
+    return [instance['InstanceId'] for instance in iter_instances(ec2, filters=instance_state_filter('running'), fields=('InstanceId',))]
 
 def extract_instance_details_from_describe_instances_response(response):
     """
@@ -234,50 +1308,340 @@ def extract_instance_details_from_describe_instances_response(response):
         instance_list.extend(i['Instances'])
     return instance_list
 
-def get_excluded_terminate_instances():
-    # Get excluded from termination instance list:
-    excluded_instances = []
-    with open("misc/exclude-from-termination-list.json", 'r') as j:
+_excluded_instances_cache = {} # path -> (mtime, excluded instance IDs), see get_excluded_terminate_instances
+_excluded_instances_cache_lock = threading.Lock()
+
+def get_excluded_terminate_instances(path=EXCLUDE_FROM_TERMINATION_FILE):
+    """
+        Instance IDs (values of the json file) excluded from termination. The file is only re-read when its mtime changes.
+    """
+    mtime = os.stat(path).st_mtime
+    with _excluded_instances_cache_lock:
+        cached = _excluded_instances_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+    with open(path, 'r') as j:
         cred_json = json.loads(j.read())
         # Convert to list of keys only:
         excluded_instances = list(cred_json.values())
-        # print(excluded_instances)
-    return excluded_instances
+    with _excluded_instances_cache_lock:
+        _excluded_instances_cache[path] = (mtime, excluded_instances)
+    return list(excluded_instances)
 
 def get_all_instances_init_details(ec2):
     """
         Used only for wireguard integration only for now: GET endpoint
     """
-    response = ec2.describe_instances(
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': [
-                    'running',
-                ]
-            }
-        ]
-    )
     # Get excluded from termination instance list:
     excluded_instances = get_excluded_terminate_instances()
-    # response['Reservations'][0]['Instances'][0]['InstanceId']
-    return extract_init_details_from_describe_instances_response(response, excluded_instances)
+    instances = iter_instances(ec2, filters=instance_state_filter('running'), fields=('InstanceId', 'PublicIpAddress'))
+    return extract_init_details_from_instance_records(instances, excluded_instances)
 
-def extract_init_details_from_describe_instances_response(response, excluded_instances):
+def extract_init_details_from_instance_records(instances, excluded_instances):
     instances_details = defaultdict(dict)
-    for instance in extract_instance_details_from_describe_instances_response(response):
+    for instance in instances:
         # print(instance['InstanceId'])
         if instance['InstanceId'] not in excluded_instances: # no need to include instance manager since we will not assign clients to it anyway..
             instances_details[instance['InstanceId']] = {"PublicIpAddress": instance['PublicIpAddress']}
-    # instance_ids = [instance['InstanceId'] for instance in response['Reservations'][0]['Instances']]
     return instances_details
 
+class FleetInventory:
+    """
+        In-memory view of every instance of one region (slim records, see iter_instances), so that polling endpoints do not turn into describe_instances calls.
+
+        Kept up to date two ways:
+            - incrementally, from fleet events: instances yielded by the fleet waiters are recorded as running, and terminate_instances marks its instances shutting-down
+            - by a background thread that re-lists every instance every reconcile_interval seconds, which catches what no event reports (e.g., spot interruptions)
+        An instance changed by an event while a reconcile is listing keeps its event state, since the listing may predate the event.
+
+        staleness() bounds how old the snapshot can be: seconds since the last successful reconcile started.
+        Reconciles are single-flight: a reconcile requested while another one is listing waits for that one instead of listing again.
+
+        Every update also diffs the membership (what getInitDetails serves: running, non-excluded instances and their public IPs) and logs each
+        'add', 'remove' and 'ip-change' under an increasing version, which changes() long-polls on.
+    """
+    def __init__(self, ec2, reconcile_interval=INVENTORY_RECONCILE_INTERVAL, change_log_size=INVENTORY_CHANGE_LOG_SIZE):
+        self.ec2 = ec2
+        self.reconcile_interval = reconcile_interval
+        self.instances = {} # instance ID -> slim record
+        self.event_times = {} # instance ID -> monotonic time of its last event
+        self.reconciled_at = None # monotonic start time of the last successful reconcile
+        self.reconcile_flight = None # {'done': Event, 'error': exception or None} of the reconcile in progress
+        self.members = {} # instance ID -> public IP, as of version
+        self.version = 0
+        self.stream_id = uuid.uuid4().hex # versions only mean something within one stream, i.e., one process
+        self.change_log = deque(maxlen=change_log_size)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _publish_changes(self, excluded_instances):
+        """
+            Logs the membership changes since the last call and wakes up changes() waiters. Called with the lock held.
+        """
+        members = {instance_id: instance.get('PublicIpAddress') for instance_id, instance in self.instances.items() if instance.get('State') == 'running' and instance_id not in excluded_instances}
+        changes = [('remove', instance_id, public_ip) for instance_id, public_ip in self.members.items() if instance_id not in members]
+        for instance_id, public_ip in members.items():
+            if instance_id not in self.members:
+                changes.append(('add', instance_id, public_ip))
+            elif self.members[instance_id] != public_ip:
+                changes.append(('ip-change', instance_id, public_ip))
+        now = time.time()
+        for change_type, instance_id, public_ip in changes:
+            self.version += 1
+            self.change_log.append({'Version': self.version, 'Type': change_type, 'InstanceId': instance_id, 'PublicIpAddress': public_ip, 'Time': now})
+        self.members = members
+        if changes:
+            self.changed.notify_all()
+
+    def cursor(self):
+        """
+            "<stream_id>:<version>", called with the lock held.
+        """
+        return "{}:{}".format(self.stream_id, self.version)
+
+    def parse_cursor(self, cursor):
+        """
+            Returns:
+                the version of cursor, None if cursor is None or comes from another stream (e.g., before a restart of the manager)
+            Raises:
+                ValueError if cursor is malformed
+        """
+        if cursor is None:
+            return None
+        stream_id, separator, version = cursor.rpartition(':')
+        if not separator:
+            raise ValueError("cursor must be <stream>:<version>, got " + cursor)
+        version = int(version)
+        return version if stream_id == self.stream_id else None
+
+    def changes(self, since=None, timeout=INVENTORY_LONG_POLL_TIMEOUT):
+        """
+            Long poll: waits up to timeout seconds for membership changes after cursor since.
+            Parameters:
+                since: Cursor of the last answer the caller applied (None to start from scratch)
+            Returns:
+                {'Cursor': to pass as since next time, 'Version': latest version, 'Changes': [{'Version', 'Type': 'add' | 'remove' | 'ip-change', 'InstanceId', 'PublicIpAddress', 'Time'}], 'Reset': bool, 'Members': ...}
+                When the changes after since are no longer (or were never) in the log, or since comes from another stream, Reset is True 
+                and Members holds the whole membership ({instance ID: {"PublicIpAddress": ...}}, as getInitDetails) instead
+            Raises:
+                ValueError if since is malformed
+        """
+        since = self.parse_cursor(since)
+        with self.changed:
+            if since is not None and since >= self.version:
+                self.changed.wait_for(lambda: self.version > since, timeout)
+            oldest = self.change_log[0]['Version'] if self.change_log else self.version + 1
+            if since is None or since > self.version or since + 1 < oldest:
+                return {
+                    'Cursor': self.cursor(),
+                    'Version': self.version,
+                    'Changes': [],
+                    'Reset': True,
+                    'Members': {instance_id: {"PublicIpAddress": public_ip} for instance_id, public_ip in self.members.items()},
+                }
+            return {
+                'Cursor': self.cursor(),
+                'Version': self.version,
+                'Changes': [change for change in self.change_log if change['Version'] > since],
+                'Reset': False,
+            }
+
+    def reconcile(self):
+        """
+            Replaces the snapshot with a full listing of the region's instances. If a reconcile is already in progress, waits for it (and raises its error) instead.
+        """
+        with self.lock:
+            flight = self.reconcile_flight
+            leader = flight is None
+            if leader:
+                flight = self.reconcile_flight = {'done': threading.Event(), 'error': None}
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return
+        try:
+            self._reconcile()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                self.reconcile_flight = None
+            flight['done'].set()
+
+    def _reconcile(self):
+        start_time = time.monotonic()
+        listed = {instance['InstanceId']: instance for instance in iter_instances(self.ec2)}
+        excluded_instances = set(get_excluded_terminate_instances())
+        with self.lock:
+            for instance_id, event_time in self.event_times.items():
+                if event_time >= start_time and instance_id in self.instances:
+                    listed[instance_id] = self.instances[instance_id]
+            self.event_times = {instance_id: event_time for instance_id, event_time in self.event_times.items() if event_time >= start_time}
+            self.instances = listed
+            self.reconciled_at = start_time
+            self._publish_changes(excluded_instances)
+
+    def record_instances(self, instances):
+        """
+            Upserts slim records, e.g., the running instances yielded by a fleet waiter.
+        """
+        now = time.monotonic()
+        excluded_instances = set(get_excluded_terminate_instances())
+        with self.lock:
+            for instance in instances:
+                self.instances[instance['InstanceId']] = {**self.instances.get(instance['InstanceId'], {}), **instance}
+                self.event_times[instance['InstanceId']] = now
+            self._publish_changes(excluded_instances)
+
+    def record_nic_public_ip(self, instance_id, nic_id, public_ip):
+        """
+            Records the new public IP of one NIC (e.g., after an EIP rotation). The instance's PublicIpAddress follows its primary NIC (DeviceIndex 0).
+            NICs the inventory does not know yet are left to the next reconcile.
+        """
+        now = time.monotonic()
+        excluded_instances = set(get_excluded_terminate_instances())
+        with self.lock:
+            record = self.instances.get(instance_id)
+            nics = [nic for nic in (record or {}).get('NetworkInterfaces') or [] if nic['NetworkInterfaceId'] == nic_id]
+            if not nics:
+                return
+            updated = {**record, 'NetworkInterfaces': [{**nic, 'PublicIp': public_ip} if nic['NetworkInterfaceId'] == nic_id else nic for nic in record['NetworkInterfaces']]}
+            if nics[0].get('DeviceIndex') == 0:
+                updated['PublicIpAddress'] = public_ip
+            self.instances[instance_id] = updated
+            self.event_times[instance_id] = now
+            self._publish_changes(excluded_instances)
+
+    def record_state(self, instance_ids, state):
+        now = time.monotonic()
+        excluded_instances = set(get_excluded_terminate_instances())
+        with self.lock:
+            for instance_id in instance_ids:
+                self.instances[instance_id] = {**self.instances.get(instance_id, {'InstanceId': instance_id}), 'State': state}
+                self.event_times[instance_id] = now
+            self._publish_changes(excluded_instances)
+
+    def staleness(self):
+        with self.lock:
+            return None if self.reconciled_at is None else time.monotonic() - self.reconciled_at
+
+    def snapshot(self, max_staleness=None):
+        """
+            Parameters:
+                max_staleness: in seconds, at least INVENTORY_MIN_STALENESS. A snapshot older than this is reconciled first (one describe_instances listing)
+            Returns:
+                (list of slim records, staleness in seconds)
+        """
+        if max_staleness is not None:
+            max_staleness = max(max_staleness, INVENTORY_MIN_STALENESS)
+        staleness = self.staleness()
+        if staleness is None or (max_staleness is not None and staleness > max_staleness):
+            self.reconcile()
+        with self.lock:
+            return list(self.instances.values()), time.monotonic() - self.reconciled_at
+
+    def count(self, max_staleness=None):
+        """
+            Same count as get_all_instances: every listed instance, whatever its state.
+        """
+        instances, staleness = self.snapshot(max_staleness)
+        return len(instances), staleness
+
+    def init_details(self, max_staleness=None):
+        """
+            Same as get_all_instances_init_details.
+        """
+        instances, staleness = self.snapshot(max_staleness)
+        running = [instance for instance in instances if instance.get('State') == 'running']
+        return extract_init_details_from_instance_records(running, get_excluded_terminate_instances()), staleness
+
+    def check_interruptible(self, instance_ids):
+        """
+            Returns:
+                {instance ID: reason} of the instance_ids that must not be interrupted: unknown to the inventory, not running, or excluded from termination
+        """
+        excluded_instances = set(get_excluded_terminate_instances())
+        with self.lock:
+            records = {instance_id: self.instances.get(instance_id) for instance_id in instance_ids}
+        rejected = {}
+        for instance_id, record in records.items():
+            if instance_id in excluded_instances:
+                rejected[instance_id] = "excluded from termination"
+            elif record is None:
+                rejected[instance_id] = "unknown instance"
+            elif record.get('State') != 'running':
+                rejected[instance_id] = "not running ({})".format(record.get('State'))
+        return rejected
+
+    def _reconcile_loop(self):
+        delay = self.reconcile_interval
+        while not self.stop_event.wait(delay):
+            try:
+                self.reconcile()
+                delay = self.reconcile_interval
+            except Exception as e: # keep serving the last snapshot, its staleness tells clients how old it is
+                delay = min(delay * 2, INVENTORY_RECONCILE_MAX_BACKOFF)
+                print("inventory reconcile of {} failed, retrying in {}s: {}".format(self.ec2.meta.region_name, delay, e))
+
+    def start(self):
+        """
+            Loads the first snapshot (synchronously, so that endpoints never serve an empty inventory) and starts the reconcile thread.
+        """
+        if self.thread is not None:
+            return self
+        self.reconcile()
+        self.thread = threading.Thread(target=self._reconcile_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+_inventories = {} # region -> FleetInventory
+_inventories_lock = threading.Lock()
+
+def get_fleet_inventory(ec2, reconcile_interval=INVENTORY_RECONCILE_INTERVAL):
+    """
+        Process-wide FleetInventory of ec2's region, created (not started) on first use.
+    """
+    with _inventories_lock:
+        region = ec2.meta.region_name
+        if region not in _inventories:
+            _inventories[region] = FleetInventory(ec2, reconcile_interval)
+        return _inventories[region]
+
+def _tracking_inventory(ec2):
+    """
+        FleetInventory of ec2's region if one is being kept, for fleet events to update. None otherwise.
+    """
+    with _inventories_lock:
+        return _inventories.get(ec2.meta.region_name)
+
+def record_running_instances(ec2, instances):
+    inventory = _tracking_inventory(ec2)
+    if inventory is not None:
+        inventory.record_instances(instances)
+
+def record_nic_public_ip(ec2, instance_id, nic_id, public_ip):
+    inventory = _tracking_inventory(ec2)
+    if inventory is not None:
+        inventory.record_nic_public_ip(instance_id, nic_id, public_ip)
+
+def record_terminating_instances(ec2, instance_ids):
+    inventory = _tracking_inventory(ec2)
+    if inventory is not None:
+        inventory.record_state(instance_ids, 'shutting-down')
+
 def get_specific_instances_attached_ebs(ec2, instance_id):
     """
         Get an instance's attached NIC EBS volume details. 
     """
     
-    volumes = ec2.describe_instance_attribute(InstanceId=instance_id,
+    volumes = ec2_call(ec2, 'describe_instance_attribute', InstanceId=instance_id,
         Attribute='blockDeviceMapping')
     # Get ec2 instance attached NIC IDs:
     # nics = ec2.describe_instance_attribute(InstanceId=instance_id,
@@ -285,7 +1649,7 @@ def get_specific_instances_attached_ebs(ec2, instance_id):
     return volumes 
 
 def get_specific_instances(ec2, instance_ids):
-    response = ec2.describe_instances(
+    response = ec2_call(ec2, 'describe_instances',
         InstanceIds=instance_ids
     )
     return response
@@ -295,31 +1659,22 @@ def get_specific_instances_with_fleet_id_tag(ec2, fleet_id, return_type="init-de
         tag:<key> - The key/value combination of a tag assigned to the resource. Use the tag key in the filter name and the tag value as the filter value. For example, to find all resources that have a tag with the key Owner and the value TeamA, specify tag:Owner for the filter name and TeamA for the filter value.
 
         Parameters:
-            - return_type: "raw" | "init-details"
+            - return_type: "raw" (list of slim instance records, see iter_instances) | "init-details"
     """
-    response = ec2.describe_instances(
-        Filters=[
-            {
-                'Name': 'tag:aws:ec2:fleet-id',
-                'Values': [
-                    fleet_id
-                ]
-            }
-        ]
-    )
-    with open("response.json", "w") as f:
-        print(pretty_json(response), file=f)
-    # instance_details = {}
-    # for instance in response['Reservations'][0]['Instances']:
-    #     instance_details[instance['InstanceId']] = {}
-    # instance_ids = [instance['InstanceId'] for instance in response['Reservations'][0]['Instances']]
-
+    filters = [
+        {
+            'Name': 'tag:aws:ec2:fleet-id',
+            'Values': [
+                fleet_id
+            ]
+        }
+    ]
     if return_type == "raw":
-        return extract_instance_details_from_describe_instances_response(response) # quite a complex dict, may need to prune out useless information later
+        return list(iter_instances(ec2, filters=filters))
     else: 
         excluded_instances = get_excluded_terminate_instances()
-        # response['Reservations'][0]['Instances'][0]['InstanceId']
-        return extract_init_details_from_describe_instances_response(response, excluded_instances)
+        instances = iter_instances(ec2, filters=filters, fields=('InstanceId', 'PublicIpAddress'))
+        return extract_init_details_from_instance_records(instances, excluded_instances)
 
 # def get_all_active_spot_fleet_requests(ec2):
 #     response = ec2.describe_spot_fleet_requests()
@@ -331,29 +1686,47 @@ def get_specific_instances_with_fleet_id_tag(ec2, fleet_id, return_type="init-de
 #     return active_fleet_requests
 
 def start_instances(ec2, instance_ids):
-    response = ec2.start_instances(
+    response = ec2_call(ec2, 'start_instances',
         InstanceIds=instance_ids
     )
     return response
 
 def stop_instances(ec2, instance_ids):
-    response = ec2.stop_instances(
+    response = ec2_call(ec2, 'stop_instances',
         InstanceIds=instance_ids
     )
     return response
 
 def reboot_instances(ec2, instance_ids):
-    response = ec2.reboot_instances(
+    response = ec2_call(ec2, 'reboot_instances',
         InstanceIds=instance_ids
     )
     return response
 
 def terminate_instances(ec2, instance_ids):
-    response = ec2.terminate_instances(
+    response = ec2_call(ec2, 'terminate_instances',
         InstanceIds=instance_ids
     )
+    record_terminating_instances(ec2, [instance['InstanceId'] for instance in response.get('TerminatingInstances', [])])
     return response
 
+def terminate_instances_individually(ec2, instance_ids, max_workers=16):
+    """
+        One terminate_instances call per instance, so that a bad or already gone ID does not stop the others.
+        Returns:
+            {instance ID: exception} of the calls that failed. Instances that no longer exist (InvalidInstanceID.NotFound) count as terminated
+    """
+    def terminate(instance_id):
+        try:
+            terminate_instances(ec2, [instance_id])
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidInstanceID.NotFound':
+                raise
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(instance_ids)))) as executor:
+        futures = {instance_id: executor.submit(terminate, instance_id) for instance_id in instance_ids}
+        wait(futures.values())
+    return {instance_id: future.exception() for instance_id, future in futures.items() if future.exception() is not None}
+
 def nuke_all_instances(ec2, excluded_instance_ids):
     """
         Terminates all instances, and spot requests except for the ones specified in excluded_instance_ids
@@ -385,7 +1758,7 @@ def nuke_all_instances(ec2, excluded_instance_ids):
 
 def create_fleet_archive(instance_type, region, launch_template, num):
     # feel free to delete this in the future
-    response = ec2.create_fleet(
+    response = ec2_call(ec2, 'create_fleet',
         # DryRun=True|False,
         # ClientToken='string',
         SpotOptions={
@@ -540,11 +1913,68 @@ def create_fleet_archive(instance_type, region, launch_template, num):
     )
     return response
 
-def create_fleet(ec2, instance_type, region, launch_template, num):
-    print("creating " + instance_type + " fleet with " + str(num) + " instances")
-    response = ec2.create_fleet(
+_pool_blacklist = {} # (instance_type, availability_zone) -> (expiry time, error code)
+_pool_blacklist_lock = threading.Lock()
+
+def blacklist_pool(instance_type, availability_zone, reason, ttl=POOL_BLACKLIST_TTL):
+    with _pool_blacklist_lock:
+        _pool_blacklist[(instance_type, availability_zone)] = (time.time() + ttl, reason)
+
+def blacklist_fleet_errors(errors, ttl=POOL_BLACKLIST_TTL):
+    """
+        Blacklists the pool of every capacity error (see CAPACITY_ERROR_CODES) among errors (flattened, see flatten_fleet_errors).
+        Returns:
+            the newly blacklisted pools
+    """
+    pools = []
+    for error in errors:
+        if error['ErrorCode'] in CAPACITY_ERROR_CODES and error['InstanceType'] and error['AvailabilityZone']:
+            blacklist_pool(error['InstanceType'], error['AvailabilityZone'], error['ErrorCode'], ttl)
+            pools.append((error['InstanceType'], error['AvailabilityZone']))
+    return pools
+
+def get_blacklisted_pools():
+    """
+        Returns:
+            {(instance_type, availability_zone): error code} of the pools that are still blacklisted
+    """
+    now = time.time()
+    with _pool_blacklist_lock:
+        for pool in [pool for pool, (expires_at, _) in _pool_blacklist.items() if expires_at <= now]:
+            del _pool_blacklist[pool]
+        return {pool: reason for pool, (_, reason) in _pool_blacklist.items()}
+
+def create_fleet(ec2, instance_type, region, launch_template, num, fleet_type='request', tags=None, overrides=None, allocation_strategy='lowestPrice'):
+    """
+        Parameters:
+            region: availability zone to launch in
+            fleet_type: 'request' (instances show up asynchronously, see wait_for_fleet) | 'instant' (the response lists the launched instance IDs and per-pool errors, see get_instance_ids_from_fleet_response)
+            tags: {key: value} applied to every instance at launch
+            overrides: ranked list of pools to spread one request over (see fleet_overrides), instead of the single (instance_type, region) pool. 
+                num is then counted in WeightedCapacity units (e.g., proxies), and the launch template must belong to the region of every pool
+            allocation_strategy: 'lowestPrice' | 'priceCapacityOptimized' | 'capacityOptimized' | 'capacityOptimizedPrioritized' (follows the ranking of overrides)
+    """
+    if overrides is None:
+        overrides = [
+            {
+                'InstanceType': instance_type,
+                'AvailabilityZone': region
+            }
+        ]
+        print("creating " + instance_type + " fleet with " + str(num) + " instances")
+    else:
+        print("creating fleet over {} pools with {} capacity".format(len(overrides), num))
+    kwargs = {}
+    if tags:
+        kwargs['TagSpecifications'] = [
+            {
+                'ResourceType': 'instance',
+                'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()]
+            },
+        ]
+    response = ec2_call(ec2, 'create_fleet',
         SpotOptions={
-            'AllocationStrategy': 'lowestPrice',
+            'AllocationStrategy': allocation_strategy,
         },
         LaunchTemplateConfigs=[
             {
@@ -552,12 +1982,7 @@ def create_fleet(ec2, instance_type, region, launch_template, num):
                     'LaunchTemplateId': launch_template,
                     'Version': '$Default'
                 },
-                'Overrides': [
-                    {
-                        'InstanceType': instance_type,
-                        'AvailabilityZone': region
-                    }
-                ]
+                'Overrides': overrides
             }
         ],
         TargetCapacitySpecification={
@@ -566,33 +1991,208 @@ def create_fleet(ec2, instance_type, region, launch_template, num):
             'SpotTargetCapacity': num,
             'DefaultTargetCapacityType': 'spot'
         },
-        Type='request',
-        # TagSpecifications=[
-        #     {
-        #         'Tags': [
-        #             {
-        #                 'Key': 'fleet-id',
-        #                 'Value': fleet_id_tag # this is a string
-        #             },
-        #         ]
-        #     },
-        # ],
+        Type=fleet_type,
+        **kwargs
     )
+    blacklisted = blacklist_fleet_errors(flatten_fleet_errors(response.get('Errors', []))) # instant fleets report their errors right away
+    if blacklisted:
+        print("blacklisted pools without capacity: " + str(blacklisted))
     return response
 
-def create_nics(ec2, instanceID, nic_count, az):
+def fleet_overrides(pools, weighted=True, max_pools=FLEET_MAX_OVERRIDES):
     """
-        Creates the specified number of NICs for a given instance (based on its type) and attaches the NICs to this instance. 
+        Parameters:
+            pools: ranked rows with InstanceType, AvailabilityZone and MaximumNetworkInterfaces (e.g., from query_price_index), all in one region
+            weighted: True to set WeightedCapacity to the NIC count, so that fleet capacity is counted in proxies (live IP). False counts instances
+        Returns:
+            overrides for create_fleet, and the weights ({instance_type: WeightedCapacity}) to wait for them with (see wait_for_fleet_response)
+    """
+    overrides = []
+    weights = {}
+    for priority, (_, pool) in enumerate(pools.head(max_pools).iterrows()):
+        override = {
+            'InstanceType': str(pool['InstanceType']),
+            'AvailabilityZone': str(pool['AvailabilityZone']),
+            'Priority': float(priority),
+        }
+        if weighted:
+            override['WeightedCapacity'] = float(pool['MaximumNetworkInterfaces'])
+            weights[override['InstanceType']] = int(pool['MaximumNetworkInterfaces'])
+        overrides.append(override)
+    return overrides, weights
+
+def get_instance_ids_from_fleet_response(response):
+    """
+        Returns the instance IDs launched by an instant fleet (from the response of create_fleet)
+    """
+    instance_ids = []
+    for launched in response.get('Instances', []):
+        instance_ids.extend(launched['InstanceIds'])
+    return instance_ids
 
-        NOTE: assumes the instance currently only has the default original NIC attached, i.e., only one NIC. 
+class PartialFleetFulfilment(Exception):
+    """
+        Raised by iter_fleet_instances/wait_for_fleet when a fleet stops short of its target capacity. 
+        instances holds the running instances it did get (slim records, see iter_instances), errors the fleet's launch errors (see flatten_fleet_errors).
+    """
+    def __init__(self, fleet_id, target_capacity, instances, errors, fleet_state=None, weights=None):
+        self.fleet_id = fleet_id
+        self.target_capacity = target_capacity
+        self.instances = instances
+        self.errors = errors
+        self.fleet_state = fleet_state
+        self.running_capacity = fleet_capacity(instances, weights)
+        error_codes = sorted(set(error['ErrorCode'] for error in errors))
+        super().__init__("Fleet {} only has {} of {} capacity running in {} instances (state: {}, errors: {})".format(fleet_id, self.running_capacity, target_capacity, len(instances), fleet_state, error_codes))
+
+def fleet_capacity(instances, weights=None):
+    """
+        Parameters:
+            instances: records with an InstanceType
+            weights: {instance_type: WeightedCapacity} of a weighted fleet (see fleet_overrides). None counts every instance as 1
+    """
+    if not weights:
+        return len(instances)
+    return sum(weights.get(instance['InstanceType'], 1) for instance in instances)
+
+def flatten_fleet_errors(errors):
+    """
+        Flattens the Errors of a describe_fleets (or create_fleet) response into [{'ErrorCode', 'ErrorMessage', 'InstanceType', 'AvailabilityZone'}, ...]
+    """
+    flattened = []
+    for error in errors:
+        overrides = error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+        flattened.append({
+            'ErrorCode': error.get('ErrorCode'),
+            'ErrorMessage': error.get('ErrorMessage'),
+            'InstanceType': overrides.get('InstanceType'),
+            'AvailabilityZone': overrides.get('AvailabilityZone'),
+        })
+    return flattened
+
+def _poll_running_instances(ec2, instance_ids):
+    """
+        One poll of iter_fleet_instances/iter_running_instances: yields (and records in the fleet inventory) those of instance_ids that are running. 
+        Yields nothing if some of them are not visible to describe_instances yet, which just placed instances can take a moment to be.
+    """
+    if not instance_ids:
+        return
+    try:
+        for instance in iter_instances(ec2, filters=instance_state_filter('running'), instance_ids=instance_ids):
+            record_running_instances(ec2, [instance])
+            yield instance
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'InvalidInstanceID.NotFound':
+            raise
+
+def iter_fleet_instances(ec2, fleet_id, target_capacity, fulfilment_timeout=FLEET_FULFILMENT_TIMEOUT, running_timeout=FLEET_RUNNING_TIMEOUT, weights=None):
+    """
+        Polls describe_fleet_instances/describe_fleets with backoff, and yields each instance of the fleet (slim record, see iter_instances) as soon as it is running.
+        Returns as soon as target_capacity instances are running. 
 
         Parameters:
-            nic_count: NICs to create for this instance
-        Returns: 
-            - list of nic_ids that were created and attached to this instance
+            fulfilment_timeout: in seconds. AWS has this long to place the capacity (the fleet's activity status becoming fulfilled or error ends it earlier)
+            running_timeout: in seconds, after fulfilment_timeout, for the placed instances to reach running
+            weights: {instance_type: WeightedCapacity} if target_capacity is weighted (see fleet_overrides)
+        Raises:
+            PartialFleetFulfilment if the fleet ends up short
+    """
+    start_time = time.monotonic()
+    delay = FLEET_POLL_INTERVAL
+    placed = [] # {'InstanceId', 'InstanceType'}, in placement order
+    placed_ids = set()
+    running = []
+    running_ids = set()
+    errors = []
+    fleet_state = None
+    placement_done = False
+    while True:
+        elapsed = time.monotonic() - start_time
+        if not placement_done:
+            for page in ec2_paginate(ec2, 'describe_fleet_instances', FleetId=fleet_id):
+                for active_instance in page['ActiveInstances']:
+                    if active_instance['InstanceId'] not in placed_ids:
+                        placed_ids.add(active_instance['InstanceId'])
+                        placed.append({'InstanceId': active_instance['InstanceId'], 'InstanceType': active_instance['InstanceType']})
+            fleet = ec2_call(ec2, 'describe_fleets', FleetIds=[fleet_id])['Fleets'][0]
+            errors = flatten_fleet_errors(fleet.get('Errors', []))
+            blacklist_fleet_errors(errors)
+            fleet_state = fleet['FleetState']
+            placement_done = fleet_capacity(placed, weights) >= target_capacity or fleet.get('ActivityStatus') in ('fulfilled', 'error') or fleet_state in FLEET_TERMINAL_STATES or elapsed >= fulfilment_timeout
+
+        not_running = [instance['InstanceId'] for instance in placed if instance['InstanceId'] not in running_ids]
+        for instance in _poll_running_instances(ec2, not_running):
+            running.append(instance)
+            running_ids.add(instance['InstanceId'])
+            yield instance
+        if fleet_capacity(running, weights) >= target_capacity:
+            return
+        if placement_done and (len(running) == len(placed) or elapsed >= fulfilment_timeout + running_timeout):
+            raise PartialFleetFulfilment(fleet_id, target_capacity, running, errors, fleet_state, weights)
+        sleep(delay)
+        delay = min(delay * 1.5, FLEET_POLL_MAX_INTERVAL)
+
+def iter_running_instances(ec2, instance_ids, timeout=FLEET_RUNNING_TIMEOUT):
+    """
+        Yields each of instance_ids (slim record, see iter_instances) as soon as it is running, polling with backoff for at most timeout seconds.
+    """
+    start_time = time.monotonic()
+    delay = FLEET_POLL_INTERVAL
+    not_running = dict.fromkeys(instance_ids) # ordered set
+    while not_running:
+        for instance in _poll_running_instances(ec2, list(not_running)):
+            del not_running[instance['InstanceId']]
+            yield instance
+        if not not_running or time.monotonic() - start_time >= timeout:
+            return
+        sleep(delay)
+        delay = min(delay * 1.5, FLEET_POLL_MAX_INTERVAL)
+
+def iter_instant_fleet_instances(ec2, response, target_capacity, running_timeout=FLEET_RUNNING_TIMEOUT, weights=None):
+    """
+        Same as iter_fleet_instances, for the response of an instant create_fleet: its instance IDs and errors are already known, so only the running state is polled.
+    """
+    running = []
+    for instance in iter_running_instances(ec2, get_instance_ids_from_fleet_response(response), running_timeout):
+        running.append(instance)
+        yield instance
+    if fleet_capacity(running, weights) < target_capacity:
+        raise PartialFleetFulfilment(response['FleetId'], target_capacity, running, flatten_fleet_errors(response.get('Errors', [])), 'instant', weights)
+
+def wait_for_fleet(ec2, fleet_id, target_capacity, fulfilment_timeout=FLEET_FULFILMENT_TIMEOUT, running_timeout=FLEET_RUNNING_TIMEOUT, weights=None):
+    """
+        Blocking version of iter_fleet_instances. 
+        Returns:
+            list of the running instances (slim records, see iter_instances)
+        Raises:
+            PartialFleetFulfilment if the fleet ends up short
     """
-    # Get subnet associated with this availability zone:
-    response = ec2.describe_subnets(
+    return list(iter_fleet_instances(ec2, fleet_id, target_capacity, fulfilment_timeout, running_timeout, weights))
+
+def wait_for_fleet_response(ec2, response, target_capacity, fleet_type, fulfilment_timeout=FLEET_FULFILMENT_TIMEOUT, running_timeout=FLEET_RUNNING_TIMEOUT, weights=None):
+    """
+        wait_for_fleet for the response of create_fleet, whichever its fleet_type.
+
+        Parameters:
+            fleet_type: the fleet_type create_fleet was called with. The response alone does not tell: an instant fleet that launched nothing may have no Instances, 
+                and describe_fleet_instances does not support instant fleets
+    """
+    if fleet_type == 'instant':
+        return list(iter_instant_fleet_instances(ec2, response, target_capacity, running_timeout, weights))
+    return wait_for_fleet(ec2, response['FleetId'], target_capacity, fulfilment_timeout, running_timeout, weights)
+
+_subnet_cache = {} # (region, availability zone) -> subnet ID, see get_subnet_id
+_subnet_cache_lock = threading.Lock()
+
+def get_subnet_id(ec2, az):
+    """
+        Subnet of an availability zone, looked up once per (region, zone) and cached for the lifetime of the process.
+    """
+    key = (ec2.meta.region_name, az)
+    with _subnet_cache_lock:
+        if key in _subnet_cache:
+            return _subnet_cache[key]
+    response = ec2_call(ec2, 'describe_subnets',
         Filters=[
             {
                 'Name': 'availabilityZone',
@@ -602,23 +2202,104 @@ def create_nics(ec2, instanceID, nic_count, az):
             },
         ],
     )
-    subnet_id = response['Subnets'][0]['SubnetId']
+    with _subnet_cache_lock:
+        _subnet_cache[key] = response['Subnets'][0]['SubnetId']
+        return _subnet_cache[key]
 
-    nic_ids = []
+def wait_for_nics_available(ec2, nic_ids, timeout=NIC_DETACH_TIMEOUT):
+    """
+        Polls describe_network_interfaces (through ec2_call) with backoff until every NIC of nic_ids is available, i.e., detached.
+        Returns:
+            list of the nic_ids that were still not available after timeout seconds
+    """
+    start_time = time.monotonic()
+    delay = FLEET_POLL_INTERVAL
+    pending = list(nic_ids)
+    while pending:
+        response = ec2_call(ec2, 'describe_network_interfaces', NetworkInterfaceIds=pending)
+        pending = [nic['NetworkInterfaceId'] for nic in response['NetworkInterfaces'] if nic['Status'] != 'available']
+        if not pending or time.monotonic() - start_time >= timeout:
+            return pending
+        sleep(delay)
+        delay = min(delay * 1.5, FLEET_POLL_MAX_INTERVAL)
+    return pending
+
+def delete_nics(ec2, nics, max_workers=NIC_PROVISIONING_WORKERS):
+    """
+        Best effort cleanup of NICs created by create_nics: every NIC is detached and deleted on its own, and a failure is logged without stopping the others.
 
-    for i in range(nic_count):
-        response = ec2.create_network_interface(SubnetId=subnet_id)
-        nic_ids.append(response['NetworkInterface']['NetworkInterfaceId'])
+        Parameters:
+            nics: list of (nic_id, attachment_id), attachment_id is None for NICs that were never attached
+        Returns:
+            {nic_id: exception} of the NICs that could not be detached or deleted
+    """
+    errors = {}
+    def log_failures(futures, action):
+        for nic_id, future in futures.items():
+            if future.exception() is not None:
+                print("failed to {} NIC {}: {}".format(action, nic_id, future.exception()))
+                errors[nic_id] = future.exception()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {nic_id: executor.submit(ec2_call, ec2, 'detach_network_interface', AttachmentId=attachment_id, Force=True) for nic_id, attachment_id in nics if attachment_id is not None}
+        wait(futures.values())
+    log_failures(futures, 'detach')
+    detached = [nic_id for nic_id in futures if nic_id not in errors]
+    if detached:
+        try:
+            still_attached = wait_for_nics_available(ec2, detached)
+            if still_attached:
+                print("NICs still not available after detaching, deleting anyway: " + str(still_attached))
+        except Exception as e:
+            print("failed to wait for detached NICs: {}".format(e))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {nic_id: executor.submit(ec2_call, ec2, 'delete_network_interface', NetworkInterfaceId=nic_id) for nic_id, _ in nics if nic_id not in errors}
+        wait(futures.values())
+    log_failures(futures, 'delete')
+    return errors
+
+def create_nics(ec2, instanceID, nic_count, az, max_workers=NIC_PROVISIONING_WORKERS):
+    """
+        Creates the specified number of NICs for a given instance (based on its type) and attaches the NICs to this instance. 
+        Each NIC is created and attached in its own worker with its DeviceIndex assigned up front, so the NICs are set up in parallel. 
+        If any NIC fails, the ones that succeeded are detached and deleted again before the error is raised.
+
+        NOTE: assumes the instance currently only has the default original NIC attached, i.e., only one NIC. 
 
-    device_index = 1
-    for nic_id in nic_ids:
-        response = ec2.attach_network_interface(
+        Parameters:
+            nic_count: NICs to create for this instance
+        Returns: 
+            - list of nic_ids that were created and attached to this instance, in DeviceIndex order
+    """
+    if nic_count <= 0:
+        return []
+    subnet_id = get_subnet_id(ec2, az)
+    created = [] # (nic_id, attachment_id) of every NIC that exists, for rollback
+    created_lock = threading.Lock()
+
+    def provision(device_index):
+        response = ec2_call(ec2, 'create_network_interface', SubnetId=subnet_id)
+        nic_id = response['NetworkInterface']['NetworkInterfaceId']
+        with created_lock:
+            created.append((nic_id, None))
+        response = ec2_call(ec2, 'attach_network_interface',
             NetworkInterfaceId=nic_id,
             InstanceId=instanceID,
             DeviceIndex=device_index
         )
-        device_index += 1
-    return nic_ids 
+        with created_lock:
+            created[created.index((nic_id, None))] = (nic_id, response['AttachmentId'])
+        return nic_id
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, nic_count)) as executor:
+        futures = [executor.submit(provision, device_index) for device_index in range(1, nic_count + 1)]
+        wait(futures)
+    failures = [future.exception() for future in futures if future.exception() is not None]
+    if failures:
+        print("failed to set up {} of {} NICs of {}, rolling back: {}".format(len(failures), nic_count, instanceID, failures[0]))
+        delete_nics(ec2, created, max_workers) # logs its own failures, so that the original failure is the one raised
+        raise failures[0]
+    return [future.result() for future in futures]
 
 def get_cost(ce, StartTime, EndTime):
     response = ce.get_cost_and_usage(
@@ -638,20 +2319,28 @@ def get_cost(ce, StartTime, EndTime):
     return response
 
 def get_addresses(ec2):
-    response = ec2.describe_addresses()
+    response = ec2_call(ec2, 'describe_addresses')
     return response
 
 def get_public_ip_address(ec2, eip_id):
-    response = ec2.describe_addresses(
+    response = ec2_call(ec2, 'describe_addresses',
         AllocationIds=[
             eip_id,
         ]
     )
     return response['Addresses'][0]['PublicIp']
 
-def allocate_address(ec2):
-    response = ec2.allocate_address(
-        Domain='vpc'
+def allocate_address(ec2, tags=None):
+    """
+        Parameters:
+            tags: [{'Key', 'Value'}] to tag the new EIP with, e.g., [EIP_POOL_TAG]
+    """
+    kwargs = {}
+    if tags:
+        kwargs['TagSpecifications'] = [{'ResourceType': 'elastic-ip', 'Tags': tags}]
+    response = ec2_call(ec2, 'allocate_address',
+        Domain='vpc',
+        **kwargs
     )
     return response
 
@@ -662,13 +2351,13 @@ def get_eip_id_from_allocation_response(response):
     return response['AllocationId']
 
 def release_address(ec2, allocation_id):
-    response = ec2.release_address(
+    response = ec2_call(ec2, 'release_address',
         AllocationId=allocation_id
     )
     return response
 
 def associate_address(ec2, instance_id, allocation_id, network_interface_id):
-    response = ec2.associate_address(
+    response = ec2_call(ec2, 'associate_address',
         # InstanceId=instance_id,
         AllocationId=allocation_id,
         NetworkInterfaceId=network_interface_id
@@ -679,13 +2368,311 @@ def get_association_id_from_association_response(response):
     return response['AssociationId']
 
 def disassociate_address(ec2, association_id):
-    response = ec2.disassociate_address(
+    response = ec2_call(ec2, 'disassociate_address',
         AssociationId=association_id
     )
     return response
 
+class ElasticIpPool:
+    """
+        Keeps spares EIPs allocated in ec2's region, with their public IPs already known, so that rotating an EIP is one associate_address call.
+        Every acquire triggers a background allocation to refill the spares, and released addresses are released in the background too.
+
+        Usage example:
+            pool = get_eip_pool(ec2)
+            eip, ip = pool.acquire()
+            assoc_id = get_association_id_from_association_response(associate_address(ec2, instance, eip, nic))
+            ...
+            disassociate_address(ec2, assoc_id)
+            pool.release(eip)
+    """
+    def __init__(self, ec2, spares=EIP_POOL_SPARES, workers=EIP_POOL_WORKERS):
+        self.ec2 = ec2
+        self.spares = max(1, spares)
+        self.closed = False
+        self.available = deque() # (allocation_id, public_ip) of the spares
+        self.public_ips = {} # allocation_id -> public_ip of every address of the pool, spare or in use
+        self.pending = 0 # allocations in flight
+        self.error = None # last allocation error, raised to a waiting acquire
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.refill()
+
+    def _allocate(self):
+        try:
+            response = allocate_address(self.ec2, tags=[EIP_POOL_TAG])
+        except Exception as e:
+            with self.condition:
+                self.pending -= 1
+                self.error = e
+                self.condition.notify_all()
+            return
+        with self.condition:
+            self.pending -= 1
+            self.available.append((response['AllocationId'], response['PublicIp']))
+            self.public_ips[response['AllocationId']] = response['PublicIp']
+            self.condition.notify_all()
+
+    def refill(self):
+        with self.condition: # submitting under the lock, so that close can't shut the executor down in between
+            if self.closed:
+                return
+            missing = max(0, self.spares - len(self.available) - self.pending)
+            self.pending += missing
+            for i in range(missing):
+                self.executor.submit(self._allocate)
+
+    def acquire(self):
+        """
+            Returns:
+                (allocation_id, public_ip) of a spare EIP. Only waits for an allocation when the spares ran out.
+        """
+        self.refill()
+        with self.condition:
+            while not self.available:
+                if self.closed:
+                    raise Exception("EIP pool of {} is closed".format(self.ec2.meta.region_name))
+                if self.pending == 0 and self.error is not None:
+                    error, self.error = self.error, None
+                    raise error
+                self.condition.wait()
+            allocation = self.available.popleft()
+        self.refill()
+        return allocation
+
+    def release(self, allocation_id, histogram=None):
+        """
+            Releases a disassociated EIP of the pool in the background (right away once the pool is closed).
+
+            Parameters:
+                histogram: LatencyHistogram to record the release latency (from now until released) into
+            Returns:
+                Future of the release_address call
+        """
+        submitted_at = time.monotonic()
+        def release():
+            response = release_address(self.ec2, allocation_id)
+            if histogram is not None:
+                histogram.record(time.monotonic() - submitted_at)
+            return response
+        with self.condition:
+            self.public_ips.pop(allocation_id, None)
+            if not self.closed:
+                return self.executor.submit(release)
+        future = Future()
+        try:
+            future.set_result(release())
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def give_back(self, allocation_id, public_ip):
+        """
+            Returns an acquired EIP that was never associated to the spares (released right away if the pool is closed).
+        """
+        with self.condition:
+            if not self.closed:
+                self.available.appendleft((allocation_id, public_ip))
+                self.public_ips[allocation_id] = public_ip
+                self.condition.notify_all()
+                return
+            self.public_ips.pop(allocation_id, None)
+        release_address(self.ec2, allocation_id)
+
+    def public_ip(self, allocation_id):
+        with self.condition:
+            return self.public_ips.get(allocation_id)
+
+    def close(self):
+        """
+            Releases the spares (once the allocations in flight are done). Addresses still in use are left to their users.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all() # so that a waiting acquire raises instead of hanging
+        self.executor.shutdown(wait=True)
+        with self.condition:
+            spares, self.available = list(self.available), deque()
+            for allocation_id, public_ip in spares:
+                self.public_ips.pop(allocation_id, None)
+        for allocation_id, public_ip in spares:
+            release_address(self.ec2, allocation_id)
+
+_eip_pools = {} # region -> ElasticIpPool
+_eip_pools_lock = threading.Lock()
+
+def get_eip_pool(ec2, spares=EIP_POOL_SPARES):
+    """
+        Process-wide ElasticIpPool of ec2's region, created on first use.
+    """
+    with _eip_pools_lock:
+        region = ec2.meta.region_name
+        if region not in _eip_pools:
+            _eip_pools[region] = ElasticIpPool(ec2, spares)
+        return _eip_pools[region]
+
+def close_eip_pools():
+    with _eip_pools_lock:
+        pools = list(_eip_pools.values())
+        _eip_pools.clear()
+    for pool in pools:
+        pool.close()
+
+class LatencyHistogram:
+    """
+        Thread safe latency recorder: log-spaced bucket counts (in seconds) plus the raw samples for exact percentiles.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def summary(self):
+        """
+            Returns:
+                {'count', 'p50', 'p95', 'p99', 'max', 'buckets': {"<=upper bound": count}}, latencies in seconds (None without samples)
+        """
+        with self.lock:
+            samples = np.array(self.samples, dtype=float)
+        if len(samples) == 0:
+            return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None, 'buckets': {}}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        counts = np.bincount(np.searchsorted(self.BUCKETS, samples, side='left'), minlength=len(self.BUCKETS))
+        return {
+            'count': int(len(samples)),
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'max': float(samples.max()),
+            'buckets': {"<=" + str(bound): int(count) for bound, count in zip(self.BUCKETS, counts) if count},
+        }
+
+class RotationError(Exception):
+    """
+        Raised by rotate_nic_ip when a swap fails. nic_details is the (NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP) the NIC is left with: 
+        its old EIP, re-associated (ASSOCIATION ID is None if that failed too, i.e., the NIC has no public IP and the old EIP is still allocated).
+    """
+    def __init__(self, nic_details, cause):
+        self.nic_details = nic_details
+        self.cause = cause
+        super().__init__("Failed to rotate the EIP of {}: {!r}".format(nic_details[0], cause))
+
+def rotate_nic_ip(ec2, nic_details, histograms, release_futures):
+    """
+        Swaps the EIP of one NIC for a spare of the region's ElasticIpPool, recording each phase into histograms ({phase: LatencyHistogram}).
+        On failure the spare goes back to the pool, and the old EIP is re-associated if it was already disassociated.
+
+        Parameters:
+            nic_details: (NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP)
+            release_futures: list the (Future, EIP ID) of the (background) release of the old EIP is appended to
+        Returns:
+            the new (NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP)
+        Raises:
+            RotationError
+    """
+    pool = get_eip_pool(ec2)
+    swap_start = time.monotonic()
+    eip, public_ip = pool.acquire()
+    histograms['allocate'].record(time.monotonic() - swap_start)
+
+    phase_start = time.monotonic()
+    try:
+        disassociate_address(ec2, nic_details[2])
+    except Exception as e:
+        pool.give_back(eip, public_ip)
+        raise RotationError(nic_details, e)
+    histograms['disassociate'].record(time.monotonic() - phase_start)
+
+    phase_start = time.monotonic()
+    try:
+        assoc_id = get_association_id_from_association_response(associate_address(ec2, None, eip, nic_details[0]))
+    except Exception as e:
+        pool.give_back(eip, public_ip)
+        try:
+            old_assoc_id = get_association_id_from_association_response(associate_address(ec2, None, nic_details[1], nic_details[0]))
+        except Exception as restore_error:
+            print("failed to re-associate {} to {}: {!r}".format(nic_details[1], nic_details[0], restore_error))
+            old_assoc_id = None
+        raise RotationError((nic_details[0], nic_details[1], old_assoc_id, nic_details[3]), e)
+    histograms['associate'].record(time.monotonic() - phase_start)
+    histograms['swap'].record(time.monotonic() - swap_start)
+
+    release_futures.append((pool.release(nic_details[1], histograms['release']), nic_details[1]))
+    return (nic_details[0], eip, assoc_id, public_ip)
+
+def rotate_fleet_ips(clients, instance_list, max_workers=ROTATION_MAX_WORKERS, max_workers_per_region=ROTATION_MAX_WORKERS_PER_REGION):
+    """
+        Rotates the EIP of every NIC of the fleet concurrently: one worker pool per region (max_workers_per_region swaps each), and at most max_workers swaps overall.
+        The NICs of each instance in instance_list are replaced in place by the ones that were rotated (a NIC that failed gets the tuple of RotationError.nic_details).
+
+        Parameters:
+            clients: {region: ec2 client}
+            instance_list: [{'InstanceID', 'ec2_session_region', 'NICs': [(NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP), ...]}, ...]
+        Returns:
+            {
+                'makespan': seconds from the first swap starting to the last one finishing (background releases excluded),
+                'nics': NICs rotated,
+                'failures': [{'InstanceID', 'NIC', 'error'}, ...],
+                'release_failures': [{'EIP', 'error'}, ...], old EIPs whose background release failed (still allocated)
+                'phases': {phase: LatencyHistogram.summary()}, see ROTATION_PHASES
+                'regions': {region: {'nics', 'makespan'}}
+            }
+    """
+    histograms = {phase: LatencyHistogram() for phase in ROTATION_PHASES}
+    release_futures = []
+    slots = threading.BoundedSemaphore(max_workers)
+    region_finish = defaultdict(float)
+    region_finish_lock = threading.Lock()
+
+    def swap(region, instance_id, nic_details):
+        with slots:
+            try:
+                new_nic_details = rotate_nic_ip(clients[region], nic_details, histograms, release_futures)
+                record_nic_public_ip(clients[region], instance_id, new_nic_details[0], new_nic_details[3]) # ip-change on the changes stream right away
+                return new_nic_details
+            finally:
+                with region_finish_lock:
+                    region_finish[region] = max(region_finish[region], time.monotonic())
+
+    executors = {region: ThreadPoolExecutor(max_workers=max_workers_per_region) for region in set(instance_details['ec2_session_region'] for instance_details in instance_list)}
+    start_time = time.monotonic()
+    futures = [[executors[instance_details['ec2_session_region']].submit(swap, instance_details['ec2_session_region'], instance_details['InstanceID'], nic_details) for nic_details in instance_details['NICs']] for instance_details in instance_list]
+    wait([future for instance_futures in futures for future in instance_futures])
+    makespan = time.monotonic() - start_time
+    for executor in executors.values():
+        executor.shutdown(wait=False)
+
+    failures = []
+    region_nics = defaultdict(int)
+    for instance_details, instance_futures in zip(instance_list, futures):
+        new_nics = []
+        for nic_details, future in zip(instance_details['NICs'], instance_futures):
+            if future.exception() is not None:
+                failures.append({'InstanceID': instance_details['InstanceID'], 'NIC': nic_details[0], 'error': repr(future.exception())})
+                new_nics.append(getattr(future.exception(), 'nic_details', nic_details))
+            else:
+                new_nics.append(future.result())
+                region_nics[instance_details['ec2_session_region']] += 1
+        instance_details['NICs'] = new_nics
+    wait([future for future, _ in release_futures]) # so that the release histogram is complete
+    release_failures = [{'EIP': allocation_id, 'error': repr(future.exception())} for future, allocation_id in release_futures if future.exception() is not None]
+
+    return {
+        'makespan': makespan,
+        'nics': sum(region_nics.values()),
+        'failures': failures,
+        'release_failures': release_failures,
+        'phases': {phase: histogram.summary() for phase, histogram in histograms.items()},
+        'regions': {region: {'nics': region_nics[region], 'makespan': region_finish[region] - start_time if region in region_finish else None} for region in executors},
+    }
+
 def assign_name_tags(ec2, resource_id, name):
-    response = ec2.create_tags(
+    response = ec2_call(ec2, 'create_tags',
         Resources=[
             resource_id # resource could be an instance, network interface, eip, etc.
         ],
@@ -699,8 +2686,7 @@ def assign_name_tags(ec2, resource_id, name):
     return response
  
 def use_jinyu_launch_templates(ec2, instance_type):
-    instance_info = get_instance_type(ec2, [instance_type])
-    arch = instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures'][0]
+    arch = get_instance_type_info(ec2, instance_type)['ProcessorInfo']['SupportedArchitectures'][0]
     #x86: lt-04d9c8ac5d00a2078
     #arm: lt-0abc44b6c12879596
     if arch == 'arm64':
@@ -735,93 +2721,488 @@ def use_UM_launch_templates(ec2, region, proxy_impl, type="main"):
         launch_template = 'NOT-SUPPORTED-YET'
     return launch_template
 
-def replace_instance_loop(ec2, type):
-    cheapest_type = type
+ACTION_KEEP, ACTION_TOP_UP, ACTION_REPLACE = 0, 1, 2
+REPLACE_INTERVAL = 5*60 # in seconds, how often replace_instance_loop re-evaluates the fleet
+
+def replacement_action(cheapest_type, current_type, running_count, capacity):
+    """
+        Decision step of replace_instance_loop: 
+            - ACTION_REPLACE: the cheapest type changed, terminate everything and recreate capacity instances of the cheapest type
+            - ACTION_TOP_UP: create capacity - running_count instances of the cheapest type
+            - ACTION_KEEP: nothing to do
+        Works element-wise on numpy arrays too, which is how misc/replay_eval/replay-simulator.py evaluates many policies at once.
+    """
+    return np.where(cheapest_type != current_type, ACTION_REPLACE, np.where(running_count < capacity, ACTION_TOP_UP, ACTION_KEEP))
+
+class ManagerState:
+    """
+        What the HTTP handlers and replace_instance_loop share: the ec2 client, and the pool (region, zone, current_type) and capacity the fleet is kept at.
+        Fields are read through snapshot() so that a handler never sees a half-applied update (e.g., the new type with the old zone).
+    """
+    FIELDS = ('region', 'zone', 'current_type', 'capacity')
+
+    def __init__(self, ec2, region, zone, current_type, capacity):
+        self.ec2 = ec2
+        self.region = region
+        self.zone = zone
+        self.current_type = current_type
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """
+            Returns:
+                {'region', 'zone', 'current_type', 'capacity'}, consistent with each other
+        """
+        with self.lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+    def update(self, **fields):
+        with self.lock:
+            for field, value in fields.items():
+                if field not in self.FIELDS:
+                    raise Exception("Unknown manager state field: " + field)
+                setattr(self, field, value)
+
+def wait_for_replacement_fleet(ec2, response, target_capacity):
+    """
+        Waits for a fleet of replace_instance_loop, so that its instances reach the FleetInventory (and the changes stream) as soon as they run, rather than at the next reconcile.
+    """
+    try:
+        wait_for_fleet_response(ec2, response, target_capacity, 'request')
+    except PartialFleetFulfilment as e: # the next iteration tops up
+        print(e)
+
+def replace_instance_loop(state):
+    ec2 = state.ec2
     while True:
-        sleep(5*60)
+        sleep(REPLACE_INTERVAL)
         print("updating spot prices")
+        current = state.snapshot()
+        cheapest_type = current['current_type']
+        capacity = current['capacity']
         instances = get_all_instances(ec2)
         prices = update_spot_prices(ec2)
         prices = prices.sort_values(by=['SpotPrice'], ascending=True)
-        new_instance_type = prices.iloc[0]['InstanceType']
+        _, cheapest_instance = select_cheapest_instance_row(prices, keep_order=True, exclude_pools=get_blacklisted_pools())
+        new_instance_type = cheapest_instance['InstanceType']
         print("new instance type: " + new_instance_type)
-        zone = prices.iloc[0]['AvailabilityZone']
-        if new_instance_type != cheapest_type:
+        zone = cheapest_instance['AvailabilityZone']
+        action = replacement_action(new_instance_type, cheapest_type, len(instances), capacity)
+        if action == ACTION_REPLACE:
             print("terminating instances")
             response = terminate_instances(ec2, instances)
             print(response)
             launch_template = use_jinyu_launch_templates(ec2, new_instance_type)
             print("creating new instances")
-            create_fleet(ec2, new_instance_type, zone, launch_template, capacity)
-            cheapest_type = new_instance_type
-        elif len(instances) < capacity:
+            response = create_fleet(ec2, new_instance_type, zone, launch_template, capacity)
+            state.update(current_type=new_instance_type, zone=zone)
+            wait_for_replacement_fleet(ec2, response, capacity)
+        elif action == ACTION_TOP_UP:
             print("creating new instances")
             launch_template = use_jinyu_launch_templates(ec2, new_instance_type)
-            create_fleet(ec2, new_instance_type, zone, launch_template, capacity - len(instances))
+            response = create_fleet(ec2, new_instance_type, zone, launch_template, capacity - len(instances))
+            wait_for_replacement_fleet(ec2, response, capacity - len(instances))
             #send update to controller
         
 
+def is_reachable(ip, timeout=INTERRUPT_REACHABLE_TIMEOUT, backoff_time=2):
+    """
+        Pings ip (one echo request at a time) until it answers or timeout seconds have passed.
+    """
+    start_time = time.monotonic()
+    while True:
+        if os.system("ping -c 1 -W 1 " + ip + " > /dev/null 2>&1") == 0:
+            return True
+        if time.monotonic() - start_time >= timeout:
+            return False
+        sleep(backoff_time)
+
+class InterruptJob:
+    """
+        One interrupt of instance_ids: launch their replacements, and terminate each of them once its replacement is running, registered and reachable (make-before-break).
+        status: 'queued' | 'running' | 'done' | 'failed'. phases: {phase: seconds} of each finished phase of INTERRUPT_JOB_PHASES
+    """
+    def __init__(self, instance_ids):
+        self.id = uuid.uuid4().hex
+        self.instance_ids = list(instance_ids)
+        self.status = 'queued'
+        self.phase = 'queued'
+        self.phases = {}
+        self.replacements = {} # interrupted instance ID -> slim record of its replacement, see iter_instances
+        self.errors = {} # instance ID -> why it was not replaced, or not terminated
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.phase_started_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def start_phase(self, phase):
+        """
+            Ends the current phase (recording its duration) and starts the next one.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.phases[self.phase] = now - self.phase_started_at
+            self.phase = phase
+            self.phase_started_at = now
+            self.status = 'running'
+
+    def finish(self, error=None):
+        with self.lock:
+            self.phases[self.phase] = time.monotonic() - self.phase_started_at
+            self.phase = None
+            self.status = 'failed' if error is not None else 'done'
+            self.error = None if error is None else str(error)
+            self.finished_at = time.time()
+
+    def is_finished(self):
+        with self.lock:
+            return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'JobId': self.id,
+                'InstanceIds': list(self.instance_ids),
+                'Status': self.status,
+                'Phase': self.phase,
+                'Phases': dict(self.phases),
+                'Replacements': dict(self.replacements),
+                'Errors': dict(self.errors),
+                'Error': self.error,
+                'SubmittedAt': self.submitted_at,
+                'FinishedAt': self.finished_at,
+            }
+
+class InterruptQueue:
+    """
+        Bounded queue of InterruptJobs, processed by a fixed set of worker threads, so that the interrupt endpoints return a job ID right away.
+        Instances that already have an unfinished job are coalesced into it instead of being queued again.
+        The replacements of a job are launched by one instant fleet, spread over the cheapest pools of the manager's region (see replacement_overrides).
+    """
+    def __init__(self, state, inventory, workers=INTERRUPT_WORKERS, max_size=INTERRUPT_QUEUE_SIZE, job_ttl=INTERRUPT_JOB_TTL, reachable_timeout=INTERRUPT_REACHABLE_TIMEOUT):
+        self.state = state
+        self.inventory = inventory
+        self.job_ttl = job_ttl
+        self.reachable_timeout = reachable_timeout
+        self.pending = queue.Queue(maxsize=max_size)
+        self.jobs = {} # job ID -> InterruptJob
+        self.active = {} # instance ID -> unfinished InterruptJob
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, instance_ids):
+        """
+            Returns:
+                (job, coalesced): job of the instance_ids without an unfinished job (None if there are none), 
+                and coalesced: {instance ID: its unfinished InterruptJob} for the others
+            Raises:
+                queue.Full if max_size jobs are already pending
+        """
+        with self.lock:
+            self._expire_jobs()
+            coalesced = {}
+            new_ids = []
+            for instance_id in dict.fromkeys(instance_ids): # drops duplicates, keeps the order
+                if instance_id in self.active and not self.active[instance_id].is_finished():
+                    coalesced[instance_id] = self.active[instance_id]
+                else:
+                    new_ids.append(instance_id)
+            if not new_ids:
+                return None, coalesced
+            job = InterruptJob(new_ids)
+            self.pending.put_nowait(job)
+            self.jobs[job.id] = job
+            for instance_id in new_ids:
+                self.active[instance_id] = job
+            return job, coalesced
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def _expire_jobs(self):
+        expired_before = time.time() - self.job_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.is_finished() and job.finished_at < expired_before:
+                del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self.pending.get()
+            try:
+                self.process(job)
+                job.finish()
+            except Exception as e:
+                print("interrupt of {} failed: {}".format(job.instance_ids, e))
+                job.finish(e)
+            finally:
+                with self.lock:
+                    for instance_id in job.instance_ids:
+                        if self.active.get(instance_id) is job:
+                            del self.active[instance_id]
+
+    def process(self, job):
+        ec2 = self.state.ec2
+        rejected = self.inventory.check_interruptible(job.instance_ids) # instances can go away while the job is queued
+        if rejected:
+            with job.lock:
+                job.errors.update(rejected)
+        instance_ids = [instance_id for instance_id in job.instance_ids if instance_id not in rejected]
+        count = len(instance_ids)
+        if count == 0:
+            raise Exception("None of the instances can be interrupted: " + str(rejected))
+        job.start_phase('launch')
+        response = launch_replacements(ec2, self.state.snapshot(), count)
+        job.start_phase('running')
+        try:
+            launched = wait_for_fleet_response(ec2, response, count, 'instant')
+        except PartialFleetFulfilment as e: # replace what we can, the rest keeps running
+            launched = e.instances
+        job.start_phase('registered')
+        self.inventory.record_instances(launched)
+        job.start_phase('reachable')
+        with ThreadPoolExecutor(max_workers=max(1, len(launched))) as executor:
+            reachable = list(executor.map(lambda instance: bool(instance.get('PublicIpAddress')) and is_reachable(instance['PublicIpAddress'], self.reachable_timeout), launched))
+        replacements = [instance for instance, ok in zip(launched, reachable) if ok]
+        unreachable = [instance['InstanceId'] for instance, ok in zip(launched, reachable) if not ok]
+        with job.lock:
+            job.replacements = dict(zip(instance_ids, replacements))
+        job.start_phase('terminate')
+        replaced = list(job.replacements)
+        failed = terminate_instances_individually(ec2, replaced + unreachable)
+        if failed:
+            with job.lock:
+                job.errors.update({instance_id: "terminate failed: {!r}".format(e) for instance_id, e in failed.items()})
+        if len(replaced) < len(job.instance_ids) or failed:
+            raise Exception("Replaced {} of {} instances ({} launched, {} unreachable, {} failed to terminate)".format(len(replaced), len(job.instance_ids), len(launched), len(unreachable), len(failed)))
+
+def replacement_overrides(ec2, current, max_pools=FLEET_MAX_OVERRIDES):
+    """
+        Ranked overrides (see fleet_overrides) over the cheapest non-blacklisted pools of current['region'] that share current_type's architecture (so that one launch template fits all of them).
+        Falls back to the current pool alone when no prices are stored for the region.
+    """
+    index = get_latest_price_index('AWS', regions=[current['region']])
+    if index is not None:
+        architecture = get_instance_type_info(ec2, current['current_type'])['ProcessorInfo']['SupportedArchitectures'][:1]
+        pools = query_price_index(index, regions=[current['region']], supported_architecture=architecture, k=max_pools, exclude_pools=get_blacklisted_pools())
+        if len(pools.index) > 0:
+            overrides, _ = fleet_overrides(pools, weighted=False, max_pools=max_pools)
+            return overrides
+    return [{'InstanceType': current['current_type'], 'AvailabilityZone': current['zone']}]
+
+def launch_replacements(ec2, current, count):
+    """
+        Launches count replacement instances as one instant fleet over replacement_overrides.
+        Parameters:
+            current: ManagerState.snapshot()
+    """
+    launch_template = use_jinyu_launch_templates(ec2, current['current_type'])
+    return create_fleet(ec2, current['current_type'], current['zone'], launch_template, count, fleet_type='instant', overrides=replacement_overrides(ec2, current), allocation_strategy='capacityOptimizedPrioritized')
+
+def parse_query_param(query, name, parse=str, default=None):
+    """
+        Parameters:
+            query: parsed query string (see urllib.parse.parse_qs)
+            parse: e.g., float, int
+        Returns:
+            parse of the first value of name, default if name is not in query
+        Raises:
+            ValueError if the value does not parse
+    """
+    if name not in query or not query[name][0]:
+        return default
+    return parse(query[name][0])
+
 class RequestHandler(BaseHTTPRequestHandler):
-    def __init__(self, ec2, *args, **kwargs):
-        self.ec2 = ec2
+    """
+        Served by a ThreadingHTTPServer: one thread per request, so anything shared goes through state (ManagerState) or inventory (FleetInventory), both locked.
+    """
+    def __init__(self, state, inventory, interrupts, *args, **kwargs):
+        self.state = state
+        self.ec2 = state.ec2
+        self.inventory = inventory
+        self.interrupts = interrupts
         super().__init__(*args, **kwargs)
 
-    def _set_response(self):
-        self.send_response(200)
+    def _set_response(self, staleness=None, code=200):
+        self.send_response(code)
         self.send_header('Content-type', 'text/html')
+        if staleness is not None: # served from the FleetInventory: upper bound, in seconds, on how old the answer is
+            self.send_header('X-Inventory-Staleness', '{:.3f}'.format(staleness))
         self.end_headers()
 
+    def _submit_interrupts(self, instance_ids):
+        """
+            Validates instance_ids against the inventory (400 if any is unknown, not running or excluded from termination, before anything is launched) and queues one job for them.
+            Returns:
+                (job, coalesced) as InterruptQueue.submit, None if an error was sent
+        """
+        instance_ids = [instance_id for instance_id in instance_ids if instance_id]
+        if not instance_ids:
+            self.send_error(400, "No instance IDs")
+            return None
+        rejected = self.inventory.check_interruptible(instance_ids)
+        if rejected:
+            self.send_error(400, "Cannot interrupt: " + json.dumps(rejected))
+            return None
+        try:
+            return self.interrupts.submit(instance_ids)
+        except queue.Full:
+            self.send_error(503, "Too many pending interrupts")
+            return None
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.split('/')[1:]
+        match path[0]:
+            case 'interrupt':
+                # POST interrupt/<id>: queues the replacement and returns at once, poll jobs/<JobId> to follow it
+                #notices controller to interrupt instance, WIREGUARD ONLY
+                id = path[1] if len(path) > 1 else ''
+                submitted = self._submit_interrupts([id])
+                if submitted is None:
+                    return
+                job, coalesced = submitted
+                self._set_response(code=202)
+                self.wfile.write(pretty_json({**(job or coalesced[id]).to_dict(), 'Coalesced': job is None}).encode('utf-8'))
+            case 'interruptBatch':
+                # POST {"InstanceIds": [...]}: one job replacing all of them (make-before-break, see InterruptQueue). Its Replacements map each interrupted instance to its replacement once done
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    instance_ids = [str(instance_id) for instance_id in body.get('InstanceIds', [])]
+                except (ValueError, AttributeError):
+                    self.send_error(400, "Expected {\"InstanceIds\": [...]}")
+                    return
+                submitted = self._submit_interrupts(instance_ids)
+                if submitted is None:
+                    return
+                job, coalesced = submitted
+                self._set_response(code=202)
+                self.wfile.write(pretty_json({
+                    'Job': job.to_dict() if job is not None else None,
+                    'Coalesced': {instance_id: coalesced_job.id for instance_id, coalesced_job in coalesced.items()}, # instance ID -> JobId of the unfinished job already replacing it
+                }).encode('utf-8'))
+            case _:
+                self.send_error(404)
+
     def do_GET(self):
-        path = self.path.split('/')[1:]
-        print(path)
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.split('/')[1:]
+        query = urllib.parse.parse_qs(url.query)
         match path[0]:
             case 'getNum':
-                instances = get_all_instances(self.ec2)
-                num = len(instances)
-                self._set_response()
+                # e.g., getNum?max_staleness=5 to force a fresher snapshot (same for getInitDetails)
+                try:
+                    max_staleness = parse_query_param(query, 'max_staleness', float)
+                except ValueError:
+                    self.send_error(400, "Invalid max_staleness")
+                    return
+                num, staleness = self.inventory.count(max_staleness)
+                self._set_response(staleness)
                 self.wfile.write(str(num).encode('utf-8'))
-            case 'interrupt':
-                id = path[1]
-                response = terminate_instances(self.ec2, [id])
-                launch_template = use_jinyu_launch_templates(self.ec2, current_type)
-                create_fleet(self.ec2, current_type, region, launch_template, 1)
+            case 'interrupt' | 'interruptBatch':
+                # they launch paid capacity, so only POST (crawlers and retries replay GETs)
+                self.send_response(405)
+                self.send_header('Allow', 'POST')
+                self.end_headers()
+            case 'jobs':
+                # jobs: every job kept (see INTERRUPT_JOB_TTL), jobs/<JobId>: one job with its phase timings
+                if len(path) > 1 and path[1]:
+                    job = self.interrupts.get(path[1])
+                    if job is None:
+                        self.send_error(404, "Unknown job")
+                        return
+                    body = job.to_dict()
+                else:
+                    body = [job.to_dict() for job in self.interrupts.list()]
                 self._set_response()
-                self.wfile.write(response.encode('utf-8'))
-                #notices controller to interrupt instance, WIREGUARD ONLY
+                self.wfile.write(pretty_json(body).encode('utf-8'))
+            case "changes":
+                # long poll, e.g., changes?since=<Cursor>&timeout=30. Start without since (or on Reset) from the full membership, then pass back the Cursor of each answer
+                try:
+                    since = parse_query_param(query, 'since')
+                    timeout = min(max(0.0, parse_query_param(query, 'timeout', float, default=INVENTORY_LONG_POLL_TIMEOUT)), INVENTORY_LONG_POLL_TIMEOUT)
+                    changes = self.inventory.changes(since, timeout)
+                except ValueError as e:
+                    self.send_error(400, "Invalid parameter: " + str(e))
+                    return
+                self._set_response(self.inventory.staleness())
+                self.wfile.write(pretty_json(changes).encode('utf-8'))
             case "getInitDetails":
                 # print("Enter getInitDetails")
-                instances_details = get_all_instances_init_details(self.ec2)
-                self._set_response()
+                try:
+                    max_staleness = parse_query_param(query, 'max_staleness', float)
+                except ValueError:
+                    self.send_error(400, "Invalid max_staleness")
+                    return
+                instances_details, staleness = self.inventory.init_details(max_staleness)
+                self._set_response(staleness)
                 self.wfile.write(pretty_json(instances_details).encode('utf-8'))
+            case "getCheapest":
+                # e.g., getCheapest?sort_by=PricePerInterface&max_cost=0.1&regions=us-east-1,us-east-2&arch=x86_64&min_nics=2&k=5
+                try:
+                    filters = dict(
+                        sort_by=parse_query_param(query, 'sort_by', default='SpotPrice'),
+                        min_cost=parse_query_param(query, 'min_cost', float),
+                        max_cost=parse_query_param(query, 'max_cost', float),
+                        regions=parse_query_param(query, 'regions', lambda value: value.split(',')),
+                        supported_architecture=parse_query_param(query, 'arch', lambda value: value.split(',')),
+                        min_nics=parse_query_param(query, 'min_nics', int),
+                        k=parse_query_param(query, 'k', int, default=10),
+                    )
+                except ValueError as e:
+                    self.send_error(400, "Invalid parameter: " + str(e))
+                    return
+                if filters['sort_by'] not in PRICE_INDEX_KEYS:
+                    self.send_error(400, "sort_by must be one of " + ", ".join(PRICE_INDEX_KEYS))
+                    return
+                index = get_latest_price_index('AWS')
+                if index is None:
+                    self.send_error(503, "No spot prices stored yet")
+                    return
+                candidates = query_price_index(index, exclude_pools=get_blacklisted_pools(), **filters)
+                self._set_response()
+                self.wfile.write(pretty_json(candidates.to_dict(orient='records')).encode('utf-8'))
 
-def run(ec2):
+def run(ec2, state=None):
+    """
+        Parameters:
+            state: ManagerState to serve. Defaults to one built from the module's region, zone, current_type and capacity
+    """
+    if state is None:
+        state = ManagerState(ec2, region, zone, current_type, capacity)
     server_address = ('', 8000)
     # https://stackoverflow.com/questions/21631799/how-can-i-pass-parameters-to-a-requesthandler
-    handler = partial(RequestHandler, ec2)
-    httpd = HTTPServer(server_address, handler)
+    inventory = get_fleet_inventory(ec2).start()
+    interrupts = InterruptQueue(state, inventory)
+    handler = partial(RequestHandler, state, inventory, interrupts)
+    httpd = ThreadingHTTPServer(server_address, handler) # a slow interrupt no longer holds up every other request
+    httpd.daemon_threads = True
     print('Starting server...')
-    x = threading.Thread(target=replace_instance_loop, daemon=True, args=(ec2, current_type,))
+    x = threading.Thread(target=replace_instance_loop, daemon=True, args=(state,))
     x.start()
     httpd.serve_forever()
 
-def get_instance_row_with_supported_architecture(ec2, prices, supported_architecture=['x86_64']):
+def get_instance_row_with_supported_architecture(ec2, prices, supported_architecture=['x86_64'], exclude_pools=None):
     """
         Copied from rejuvenation-eval-script.py
         Parameters:
             supported_architecture: list of architectures to support. Default is x86_64 (i.e., Intel/AMD)
             prices: df of prices (from get_cheapest_instance_types_df)
         Returns:
-            row of the cheapest instance type that supports the architecture
-    """
-    for index, row in prices.iterrows():
-        instance_type = row['InstanceType']
-        instance_info = get_instance_type(ec2, [instance_type])
-        for arch in instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures']:
-            if arch in supported_architecture:
-                return index, row
-        # if instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures'][0] in supported_architecture:
-        #     return index, row
-    raise Exception("No instance type supports the architecture: " + str(supported_architecture))
+            row of the cheapest instance type that supports the architecture (first match in the order of prices)
+    """
+    if 'SupportedArchitectures' not in prices.columns: # e.g., a table loaded from a legacy csv
+        prices = attach_instance_type_metadata(ec2, prices)
+    return select_cheapest_instance_row(prices, supported_architecture=supported_architecture, keep_order=True, exclude_pools=exclude_pools)
 
 # example usage of creating 2 instances in us-east-1 with UM account: python3 api.py UM us-east-1 2 main
 # explanation of above example: this creates 2 instances in the us-east-1a az, in the UM AWS account
@@ -838,7 +3219,7 @@ if __name__ == '__main__':
     prices = update_spot_prices(ec2)
     prices = prices.sort_values(by=['SpotPrice'], ascending=True)
     print(prices.iloc[0])
-    index, cheapest_instance = get_instance_row_with_supported_architecture(ec2, prices)
+    index, cheapest_instance = get_instance_row_with_supported_architecture(ec2, prices, exclude_pools=get_blacklisted_pools())
     instance_type = cheapest_instance['InstanceType']
     zone = cheapest_instance['AvailabilityZone']
     current_type = instance_type
@@ -859,11 +3240,15 @@ if __name__ == '__main__':
     response = create_fleet(ec2, instance_type, zone, launch_template, capacity)
     print(response)
     # make sure that the required instances have been acquired: 
-    time.sleep(15) # wait awhile for fleet to be created
     print(response['FleetId'])
-    all_instance_details = get_specific_instances_with_fleet_id_tag(ec2, response['FleetId']) 
+    try:
+        instances = wait_for_fleet(ec2, response['FleetId'], capacity)
+    except PartialFleetFulfilment as e:
+        print(e)
+        instances = e.instances
+    all_instance_details = extract_init_details_from_instance_records(instances, get_excluded_terminate_instances())
     print(all_instance_details)
-    run(ec2)
+    run(ec2, ManagerState(ec2, region, zone, instance_type, capacity))
 
     # Some example usage from Patrick:
     """
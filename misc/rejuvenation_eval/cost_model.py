@@ -0,0 +1,119 @@
+"""
+    Cost engine shared by rejuvenation-eval-script.py and misc/calculate-cost.py.
+
+    Instance lists are loaded into arrays once, and the live IP, instance and optimal cost formulas are evaluated over whole grids of
+    (rejuvenation period, experiment duration, fleet size, EIP price) at once. See calculate_cost in rejuvenation-eval-script.py for
+    the reasoning behind the cost model itself.
+"""
+
+import numpy as np
+import pandas as pd
+
+EIP_HOURLY_PRICE = 0.005 # per EIP (and, with ephemeral_charge, per ephemeral IP) per hour
+REMAP_PRICE = 0.1 # per remap, AWS only. Deallocate and allocate are both counted as remaps
+
+def load_instance_arrays(instance_list):
+    """
+        Parameters:
+            - instance_list: same format as calculate_cost's instance_list
+        Returns:
+            {
+                'instance_cost': hourly cost of each instance,
+                'num_eips': number of NICs (i.e., EIPs) of each instance,
+                'optimal_instance_cost': hourly cost of the optimal instance recorded with each instance,
+                'optimal': the 'optimal_cheapest_instance' dict of the first instance
+            }
+    """
+    return {
+        'instance_cost': np.array([float(instance_details['InstanceCost']) for instance_details in instance_list]),
+        'num_eips': np.array([len(instance_details['NICs']) for instance_details in instance_list]),
+        'optimal_instance_cost': np.array([float(instance_details['optimal_cheapest_instance']['OptimalInstanceCost']) for instance_details in instance_list]),
+        'optimal': instance_list[0]['optimal_cheapest_instance'],
+    }
+
+def cost_grid(instance_list, rej_periods, exp_durations, multi_NIC=True, rej_count=None, fleet_sizes=None, eip_prices=(EIP_HOURLY_PRICE,), eip_billing="hourly", remap_price=REMAP_PRICE, ephemeral_charge=False):
+    """
+        Evaluates the cost model over the cartesian product of rej_periods x exp_durations x fleet_sizes x eip_prices.
+
+        Parameters:
+            - instance_list: same format as calculate_cost's instance_list
+            - rej_periods: list of rejuvenation periods, in seconds
+            - exp_durations: list of experiment durations, in minutes
+            - multi_NIC: True for live IP rejuvenation (and its multi-NIC optimal), False for instance rejuvenation (and its single-NIC optimal)
+            - rej_count: number of rejuvenation events that occurred in the run that produced instance_list.
+                - live IP: used for every grid point if given, otherwise derived per grid point as ceil(exp_duration * 60 / rej_period)
+                - instance: instance_list holds every instance of every rejuvenation event, rej_count tells how many events that was (defaults to 1)
+            - fleet_sizes: list of proxy counts. None keeps the fleet of instance_list, otherwise instance_list is scaled to each fleet size
+            - eip_prices: list of hourly EIP prices
+            - eip_billing: "hourly" (every rejuvenation is charged whole EIP hours) | "prorated" (EIPs charged per minute for the whole experiment)
+            - remap_price: per remap (live IP only). 0 to ignore remap charges
+            - ephemeral_charge: True to also charge the ephemeral IP of each instance (instance rejuvenation only)
+        Returns:
+            df with one row per grid point: rej_period, exp_duration, fleet_size, eip_price, total_cost, optimal_cost, total_monthly_cost, optimal_monthly_cost
+    """
+    arrays = load_instance_arrays(instance_list)
+    instance_count = len(arrays['instance_cost'])
+    observed_rounds = 1 if multi_NIC or rej_count is None else rej_count
+    observed_fleet = arrays['num_eips'].sum() if multi_NIC else instance_count / observed_rounds
+
+    rej_period, exp_duration, fleet_size, eip_price = [axis.ravel() for axis in np.meshgrid(
+        np.asarray(rej_periods, dtype=float),
+        np.asarray(exp_durations, dtype=float),
+        np.asarray(fleet_sizes if fleet_sizes is not None else [observed_fleet], dtype=float),
+        np.asarray(eip_prices, dtype=float),
+        indexing='ij')]
+    scale = fleet_size / observed_fleet # 1 when the fleet of instance_list is kept
+
+    if multi_NIC: # i.e., live ip rejuvenations
+        num_rejuvenations = np.full_like(rej_period, rej_count) if rej_count is not None else np.ceil(exp_duration * 60 / rej_period)
+        per_rej_hours = np.ceil(rej_period / 3600) # number of hours elapsed per rejuvenation
+        total_eips = arrays['num_eips'].sum() * scale
+
+        instance_cost = arrays['instance_cost'].sum() * scale / 60 * exp_duration
+        if eip_billing == "hourly":
+            nic_cost = eip_price * total_eips * num_rejuvenations * per_rej_hours # hour level granularity charge for allocated IP addresses
+        else:
+            nic_cost = eip_price * total_eips / 60 * exp_duration
+        remapping_cost = total_eips * num_rejuvenations * remap_price * 2
+        total_cost = instance_cost + nic_cost + remapping_cost
+
+        optimal = arrays['optimal']
+        optimal_nics = int(optimal['OptimalInstanceMaxNICs'])
+        if fleet_sizes is None:
+            optimal_count = np.full_like(fleet_size, optimal['OptimalInstanceCount'])
+        else:
+            optimal_count = np.ceil(fleet_size / optimal_nics)
+        if eip_billing == "hourly":
+            optimal_nic_cost = eip_price * optimal_nics * np.ceil(exp_duration / 60) * optimal_count # just the cost of the EIPs attached to it (statically) throughout the entire experiment
+        else:
+            optimal_nic_cost = eip_price * optimal_nics / 60 * exp_duration * optimal_count
+        optimal_cost = float(optimal['OptimalInstanceCost']) / 60 * exp_duration * optimal_count + optimal_nic_cost
+    else:
+        # assume that each instance across all rejuvenation events has been running for an equal amount of time:
+        total_cost = arrays['instance_cost'].sum() * scale / 60 * exp_duration / observed_rounds
+        optimal_cost = arrays['optimal_instance_cost'].sum() * scale / 60 * exp_duration / observed_rounds
+        if ephemeral_charge:
+            eip_cost = eip_price * instance_count * scale / 60 * exp_duration / observed_rounds
+            total_cost = total_cost + eip_cost
+            optimal_cost = optimal_cost + eip_cost
+
+    return pd.DataFrame({
+        'rej_period': rej_period,
+        'exp_duration': exp_duration,
+        'fleet_size': fleet_size,
+        'eip_price': eip_price,
+        'total_cost': total_cost,
+        'optimal_cost': optimal_cost,
+        'total_monthly_cost': total_cost / exp_duration * 60 * 24 * 30,
+        'optimal_monthly_cost': optimal_cost / exp_duration * 60 * 24 * 30,
+    })
+
+def cost_point(instance_list, rej_period, exp_duration, **kwargs):
+    """
+        Single grid point of cost_grid.
+
+        Returns:
+            total_cost, optimal_cost, total_monthly_cost, optimal_monthly_cost
+    """
+    row = cost_grid(instance_list, [rej_period], [exp_duration], **kwargs).iloc[0]
+    return row['total_cost'], row['optimal_cost'], row['total_monthly_cost'], row['optimal_monthly_cost']
@@ -1,4 +1,6 @@
-import math
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cost_model
 
 def calculate_cost(instance_list, rej_period, exp_duration, multi_NIC=True, rej_count=None, ephemeral_charge=False):
     """
@@ -35,53 +37,8 @@ def calculate_cost(instance_list, rej_period, exp_duration, multi_NIC=True, rej_
             - Why am I going through this trouble? Because even after 24 hours, the cost explorer did not populate the instance costs for instances that were only run for a few mins... but it did for the instance that ran for ~1 hours (with tag "test-delete-cost-explorer-show-up") in the same period.. Verified this using tags.. 
                 - Also there are inconsistencies in AWS cost explorer output: when not applying the tag "test-delete-cost-explorer-show-up" the cost was $0.05 (for the m7a.medium instance only), but when applying the tag it was $0.06.....
     """
-    total_cost = 0
-    optimal_cost = 0 
-    total_monthly_cost = 0
-    optimal_monthly_cost = 0
-    if multi_NIC: # i.e., if live ip rejuvenations
-        # assert rej_count is not None, "rej_count must be provided for live ip rejuvenations"
-
-        # Get optimal instance details: 
-        optimal_instance_cost = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceCost']
-        optimal_instance_count = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceCount']
-        optimal_instance_nics = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceMaxNICs']
-        # Calculate optimal cost:
-        optimal_nic_cost = 0.005 * int(optimal_instance_nics) / 60 * exp_duration * optimal_instance_count  # just the cost of the EIPs attached to it (statically) throughout the entire experiment
-        optimal_instance_cost = float(optimal_instance_cost) / 60 * exp_duration * optimal_instance_count 
-        optimal_cost = optimal_instance_cost + optimal_nic_cost
-
-        # Iterate through each instance within instance_list: 
-        for instance_details in instance_list:
-            instance_cost = float(instance_details['InstanceCost']) / 60 * exp_duration # we assume that live IP is able to acquire the cheapest instance (this is reasonable since our exp will terminate if it weren't able to acquire the cheapest instance at initialization).
-            # + float(instance_details['InstanceCost']) / 60 # instance charge is per-second granularity, but the first minute is also charged by default. 
-            # Get the number of NICs of this instance_type:
-            num_eips = len(instance_details['NICs'])
-            # Calculate the cost of elastic IPs attached to this instance (assuming prior to Feb 1, where the ephemeral one is free..):
-            # num_rejuvenations = math.ceil(exp_duration * 60 / rej_period)
-            # num_rejuvenations = rej_count
-            # per_rej_hours = math.ceil(rej_period/3600) # number of hours elapsed per rejuvenation
-            nic_cost = 0.005 * num_eips / 60 * exp_duration # hour level granularity charge for allocated IP addresses
-            # remapping_cost = num_eips * num_rejuvenations * 0.1 * 2 # only for AWS for now. Deallocate and allocate are both distinct operations that are remappings. 
-            
-            # Calculate total cost of NICs (skipping since additional ENIs are free..) + elastic IPs + instance_type + remapping cost:
-            total_cost += instance_cost + nic_cost # + remapping_cost
-    else:
-        for instance_details in instance_list:
-            instance_cost = float(instance_details['InstanceCost']) / 60 * exp_duration / rej_count # assume that each instance across all rejuvenation events has been running for an equal amount of time. 
-
-            optimal_instance_cost = float(instance_details['optimal_cheapest_instance']['OptimalInstanceCost']) / 60 * exp_duration / rej_count # assume that each instance across all rejuvenation events has been running for an equal amount of time.
-
-            eip_cost = 0.005 / 60 * exp_duration / rej_count
-
-            # Calculate total cost of NICs (skipping since additional ENIs are free..) + elastic IPs + instance_type + remapping cost:
-            total_cost += instance_cost + eip_cost
-            optimal_cost += optimal_instance_cost + eip_cost
-
-    total_monthly_cost = total_cost / exp_duration * 60 * 24 * 30
-    optimal_monthly_cost = optimal_cost / exp_duration * 60 * 24 * 30
-
-    return total_cost, optimal_cost, total_monthly_cost, optimal_monthly_cost
+    # EIPs are charged per minute and remaps are free here, and the ephemeral IP of instance rejuvenation is always charged (see cost_model.cost_grid for the formulas):
+    return cost_model.cost_point(instance_list, rej_period, exp_duration, multi_NIC=multi_NIC, rej_count=rej_count, eip_billing="prorated", remap_price=0, ephemeral_charge=True)
 
 instance_list = [
     {
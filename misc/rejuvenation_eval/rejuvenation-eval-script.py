@@ -36,6 +36,7 @@ import warnings
 from collections import defaultdict
 sys.path.append("../../")
 import api
+import cost_model
 
 def pretty_json(obj):
     return json.dumps(obj, sort_keys=True, indent=4, default=str)
@@ -65,6 +66,8 @@ def refresh_credentials():
             f.write("aws_access_key_id = " + cred_json['Credentials']['AccessKeyId'] + "\n")
             f.write("aws_secret_access_key = " + cred_json['Credentials']['SecretAccessKey'] + "\n")
             f.write("aws_session_token = " + cred_json['Credentials']['SessionToken'] + "\n")
+            f.truncate()
+    api.refresh_client_credentials() # cached clients pick up the new role credentials in place
 
     # proc = subprocess.run(
     #     'aws ec2 describe-instances --region us-east-1 --profile spotproxy-pat-umich-role',
@@ -124,7 +127,7 @@ def ping_instances(ec2, nic_list, multi_NIC=True, not_fixed=True):
     if not_fixed: # only ping the original NIC
         nic_details = nic_list[-1] # this is the position of the original_nic, since we append it last..
         if multi_NIC:
-            ip = api.get_public_ip_address(ec2, nic_details[1])
+            ip = nic_details[3] # known since the EIP came from the EIP pool
         else:
             ip = nic_details[1]
         response = ping(ip, backoff_time, trials)
@@ -137,7 +140,7 @@ def ping_instances(ec2, nic_list, multi_NIC=True, not_fixed=True):
     else: # ping all NICs
         for nic_details in nic_list:
             if multi_NIC:
-                ip = api.get_public_ip_address(ec2, nic_details[1])
+                ip = nic_details[3]
             else:
                 ip = nic_details[1]
             response = ping(ip, backoff_time, trials)
@@ -149,10 +152,11 @@ def ping_instances(ec2, nic_list, multi_NIC=True, not_fixed=True):
                 failed_ips.append(ip)
     return failed_ips
 
-def get_cheapest_instance_types_df(ec2, filter=None, multi_NIC=False):
+def get_cheapest_instance_types_df(ec2, filter=None, multi_NIC=False, is_UM=None, print_filename="data/output-general.txt"):
     """
         Parameters:
             multi_NIC == True, used for liveIP and optimal 
+            is_UM: if given, the prices of every region in filter["regions"] are refreshed concurrently (each with its own client). Otherwise, only ec2's region is refreshed.
             filter: price filter and region filter for now
                 Format: {
                     "min_cost": float,
@@ -174,38 +178,33 @@ def get_cheapest_instance_types_df(ec2, filter=None, multi_NIC=False):
     """
 
     # Look into cost catalogue and sort based on multi_NIC or not:
-    prices = api.update_spot_prices(ec2) # AWS prices
-    
-    # Get sorted prices:
-    if multi_NIC:
-        prices = prices.sort_values(by=['PricePerInterface'], ascending=True)
+    if is_UM is not None and isinstance(filter, dict) and filter['regions']:
+        prices, stats = api.update_spot_prices_all_regions(is_UM, filter['regions'])
+        print_stdout_and_filename("Spot price refresh per region: " + pretty_json(stats), print_filename)
+        if prices is None:
+            raise Exception("Failed to refresh spot prices in every region: " + str(filter['regions']))
     else:
-        prices = prices.sort_values(by=['SpotPrice'], ascending=True)
-
-    # Filter based on min_cost and max_cost, if filter exists:
+        prices = api.update_spot_prices(ec2) # AWS prices
+    
+    # Filter based on min_cost, max_cost and regions, if filter exists, and sort based on multi_NIC or not:
+    min_cost, max_cost, regions = None, None, None
     if isinstance(filter, dict):
-        min_cost = filter['min_cost']
-        max_cost = filter['max_cost']
+        min_cost = _scalar_cost(filter['min_cost'])
+        max_cost = _scalar_cost(filter['max_cost'])
         regions = filter['regions']
-        if regions:
-            # Only keep rows where AvailabilityZone contains one of the values in the regions list:
-            prices = prices[prices['AvailabilityZone'].str.startswith(tuple(regions))] # https://stackoverflow.com/a/20461857/13336187
-        if min_cost:
-            if multi_NIC:
-                prices = prices[prices['PricePerInterface'] >= min_cost]
-            else:
-                # print(prices.dtypes)
-                # print(isinstance(prices['PricePerInterface'], float))
-                # print(isinstance(min_cost, float))
-                prices = prices[prices['SpotPrice'] >= min_cost]
-        if max_cost:
-            if multi_NIC:
-                prices = prices[prices['PricePerInterface'] <= max_cost]
-            else:
-                prices = prices[prices['SpotPrice'] <= max_cost]
+    index = api.build_price_index(prices)
+    prices = api.query_price_index(index, sort_by='PricePerInterface' if multi_NIC else 'SpotPrice', min_cost=min_cost, max_cost=max_cost, regions=regions)
 
     return prices
 
+def _scalar_cost(cost):
+    """
+        MIN_COST/MAX_COST are parsed into 1-tuples by start_rej_threads (and the tuple ends up in our log file names), so unwrap them here.
+    """
+    if isinstance(cost, (tuple, list)):
+        return cost[0]
+    return cost
+
 def get_instance_row_with_supported_architecture(ec2, prices, supported_architecture=['x86_64'], print_filename="data/output-general.txt"):
     """
         Parameters:
@@ -214,18 +213,11 @@ def get_instance_row_with_supported_architecture(ec2, prices, supported_architec
         Returns:
             row of the cheapest instance type that supports the architecture
     """
-    for index, row in prices.iterrows():
-        instance_type = row['InstanceType']
-        instance_info = api.get_instance_type(ec2, [instance_type])
-        # print_stdout_and_filename("Instance type: " + str(instance_type) + " supports architecture: " + str(instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures']), print_filename)
-        for arch in instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures']:
-            if arch in supported_architecture:
-                return index, row
-        # if instance_info['InstanceTypes'][0]['ProcessorInfo']['SupportedArchitectures'][0] in supported_architecture:
-        #     return index, row
-    raise Exception("No instance type supports the architecture: " + str(supported_architecture))
+    if 'SupportedArchitectures' not in prices.columns:
+        prices = api.attach_instance_type_metadata(ec2, prices)
+    return api.select_cheapest_instance_row(prices, supported_architecture=supported_architecture, keep_order=True, exclude_pools=api.get_blacklisted_pools())
 
-def create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt"):
+def create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt", fleet_type="instant"):
     """
         Creates fleet combinations. 
 
@@ -233,7 +225,8 @@ def create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count, proxy
             - cheapest_instance: row of the cheapest instance type (from get_cheapest_instance_types_df)
             - proxy_impl: "snowflake" | "wireguard" | "baseline"
             - tag_prefix: "liveip-expX" 
-            - wait_time_after_create: in seconds
+            - wait_time_after_create: in seconds, upper bound on how long AWS gets to place the fleet (see api.iter_fleet_instances). We move on as soon as every instance is running
+            - fleet_type: "instant" (instance IDs come back with the create_fleet response, instances are tagged with tag_prefix at launch) | "request"
     """
     proxy_count_remaining = proxy_count
 
@@ -252,15 +245,17 @@ def create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count, proxy
     launch_template = api.use_UM_launch_templates(ec2, region, proxy_impl, "main")
 
     # Create the initial fleet with multiple NICs (with tag values as indicated above)
-    response = api.create_fleet(ec2, instance_type, zone, launch_template, instances_to_create)
-    time.sleep(wait_time_after_create) # wait awhile for fleet to be created
+    response = api.create_fleet(ec2, instance_type, zone, launch_template, instances_to_create, fleet_type=fleet_type, tags={'Name': tag_prefix})
     # make sure that the required instances have been acquired: 
     print(response['FleetId'])
     print(pretty_json(response))
-    all_instance_details = api.get_specific_instances_with_fleet_id_tag(ec2, response['FleetId'], "raw") 
-    if len(all_instance_details) != instances_to_create:
-        warnings.warn("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required.")
-        print_stdout_and_filename("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required.", print_filename)
+    try:
+        all_instance_details = api.wait_for_fleet_response(ec2, response, instances_to_create, fleet_type, fulfilment_timeout=wait_time_after_create)
+    except api.PartialFleetFulfilment as e:
+        all_instance_details = e.instances
+        warnings.warn("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required. " + str(e))
+        print_stdout_and_filename("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required. " + str(e), print_filename)
+    api.record_pool_fulfilment(instance_type, zone, instances_to_create, len(all_instance_details))
 
     if proxy_count % max_nics: # i.e., where there is a remainder:
         proxy_count_remaining = proxy_count % max_nics + (instances_to_create - len(all_instance_details) - 1) * max_nics
@@ -273,40 +268,11 @@ def create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count, proxy
     instance_list = []
 
     for index, original_instance_details in enumerate(all_instance_details):
-        instance = original_instance_details['InstanceId']
-        # Tag created instance:
-        instance_tag = tag_prefix + "-instance{}".format(str(index))
-        # api.assign_name_tags(ec2, instance, instance_tag) # TODO: bypass Request limit exceeded for now
-        
-        instance_details = {'InstanceID': instance, 'InstanceCost': instance_type_cost, 'InstanceType': instance_type, 'NICs': []}
-        # Get original NIC attached to the instance:
-        original_nic = original_instance_details['NetworkInterfaces'][0]['NetworkInterfaceId']
-        assert len(original_instance_details['NetworkInterfaces']) == 1, "Expected only 1 NIC, but got " + str(len(original_instance_details['NetworkInterfaces']))
-        # _ , original_nic = api.get_specific_instances_attached_components(ec2, instance)
-
-        # Create the NICs and associate them with the instances:
-        nics = api.create_nics(ec2, instance, max_nics-1, zone)
-
-        nics.append(original_nic)
-        # Create the elastic IPs and associate them with the NICs:
-        for index2, nic in enumerate(nics):
-            # eip = api.create_eip(ec2, nic, tag)
-            eip = api.get_eip_id_from_allocation_response(api.allocate_address(ec2))
-            # print(api.associate_address(ec2, instance, eip, nic))
-            assoc_id = api.get_association_id_from_association_response(api.associate_address(ec2, instance, eip, nic))
-            instance_details['NICs'].append((nic, eip, assoc_id))
-
-            # Tag NICs and EIPs:
-            nic_tag = instance_tag + "-nic{}".format(str(index2))
-            eip_tag = nic_tag + "-eip{}".format(str(index2))
-            # api.assign_name_tags(ec2, nic, nic_tag) # TODO: bypass Request limit exceeded for now
-            # api.assign_name_tags(ec2, eip, eip_tag) # TODO: bypass Request limit exceeded for now
-
-        instance_list.append(instance_details) 
+        instance_list.append(setup_live_ip_instance(ec2, original_instance_details, instance_type_cost, max_nics, tag_prefix + "-instance{}".format(str(index))))
 
     return instance_list, proxy_count_remaining
 
-def create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt"):
+def create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt", fleet_type="instant"):
     """
         Creates fleet combinations. 
 
@@ -314,7 +280,8 @@ def create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count, prox
             - cheapest_instance: row of the cheapest instance type (from get_cheapest_instance_types_df)
             - proxy_impl: "snowflake" | "wireguard" | "baseline"
             - tag_prefix: "instance-expX" 
-            - wait_time_after_create: in seconds
+            - wait_time_after_create: in seconds, upper bound on how long AWS gets to place the fleet (see api.iter_fleet_instances). We move on as soon as every instance is running
+            - fleet_type: "instant" (instance IDs come back with the create_fleet response, instances are tagged with tag_prefix at launch) | "request"
     """
     proxy_count_remaining = proxy_count
 
@@ -328,14 +295,16 @@ def create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count, prox
     launch_template = api.use_UM_launch_templates(ec2, region, proxy_impl, "main")
 
     # Create the initial fleet with multiple NICs (with tag values as indicated above)
-    response = api.create_fleet(ec2, instance_type, zone, launch_template, proxy_count)
-    time.sleep(wait_time_after_create) # wait awhile for fleet to be created
+    response = api.create_fleet(ec2, instance_type, zone, launch_template, proxy_count, fleet_type=fleet_type, tags={'Name': tag_prefix})
     # make sure that the required instances have been acquired: 
     print(response['FleetId'])
-    all_instance_details = api.get_specific_instances_with_fleet_id_tag(ec2, response['FleetId'], "raw") 
-    if len(all_instance_details) != proxy_count:
-        warnings.warn("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(proxy_count) + " were required.")
-        print_stdout_and_filename("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(proxy_count) + " were required.", print_filename)
+    try:
+        all_instance_details = api.wait_for_fleet_response(ec2, response, proxy_count, fleet_type, fulfilment_timeout=wait_time_after_create)
+    except api.PartialFleetFulfilment as e:
+        all_instance_details = e.instances
+        warnings.warn("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(proxy_count) + " were required. " + str(e))
+        print_stdout_and_filename("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(proxy_count) + " were required. " + str(e), print_filename)
+    api.record_pool_fulfilment(instance_type, zone, proxy_count, len(all_instance_details))
     proxy_count_remaining = proxy_count - len(all_instance_details)
 
     # print("Created {} instances of type {}, and hourly cost {}. Remaining instances to create: {}".format(len(all_instance_details), instance_type, instance_type_cost, proxy_count_remaining))
@@ -344,27 +313,117 @@ def create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count, prox
     instance_list = []
 
     for index, original_instance_details in enumerate(all_instance_details):
-        instance = original_instance_details['InstanceId']
-        # Tag created instance:
-        instance_tag = tag_prefix + "-instance{}".format(str(index))
-        # api.assign_name_tags(ec2, instance, instance_tag) # TODO: removed for now pending increase limit..
+        instance_list.append(setup_instance_rejuvenation_instance(original_instance_details, instance_type_cost, tag_prefix + "-instance{}".format(str(index))))
+
+    return instance_list, proxy_count_remaining
         
-        instance_details = {'InstanceID': instance, 'InstanceCost': instance_type_cost, 'InstanceType': instance_type, 'NICs': []}
-        # Get original NIC attached to the instance:
-        original_nic = original_instance_details['NetworkInterfaces'][0]['NetworkInterfaceId']
-        original_pub_ip = original_instance_details['PublicIpAddress']
-        assert len(original_instance_details['NetworkInterfaces']) == 1, "Expected only 1 NIC, but got " + str(len(original_instance_details['NetworkInterfaces']))
-        # _ , original_nic = api.get_specific_instances_attached_components(ec2, instance)
+def setup_live_ip_instance(ec2, original_instance_details, instance_type_cost, max_nics, instance_tag):
+    """
+        Gives a just created live IP instance its max_nics NICs, each with its own EIP (from the region's api.ElasticIpPool).
 
-        # Tag the original NIC:
-        instance_details['NICs'] = [(original_nic, original_pub_ip)]
-        nic_tag = instance_tag + "-nic{}".format(str(1))
-        # api.assign_name_tags(ec2, original_nic, nic_tag) # TODO: removed for now pending increase limit..
+        Parameters:
+            - original_instance_details: running instance record (see api.iter_instances)
+        Returns:
+            {'InstanceID', 'InstanceCost', 'InstanceType', 'NICs': [(NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP), ...]}
+    """
+    instance = original_instance_details['InstanceId']
+    zone = original_instance_details['AvailabilityZone']
+    # Tag created instance:
+    # api.assign_name_tags(ec2, instance, instance_tag) # TODO: bypass Request limit exceeded for now
+    
+    instance_details = {'InstanceID': instance, 'InstanceCost': instance_type_cost, 'InstanceType': original_instance_details['InstanceType'], 'NICs': []}
+    # Get original NIC attached to the instance:
+    original_nic = original_instance_details['NetworkInterfaces'][0]['NetworkInterfaceId']
+    assert len(original_instance_details['NetworkInterfaces']) == 1, "Expected only 1 NIC, but got " + str(len(original_instance_details['NetworkInterfaces']))
+    # _ , original_nic = api.get_specific_instances_attached_components(ec2, instance)
+
+    # Create the NICs and associate them with the instances:
+    nics = api.create_nics(ec2, instance, max_nics-1, zone)
+
+    nics.append(original_nic)
+    # Create the elastic IPs and associate them with the NICs:
+    for index2, nic in enumerate(nics):
+        # eip = api.create_eip(ec2, nic, tag)
+        eip, public_ip = api.get_eip_pool(ec2).acquire()
+        # print(api.associate_address(ec2, instance, eip, nic))
+        assoc_id = api.get_association_id_from_association_response(api.associate_address(ec2, instance, eip, nic))
+        instance_details['NICs'].append((nic, eip, assoc_id, public_ip))
+
+        # Tag NICs and EIPs:
+        nic_tag = instance_tag + "-nic{}".format(str(index2))
+        eip_tag = nic_tag + "-eip{}".format(str(index2))
+        # api.assign_name_tags(ec2, nic, nic_tag) # TODO: bypass Request limit exceeded for now
+        # api.assign_name_tags(ec2, eip, eip_tag) # TODO: bypass Request limit exceeded for now
+
+    return instance_details
+
+def setup_instance_rejuvenation_instance(original_instance_details, instance_type_cost, instance_tag):
+    """
+        Parameters:
+            - original_instance_details: running instance record (see api.iter_instances)
+        Returns:
+            {'InstanceID', 'InstanceCost', 'InstanceType', 'NICs': [(NIC ID, public IP)]}
+    """
+    instance = original_instance_details['InstanceId']
+    # Tag created instance:
+    # api.assign_name_tags(ec2, instance, instance_tag) # TODO: removed for now pending increase limit..
+    
+    instance_details = {'InstanceID': instance, 'InstanceCost': instance_type_cost, 'InstanceType': original_instance_details['InstanceType'], 'NICs': []}
+    # Get original NIC attached to the instance:
+    original_nic = original_instance_details['NetworkInterfaces'][0]['NetworkInterfaceId']
+    original_pub_ip = original_instance_details['PublicIpAddress']
+    assert len(original_instance_details['NetworkInterfaces']) == 1, "Expected only 1 NIC, but got " + str(len(original_instance_details['NetworkInterfaces']))
+    # _ , original_nic = api.get_specific_instances_attached_components(ec2, instance)
 
-        instance_list.append(instance_details) 
+    # Tag the original NIC:
+    instance_details['NICs'] = [(original_nic, original_pub_ip)]
+    nic_tag = instance_tag + "-nic{}".format(str(1))
+    # api.assign_name_tags(ec2, original_nic, nic_tag) # TODO: removed for now pending increase limit..
 
+    return instance_details
+
+def create_fleet_diversified_rejuvenation(ec2, pools, proxy_count, proxy_impl, tag_prefix, mode="liveip", planned_counts=None, wait_time_after_create=15, print_filename="data/output-general.txt", fleet_type="instant", allocation_strategy="lowestPrice"):
+    """
+        Same as create_fleet_live_ip_rejuvenation/create_fleet_instance_rejuvenation, but with one create_fleet request spread over several pools (see api.fleet_overrides).
+        For live IP, each pool is weighted by its NIC count, so the fleet's capacity is counted in proxies.
+
+        Parameters:
+            - pools: ranked rows of pools, all in the same region (e.g., from api.query_price_index)
+            - mode: "liveip" | "instance"
+            - planned_counts: {(instance_type, zone): instances planned} (from api.plan_fleet). Pools that report launch errors are recorded as short of that count (see api.record_pool_fulfilment)
+            - allocation_strategy: "lowestPrice" | "priceCapacityOptimized" | ... (see api.create_fleet)
+    """
+    region = pools.iloc[0]['AvailabilityZone'][:-1] # e.g., us-east-1a -> us-east-1
+    launch_template = api.use_UM_launch_templates(ec2, region, proxy_impl, "main")
+    overrides, weights = api.fleet_overrides(pools, weighted=(mode == "liveip"))
+    pool_costs = {(str(pool['InstanceType']), str(pool['AvailabilityZone'])): pool['SpotPrice'] for _, pool in pools.iterrows()}
+
+    response = api.create_fleet(ec2, None, None, launch_template, proxy_count, fleet_type=fleet_type, tags={'Name': tag_prefix}, overrides=overrides, allocation_strategy=allocation_strategy)
+    print(response['FleetId'])
+    errors = []
+    try:
+        all_instance_details = api.wait_for_fleet_response(ec2, response, proxy_count, fleet_type, fulfilment_timeout=wait_time_after_create, weights=weights)
+    except api.PartialFleetFulfilment as e:
+        all_instance_details = e.instances
+        errors = e.errors
+        warnings.warn("Not enough instances were created: " + str(e))
+        print_stdout_and_filename("Not enough instances were created: " + str(e), print_filename)
+    for pool in set((error['InstanceType'], error['AvailabilityZone']) for error in errors):
+        if planned_counts and pool in planned_counts:
+            api.record_pool_fulfilment(pool[0], pool[1], planned_counts[pool], len([instance for instance in all_instance_details if (instance['InstanceType'], instance['AvailabilityZone']) == pool]))
+    proxy_count_remaining = max(0, proxy_count - api.fleet_capacity(all_instance_details, weights))
+    print_stdout_and_filename("Created {} instances over {} pools in {}. Remaining proxies to create: {}".format(len(all_instance_details), len(overrides), region, proxy_count_remaining), print_filename)
+
+    instance_list = []
+    for index, original_instance_details in enumerate(all_instance_details):
+        instance_type_cost = pool_costs[(original_instance_details['InstanceType'], original_instance_details['AvailabilityZone'])]
+        instance_tag = tag_prefix + "-instance{}".format(str(index))
+        if mode == "liveip":
+            instance_list.append(setup_live_ip_instance(ec2, original_instance_details, instance_type_cost, weights[original_instance_details['InstanceType']], instance_tag))
+        else:
+            instance_list.append(setup_instance_rejuvenation_instance(original_instance_details, instance_type_cost, instance_tag))
     return instance_list, proxy_count_remaining
-        
+
 def create_fleet(initial_ec2, is_UM, proxy_count, proxy_impl, tag_prefix, filter=None, multi_NIC=False, wait_time_after_create=15, print_filename="data/output-general.txt"):
     """
         Creates the required fleet: 
@@ -381,7 +440,7 @@ def create_fleet(initial_ec2, is_UM, proxy_count, proxy_impl, tag_prefix, filter
                         'InstanceID': instance_id,
                         'InstanceType': instance_type,
                         'InstanceCost': float,
-                        'NICs': [(NIC ID, EIP ID, ASSOCIATION ID), ...]
+                        'NICs': [(NIC ID, EIP ID, ASSOCIATION ID, PUBLIC IP), ...]
                     },
                     ...
                 ]
@@ -401,14 +460,14 @@ def create_fleet(initial_ec2, is_UM, proxy_count, proxy_impl, tag_prefix, filter
     """
     start_time = time.time()
     if multi_NIC:
-        prices = get_cheapest_instance_types_df(initial_ec2, filter, multi_NIC=True)
+        prices = get_cheapest_instance_types_df(initial_ec2, filter, multi_NIC=True, is_UM=is_UM, print_filename=print_filename)
         instance_list = loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename, mode="liveip")
         print_stdout_and_filename("Create fleet success with details: " + pretty_json(instance_list), print_filename)
         end_time = time.time()
         print_stdout_and_filename("Time taken to create fleet: " + str(end_time - start_time), print_filename)
         return instance_list
     else:
-        prices = get_cheapest_instance_types_df(initial_ec2, filter, multi_NIC=False)
+        prices = get_cheapest_instance_types_df(initial_ec2, filter, multi_NIC=False, is_UM=is_UM, print_filename=print_filename)
         instance_list = loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename, mode="instance")
         # print("Create fleet success with details: ", pretty_json(instance_list))
         print_stdout_and_filename("Create fleet success with details: " + pretty_json(instance_list), print_filename)
@@ -416,7 +475,17 @@ def create_fleet(initial_ec2, is_UM, proxy_count, proxy_impl, tag_prefix, filter
         print_stdout_and_filename("Time taken to create fleet: " + str(end_time - start_time), print_filename)
         return instance_list
 
-def loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt", mode="liveip"):
+def loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_prefix, wait_time_after_create=15, print_filename="data/output-general.txt", mode="liveip", use_planner=True, diversify=True, allocation_strategy="lowestPrice"):
+    """
+        Parameters:
+            use_planner: True to first request the cost-optimal mix of pools from api.plan_fleet (capped by past fulfilment, see api.get_pool_capacity_caps), 
+                and only fall back to the next cheapest pools for whatever that plan could not fulfil. False for the cheapest-pool-first loop only.
+            diversify: True to request the plan with one fleet per region, spread over the planned pools followed by the region's next cheapest pools 
+                (see create_fleet_diversified_rejuvenation), so that AWS fills a short pool from the others within the same request. False for one fleet per planned pool
+            allocation_strategy: of the diversified fleets, "lowestPrice" | "priceCapacityOptimized" | ...
+    """
+    if mode not in ("liveip", "instance"):
+        raise Exception("Invalid mode: " + str(mode))
     proxy_count_remaining = proxy_count
     instance_list = []
     ec2_list = []
@@ -426,32 +495,31 @@ def loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_p
     print_stdout_and_filename(prices.to_string(), print_filename) # https://stackoverflow.com/a/58070237/13336187
     count = 1
     prices = prices.reset_index(drop=True) # reset index. https://stackoverflow.com/a/20491748/13336187
-
-    optimal_cheapest_instance_details = None
-    first_iteration = True
-
-    while proxy_count_remaining > 0:
-        index, cheapest_instance = get_instance_row_with_supported_architecture(initial_ec2, prices, print_filename=print_filename)
-
-        if first_iteration:
-            max_nics = api.get_max_nics(initial_ec2, cheapest_instance['InstanceType'])
-            instances_to_create = math.ceil(proxy_count/max_nics) # this is only used for liveip (i.e., multi-NIC) scenario
-            optimal_cheapest_instance_details = {"OptimalInstanceCost": cheapest_instance['SpotPrice'], "OptimalInstanceType": cheapest_instance['InstanceType'], "OptimalInstanceZone": cheapest_instance['AvailabilityZone'], "OptimalInstanceMaxNICs": max_nics, "OptimalInstanceCount": instances_to_create}
-            first_iteration = False
-
-        prices = prices[index+1:] # if we repeat this loop, it means that we were not able to create enough instances of this type (i.e., index), so we should search from there onwards.
-        print_stdout_and_filename("Iteration {}: Number of rows in prices dataframe: ".format(count) + str(len(prices.index)), print_filename)
-        # df.to_string(header=False, index=False)
-        print_stdout_and_filename(prices.to_string(), print_filename) # https://stackoverflow.com/a/58070237/13336187
+    index = api.build_price_index(prices)
+    sort_by = 'PricePerInterface' if mode == "liveip" else 'SpotPrice'
+    tried_positions = [] # rows whose fleet came up short, never retried
+
+    candidates = api.query_price_index(index, sort_by=sort_by, supported_architecture=['x86_64'])
+    if len(candidates.index) == 0:
+        raise Exception("No instance type supports the architecture: " + str(['x86_64']))
+    cheapest_instance = candidates.iloc[0] # the optimal baseline ignores the blacklist below
+    blacklisted_pools = api.get_blacklisted_pools()
+    if blacklisted_pools:
+        print_stdout_and_filename("Skipping pools without capacity: " + str(blacklisted_pools), print_filename)
+        candidates = api.query_price_index(index, sort_by=sort_by, supported_architecture=['x86_64'], exclude_pools=blacklisted_pools)
+    max_nics = api.get_max_nics(initial_ec2, cheapest_instance['InstanceType'])
+    instances_to_create = math.ceil(proxy_count/max_nics) # this is only used for liveip (i.e., multi-NIC) scenario
+    optimal_cheapest_instance_details = {"OptimalInstanceCost": cheapest_instance['SpotPrice'], "OptimalInstanceType": cheapest_instance['InstanceType'], "OptimalInstanceZone": cheapest_instance['AvailabilityZone'], "OptimalInstanceMaxNICs": max_nics, "OptimalInstanceCount": instances_to_create}
+
+    def launch(cheapest_instance, proxies, pools=None, planned_counts=None):
         cheapest_instance_region = cheapest_instance['AvailabilityZone'][:-1]
         ec2, ce = api.choose_session(is_UM_AWS=is_UM, region=cheapest_instance_region)
-        if mode == "liveip":
-            instance_list_now, proxy_count_remaining = create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxy_count_remaining, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename)
-        elif mode == "instance":
-            instance_list_now, proxy_count_remaining = create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxy_count_remaining, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename)
+        if pools is not None:
+            instance_list_now, proxies_remaining = create_fleet_diversified_rejuvenation(ec2, pools, proxies, proxy_impl, tag_prefix, mode, planned_counts, wait_time_after_create, print_filename=print_filename, allocation_strategy=allocation_strategy)
+        elif mode == "liveip":
+            instance_list_now, proxies_remaining = create_fleet_live_ip_rejuvenation(ec2, cheapest_instance, proxies, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename)
         else:
-            raise Exception("Invalid mode: " + str(mode))
-
+            instance_list_now, proxies_remaining = create_fleet_instance_rejuvenation(ec2, cheapest_instance, proxies, proxy_impl, tag_prefix, wait_time_after_create, print_filename=print_filename)
         for ins in instance_list_now:
             ins['ec2_session_region'] = cheapest_instance_region
             ins['ce_session_region'] = cheapest_instance_region
@@ -459,6 +527,47 @@ def loop_create_fleet(initial_ec2, is_UM, prices, proxy_count, proxy_impl, tag_p
         # ec2_list.extend([ec2 for i in range(len(instance_list_now))]) # each instance will have its own ec2 session (in case this is different across instances...)
         # ce_list.extend([ce for i in range(len(instance_list_now))]) # each instance will have its own ce session (in case this is different across instances...)
         instance_list.extend(instance_list_now)
+        return proxies_remaining
+
+    if use_planner:
+        plan = api.plan_fleet(candidates, proxy_count, multi_NIC=(mode == "liveip"), capacity_caps=api.get_pool_capacity_caps())
+        print_stdout_and_filename("Fleet plan: " + pretty_json(plan), print_filename)
+        proxy_count_unplanned = proxy_count
+        proxy_count_remaining = 0
+        planned_proxies = defaultdict(int) # region -> proxies
+        planned_positions = defaultdict(list) # region -> planned rows, cheapest first
+        for entry in plan:
+            proxies = min(entry['Count'] * entry['ProxiesPerInstance'], proxy_count_unplanned)
+            proxy_count_unplanned -= proxies
+            if diversify:
+                planned_proxies[entry['AvailabilityZone'][:-1]] += proxies
+                planned_positions[entry['AvailabilityZone'][:-1]].append(entry['Index'])
+                continue
+            tried_positions.append(entry['Index'])
+            print_stdout_and_filename("Iteration {}: planned {} instances of {} in {}".format(count, entry['Count'], entry['InstanceType'], entry['AvailabilityZone']), print_filename)
+            proxy_count_remaining += launch(candidates.loc[entry['Index']], proxies)
+            count += 1
+
+        planned_counts = {(entry['InstanceType'], entry['AvailabilityZone']): entry['Count'] for entry in plan}
+        candidate_regions = candidates['AvailabilityZone'].astype(str).str[:-1]
+        for region, proxies in planned_proxies.items():
+            spillover = [position for position in candidates.index[candidate_regions == region] if position not in planned_positions[region]]
+            positions = (planned_positions[region] + spillover)[:api.FLEET_MAX_OVERRIDES]
+            tried_positions.extend(positions)
+            print_stdout_and_filename("Iteration {}: planned {} proxies over {} pools in {}".format(count, proxies, len(positions), region), print_filename)
+            proxy_count_remaining += launch(candidates.loc[positions[0]], proxies, pools=candidates.loc[positions], planned_counts=planned_counts)
+            count += 1
+
+    while proxy_count_remaining > 0:
+        candidates = api.query_price_index(index, sort_by=sort_by, supported_architecture=['x86_64'], k=1, exclude_positions=tried_positions, exclude_pools=api.get_blacklisted_pools())
+        if len(candidates.index) == 0:
+            raise Exception("Ran out of instance types to create the remaining {} proxies".format(proxy_count_remaining))
+        position, cheapest_instance = candidates.index[0], candidates.iloc[0]
+
+        tried_positions.append(position) # if we repeat this loop, it means that we were not able to create enough instances of this type, so we should search from the next candidate onwards.
+        print_stdout_and_filename("Iteration {}: Number of rows in prices dataframe: ".format(count) + str(len(prices.index) - len(tried_positions)), print_filename)
+        print_stdout_and_filename(cheapest_instance.to_string(), print_filename)
+        proxy_count_remaining = launch(cheapest_instance, proxy_count_remaining)
         count += 1
 
     return instance_list
@@ -565,38 +674,12 @@ def live_ip_rejuvenation(initial_ec2_region, is_UM, rej_period, proxy_count, exp
         start_time = time.time()
         # ec2, ce = api.choose_session(is_UM_AWS=is_UM, region=cheapest_instance_region)
         print_stdout_and_filename("Begin Rejuvenation count: " + str(rejuvenation_index), print_filename)
-        ec2, ce = api.choose_session(is_UM_AWS=is_UM, region=ec2_region)
-        for index, instance_details in enumerate(instance_list): 
-            if instance_details['ec2_session_region'] != ec2_region:
-                ec2_region = instance_details['ec2_session_region']
-                ec2, ce = api.choose_session(is_UM_AWS=is_UM, region=ec2_region)
-            instance_tag = tag_prefix + "-instance{}".format(str(index))
-            instance = instance_details['InstanceID']
-            new_nic_details = []
-            for index2, nic_details in enumerate(instance_details['NICs']):
-                start_time2 = time.time()
-                 # Deassociate and deallocate NICs from instances (including original one) (with tag values as indicated above):
-                api.disassociate_address(ec2, nic_details[2])
-                api.release_address(ec2, nic_details[1])
-
-                nic = nic_details[0]
-
-                # Allocate and associate elastic IPs to all of the NICs (including original one) (with tag values as indicated above):
-                # eip = api.create_eip(ec2, nic, tag)
-                eip = api.get_eip_id_from_allocation_response(api.allocate_address(ec2))
-                # api.associate_address(ec2, instance, eip, nic)
-                assoc_id = api.get_association_id_from_association_response(api.associate_address(ec2, instance, eip, nic))
-                new_nic_details.append((nic, eip, assoc_id))
-
-                end_time2 = time.time()
-                print_stdout_and_filename("Time taken to rejuvenate this NIC (EIP): " + str(end_time2 - start_time2), print_filename)
-
-                # Tag NICs and EIPs:
-                nic_tag = instance_tag + "-nic{}".format(str(index2))
-                eip_tag = nic_tag + "-eip{}".format(str(index2))
-                # api.assign_name_tags(ec2, nic, nic_tag) # TODO: bypass Request limit exceeded for now
-                # api.assign_name_tags(ec2, eip, eip_tag) # TODO: bypass Request limit exceeded for now
-            instance_details['NICs'] = new_nic_details
+        # Swap the elastic IPs of all of the NICs (including original one) concurrently across the fleet, with pre-allocated EIPs (see api.rotate_fleet_ips):
+        clients = {region: api.choose_session(is_UM_AWS=is_UM, region=region)[0] for region in set(instance_details['ec2_session_region'] for instance_details in instance_list)}
+        rotation = api.rotate_fleet_ips(clients, instance_list)
+        print_stdout_and_filename("Rotation results: " + pretty_json(rotation), print_filename)
+        if rotation['failures'] or rotation['release_failures']:
+            raise Exception("Failed to rotate the EIPs of {} NICs: {}, failed to release {} old EIPs: {}".format(len(rotation['failures']), rotation['failures'], len(rotation['release_failures']), rotation['release_failures']))
     
         # Make sure instance can be sshed/pinged (fail rejuvenation if not):
         time.sleep(wait_time_after_nic)
@@ -639,7 +722,8 @@ def live_ip_rejuvenation(initial_ec2_region, is_UM, rej_period, proxy_count, exp
             ec2_region = instance_details['ec2_session_region']
             ec2, ce = api.choose_session(is_UM_AWS=is_UM, region=ec2_region)
         for nic_details in instance_details['NICs']:
-            api.disassociate_address(ec2, nic_details[2])
+            if nic_details[2] is not None: # None if a failed rotation could not re-associate the old EIP
+                api.disassociate_address(ec2, nic_details[2])
             api.release_address(ec2, nic_details[1])
         instance = instance_details['InstanceID']
         api.terminate_instances(ec2, [instance])
@@ -794,51 +878,10 @@ def calculate_cost(instance_list, rej_period, exp_duration, multi_NIC=True, rej_
             - Why am I going through this trouble? Because even after 24 hours, the cost explorer did not populate the instance costs for instances that were only run for a few mins... but it did for the instance that ran for ~1 hours (with tag "test-delete-cost-explorer-show-up") in the same period.. Verified this using tags.. 
                 - Also there are inconsistencies in AWS cost explorer output: when not applying the tag "test-delete-cost-explorer-show-up" the cost was $0.05 (for the m7a.medium instance only), but when applying the tag it was $0.06.....
     """
-    total_cost = 0
-    optimal_cost = 0 
-    total_monthly_cost = 0
-    optimal_monthly_cost = 0
     if multi_NIC: # i.e., if live ip rejuvenations
         assert rej_count is not None, "rej_count must be provided for live ip rejuvenations"
-
-        # Get optimal instance details: 
-        optimal_instance_cost = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceCost']
-        optimal_instance_count = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceCount']
-        optimal_instance_nics = instance_list[0]['optimal_cheapest_instance']['OptimalInstanceMaxNICs']
-        # Calculate optimal cost:
-        optimal_nic_cost = 0.005 * int(optimal_instance_nics) * math.ceil(exp_duration/60) * optimal_instance_count  # just the cost of the EIPs attached to it (statically) throughout the entire experiment
-        optimal_instance_cost = float(optimal_instance_cost) / 60 * exp_duration * optimal_instance_count 
-        optimal_cost = optimal_instance_cost + optimal_nic_cost
-
-        # Iterate through each instance within instance_list: 
-        for instance_details in instance_list:
-            instance_cost = float(instance_details['InstanceCost']) / 60 * exp_duration # we assume that live IP is able to acquire the cheapest instance (this is reasonable since our exp will terminate if it weren't able to acquire the cheapest instance at initialization).
-            # + float(instance_details['InstanceCost']) / 60 # instance charge is per-second granularity, but the first minute is also charged by default. 
-            # Get the number of NICs of this instance_type:
-            num_eips = len(instance_details['NICs'])
-            # Calculate the cost of elastic IPs attached to this instance (assuming prior to Feb 1, where the ephemeral one is free..):
-            # num_rejuvenations = math.ceil(exp_duration * 60 / rej_period)
-            num_rejuvenations = rej_count
-            per_rej_hours = math.ceil(rej_period/3600) # number of hours elapsed per rejuvenation
-            nic_cost = 0.005 * num_eips * num_rejuvenations * per_rej_hours # hour level granularity charge for allocated IP addresses
-            remapping_cost = num_eips * num_rejuvenations * 0.1 * 2 # only for AWS for now. Deallocate and allocate are both distinct operations that are remappings. 
-            
-            # Calculate total cost of NICs (skipping since additional ENIs are free..) + elastic IPs + instance_type + remapping cost:
-            total_cost += instance_cost + nic_cost + remapping_cost
-    else:
-        for instance_details in instance_list:
-            instance_cost = float(instance_details['InstanceCost']) / 60 * exp_duration / rej_count # assume that each instance across all rejuvenation events has been running for an equal amount of time. 
-
-            optimal_instance_cost = float(instance_details['optimal_cheapest_instance']['OptimalInstanceCost']) / 60 * exp_duration / rej_count # assume that each instance across all rejuvenation events has been running for an equal amount of time.
-
-            # Calculate total cost of NICs (skipping since additional ENIs are free..) + elastic IPs + instance_type + remapping cost:
-            total_cost += instance_cost
-            optimal_cost += optimal_instance_cost
-
-    total_monthly_cost = total_cost / exp_duration * 60 * 24 * 30
-    optimal_monthly_cost = optimal_cost / exp_duration * 60 * 24 * 30
-
-    return total_cost, optimal_cost, total_monthly_cost, optimal_monthly_cost
+    # EIPs are charged by the hour for every rejuvenation, plus remapping charges (see cost_model.cost_grid for the formulas):
+    return cost_model.cost_point(instance_list, rej_period, exp_duration, multi_NIC=multi_NIC, rej_count=rej_count, eip_billing="hourly", remap_price=cost_model.REMAP_PRICE, ephemeral_charge=ephemeral_charge)
 
 def parse_input_args(filename):
     with open(filename, 'r') as j:
@@ -954,6 +997,7 @@ if __name__ == '__main__':
     for thread in threads:
         # Wait for threads to end:
         thread.join()
+    api.close_eip_pools() # release the spare EIPs, shared by every live IP thread
     
     # except Exception as e:
     #     print("Exception occurred: ", e)
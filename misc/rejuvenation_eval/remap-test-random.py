@@ -65,14 +65,15 @@ launch_template = api.use_UM_launch_templates(ec2, region, proxy_impl, "main")
 # SECTION: Create two instances
 # Create the initial fleet (2 instances) 
 response = api.create_fleet(ec2, instance_type, zone, launch_template, 2)
-time.sleep(30) # wait awhile for fleet to be created
 # make sure that the required instances have been acquired: 
 print(response['FleetId'])
 print(api.pretty_json(response))
-all_instance_details = api.get_specific_instances_with_fleet_id_tag(ec2, response['FleetId'], "raw") 
-if len(all_instance_details) != 2:
-    warnings.warn("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required.")
-    print_stdout_and_filename("Not enough instances were created: only created " + str(len(all_instance_details)) + " instances, but " + str(instances_to_create) + " were required.", print_filename)
+try:
+    all_instance_details = api.wait_for_fleet(ec2, response['FleetId'], 2, fulfilment_timeout=30) # returns as soon as both instances are running
+except api.PartialFleetFulfilment as e:
+    all_instance_details = e.instances
+    warnings.warn("Not enough instances were created: " + str(e))
+    print("Not enough instances were created: " + str(e))
 
 # SECTION: Create 1 EIP and attach it to the first instance's NIC. 
 eip = api.get_eip_id_from_allocation_response(api.allocate_address(ec2))
@@ -0,0 +1,215 @@
+"""
+    Offline replay of spot price history through the replace_instance_loop decision logic (api.replacement_action), on a simulated clock.
+
+    Every policy/parameter combination is one lane of numpy state arrays, so a single pass over the timesteps evaluates all of them at once.
+
+    Policy parameters (each is a list in the input args, the simulator runs their cartesian product):
+        - price_column: "SpotPrice" | "PricePerInterface". Used to pick the cheapest instance type (instances are always billed at SpotPrice)
+        - check_interval: in minutes, how often the loop re-evaluates the fleet (replace_instance_loop: 5)
+        - capacity: number of instances to keep running
+        - switch_threshold: minimum relative saving before we replace the fleet with the cheapest type (replace_instance_loop: 0, i.e., replace on any change)
+        - launch_delay: in minutes, time between create_fleet and the instances serving
+        - max_price: hourly price above which the current pool's instances are interrupted (null for never)
+
+    Outputs per combination: total cost, number of churn events (fleet replacements), interruptions and time spent under capacity.
+"""
+
+import time
+import sys
+import json
+import itertools
+import numpy as np
+import pandas as pd
+sys.path.append("../../")
+import api
+
+DEFAULT_POLICY_PARAMS = {
+    "price_column": ["SpotPrice"],
+    "check_interval": [api.REPLACE_INTERVAL // 60],
+    "capacity": [api.capacity],
+    "switch_threshold": [0.0],
+    "launch_delay": [1],
+    "max_price": [None],
+}
+
+def parse_input_args(filename):
+    with open(filename, 'r') as j:
+        input_args = json.loads(j.read())
+    return input_args
+
+def load_price_history(source, provider="AWS", store_dir=api.PRICE_STORE_DIR):
+    """
+        Parameters:
+            source: path to a price csv (e.g., total_spot_prices.csv, spot_prices.csv) | "store" (the columnar price store under store_dir, see api.read_price_history)
+        Returns:
+            df with Timestamp, AvailabilityZone, InstanceType, SpotPrice, PricePerInterface
+    """
+    if source == "store":
+        history = api.read_price_history(provider, store_dir=store_dir)
+        if history is None:
+            raise Exception("No {} prices in the price store".format(provider))
+    else:
+        history = pd.read_csv(source, index_col=0)
+    if 'Provider' in history.columns:
+        history = history[history['Provider'] == provider]
+    history = history[['Timestamp', 'AvailabilityZone', 'InstanceType', 'SpotPrice', 'PricePerInterface']].copy()
+    history['Timestamp'] = pd.to_datetime(history['Timestamp'], utc=True)
+    history['AvailabilityZone'] = history['AvailabilityZone'].astype(str)
+    history['InstanceType'] = history['InstanceType'].astype(str)
+    return history
+
+def build_price_matrices(history, step_minutes, start=None, end=None):
+    """
+        Resamples the price history onto a regular clock. A pool's price holds until its next record (forward fill), and is NaN before its first record.
+
+        Returns:
+            grid: DatetimeIndex of the timesteps
+            matrices: {price column: (timesteps x pools) array}
+            pool_types: instance type code of each pool (pools of the same type share a code)
+            pools: Index of "<AvailabilityZone>|<InstanceType>"
+    """
+    history = history.assign(Pool=history['AvailabilityZone'] + "|" + history['InstanceType'])
+    pools = pd.Index(sorted(history['Pool'].unique()))
+    start = pd.Timestamp(start) if start is not None else history['Timestamp'].min().floor(str(step_minutes) + "min")
+    end = pd.Timestamp(end) if end is not None else history['Timestamp'].max()
+    grid = pd.date_range(start, end, freq=str(step_minutes) + "min")
+
+    matrices = {}
+    for column in ['SpotPrice', 'PricePerInterface']:
+        pivot = history.pivot_table(index='Timestamp', columns='Pool', values=column, aggfunc='last').reindex(columns=pools)
+        pivot = pivot.reindex(pivot.index.union(grid)).ffill().reindex(grid)
+        matrices[column] = pivot.to_numpy(dtype=float)
+
+    pool_types = pd.factorize(pools.str.split("|").str[1])[0]
+    return grid, matrices, pool_types, pools
+
+def expand_policy_grid(policy_params):
+    params = dict(DEFAULT_POLICY_PARAMS)
+    params.update(policy_params or {})
+    names = list(params.keys())
+    combos = [dict(zip(names, values)) for values in itertools.product(*(params[name] for name in names))]
+    return pd.DataFrame(combos)
+
+def simulate(matrices, pool_types, combos, step_minutes):
+    """
+        Replays every combination in combos (one row per combination, see expand_policy_grid) over the price matrices.
+
+        Per timestep, for all combinations at once:
+            1. interrupt the current pool's instances if its price went above max_price (or it disappeared)
+            2. on check_interval boundaries, run api.replacement_action against the cheapest pool: replace (a churn event) or top up to capacity in that pool
+            3. mark launches that are older than launch_delay as running
+            4. bill running and launching instances at the current pool's SpotPrice
+
+        Returns:
+            combos with total_cost, churn_events, interruptions and hours_under_capacity columns added
+    """
+    columns = ['SpotPrice', 'PricePerInterface']
+    step_hours = step_minutes / 60
+    timesteps = matrices['SpotPrice'].shape[0]
+
+    # Cheapest pool per timestep, for each decision column:
+    cheapest_pool = np.zeros((len(columns), timesteps), dtype=int)
+    cheapest_price = np.full((len(columns), timesteps), np.inf)
+    for k, column in enumerate(columns):
+        prices = np.where(np.isnan(matrices[column]), np.inf, matrices[column])
+        cheapest_pool[k] = np.argmin(prices, axis=1)
+        cheapest_price[k] = prices[np.arange(timesteps), cheapest_pool[k]]
+
+    lanes = len(combos.index)
+    key = combos['price_column'].map({column: k for k, column in enumerate(columns)}).to_numpy()
+    check_every = np.maximum(1, np.round(combos['check_interval'].to_numpy(dtype=float) / step_minutes)).astype(int)
+    capacity = combos['capacity'].to_numpy(dtype=int)
+    threshold = combos['switch_threshold'].to_numpy(dtype=float)
+    delay = np.round(combos['launch_delay'].to_numpy(dtype=float) / step_minutes).astype(int)
+    max_price = pd.to_numeric(combos['max_price'], errors='coerce').fillna(np.inf).to_numpy(dtype=float) # object column when it holds nulls
+
+    current_pool = np.full(lanes, -1) # -1: no fleet yet
+    running = np.zeros(lanes, dtype=int)
+    pending = np.zeros(lanes, dtype=int)
+    ready_at = np.zeros(lanes, dtype=int)
+    total_cost = np.zeros(lanes)
+    churn_events = np.zeros(lanes, dtype=int)
+    interruptions = np.zeros(lanes, dtype=int)
+    steps_under_capacity = np.zeros(lanes, dtype=int)
+
+    for t in range(timesteps):
+        spot_row = matrices['SpotPrice'][t]
+        decision_rows = np.stack([matrices[column][t] for column in columns])
+        pool = current_pool.clip(0)
+        has_fleet = current_pool >= 0
+
+        # 1. interruptions:
+        current_spot = np.where(has_fleet, spot_row[pool], np.nan)
+        interrupted = has_fleet & (running + pending > 0) & ~(current_spot <= max_price)
+        running[interrupted] = 0
+        pending[interrupted] = 0
+        interruptions += interrupted
+
+        # 2. replace_instance_loop decision:
+        decide = np.isfinite(cheapest_price[key, t]) & (t % check_every == 0)
+        cheap_pool = cheapest_pool[key, t]
+        action = api.replacement_action(pool_types[cheap_pool], np.where(has_fleet, pool_types[pool], -1), running + pending, capacity)
+        current_decision_price = decision_rows[key, pool]
+        worth_it = ~has_fleet | np.isnan(current_decision_price) | (cheapest_price[key, t] <= current_decision_price * (1 - threshold))
+        replace = decide & (action == api.ACTION_REPLACE) & worth_it
+        top_up = decide & ~replace & (running + pending < capacity)
+
+        churn_events += replace & has_fleet
+        # like replace_instance_loop, a top-up launches in the cheapest pool (same type, maybe another zone). 
+        # A lane tracks a single pool, so its running instances are then billed and interrupted at that pool's price too.
+        top_up_pool = np.where(action == api.ACTION_TOP_UP, cheap_pool, current_pool)
+        current_pool = np.where(replace, cheap_pool, np.where(top_up, top_up_pool, current_pool))
+        running = np.where(replace, 0, running)
+        pending = np.where(replace, capacity, np.where(top_up, capacity - running, pending))
+        ready_at = np.where(replace | top_up, t + delay, ready_at)
+
+        # 3. launches that completed:
+        done = (pending > 0) & (t >= ready_at)
+        running = np.where(done, running + pending, running)
+        pending = np.where(done, 0, pending)
+
+        # 4. billing:
+        has_fleet = current_pool >= 0
+        current_spot = np.where(has_fleet, spot_row[current_pool.clip(0)], 0)
+        total_cost += (running + pending) * np.nan_to_num(current_spot) * step_hours
+        steps_under_capacity += running < capacity
+
+    return combos.assign(
+        total_cost=total_cost,
+        churn_events=churn_events,
+        interruptions=interruptions,
+        hours_under_capacity=steps_under_capacity * step_hours,
+        simulated_hours=timesteps * step_hours,
+    )
+
+# Usage example: python3 replay-simulator.py input-args.json
+if __name__ == '__main__':
+    """
+        Input args:
+            {
+                "source": "../../total_spot_prices.csv", # or "store"
+                "store_dir": "../../price_store", # only read if source is "store", relative to this directory
+                "provider": "AWS",
+                "step_minutes": 5,
+                "start": null, # ISO timestamps, defaults to the span of the history
+                "end": null,
+                "policy_params": {"capacity": [2, 10], "switch_threshold": [0, 0.05, 0.1], ...}, # see DEFAULT_POLICY_PARAMS
+                "output": "replay-results.csv"
+            }
+    """
+    input_args = parse_input_args(sys.argv[1])
+    step_minutes = input_args.get('step_minutes', 5)
+
+    history = load_price_history(input_args.get('source', '../../total_spot_prices.csv'), input_args.get('provider', 'AWS'), input_args.get('store_dir', '../../' + api.PRICE_STORE_DIR))
+    grid, matrices, pool_types, pools = build_price_matrices(history, step_minutes, input_args.get('start'), input_args.get('end'))
+    combos = expand_policy_grid(input_args.get('policy_params'))
+    print("Replaying {} timesteps of {} pools for {} policy combinations".format(len(grid), len(pools), len(combos.index)))
+
+    start_time = time.time()
+    results = simulate(matrices, pool_types, combos, step_minutes)
+    end_time = time.time()
+    print("Time taken to replay: " + str(end_time - start_time))
+
+    results = results.sort_values(by=['total_cost'])
+    print(results.to_string())
+    results.to_csv(input_args.get('output', 'replay-results.csv'))